@@ -16,79 +16,293 @@ Handles the actual creation and logging of popup AMIs
 import base64
 import os
 import sys
-import time
 
 from datetime import datetime
 
+from . import backend, bake, discovery, index, journal, reaper, shared, trace, waiter
+
+
+# SSH, OpenVPN, Mosh, Tor, HTTP/S
+# XXX Configure this in the playbooks (or next to the playbooks)
+PORTS = [('tcp', 22, 22), ('tcp', 1194, 1194), ('udp', 1194, 1194), ('udp', 60000, 61000), ('tcp', 80, 80),
+    ('tcp', 443, 443), ('tcp', 9001, 9001), ('tcp', 9030, 9030)]
+
+# Without --max-price we bid this much over the highest current spot price
+SPOT_MARKUP = 1.2
+# Seconds to wait for spot requests before falling back to on-demand
+SPOT_TIMEOUT = 300
+
 
 class PopupServer():
-    def __init__(self, conn, args):
-        """We use 2 different AMIs based on instance size.
-        Both images are 64-bit ubuntu 12.10 in us-east-1
+    def __init__(self, conn, args, journal=None, detach=False):
+        """We use 2 different stock AMIs based on instance size (see bake.STOCK_IMAGES).
+        If the selected playbooks have been baked into an image of that stock AMI we boot it instead.
+
+        With args.count > 1 a whole fleet is launched from a single run request.
+        Every instance in the fleet shares the key pair, security group and popup_id.
+        With args.share the security group is shared with other popups (see shared.py).
+
+        With a journal (see journal.py) every completed step is recorded, and steps the
+        journal already has are picked up instead of redone. detach returns as soon as
+        the instances are launched and tagged, leaving instance_ids set but not instances.
         """
         self.args = args
         self.conn = conn
+        self.journal = journal
+        self.detach = detach
+        identity = self._resumed('identity')
+        # Picking up an interrupted create: what it was doing may have happened without being recorded
+        self.resuming = identity is not None
         self.connection_string = None
-        self.date = str(datetime.date(datetime.now())).replace('-','')
+        self.connection_strings = []
+        self.count = getattr(args, 'count', 1) or 1
+        self.workers = getattr(args, 'workers', 8) or 1
+        self.spot = getattr(args, 'spot', False)
+        self.spot_requests = []
+        self.date = identity['date'] if identity else str(datetime.date(datetime.now())).replace('-','')
+        # The reaper stops the popup once this passes
+        self.expires = identity['expires'] if identity else reaper.expires_tag(getattr(args, 'lifetime', None))
         self.home = os.path.expanduser('~')
         self.instance = None
+        self.instances = []
+        self.instance_ids = []
         self.kp = None
+        self.keyfile = None
         self.sg = None
-        self.unique_tag = base64.urlsafe_b64encode(os.urandom(6))
+        self.unique_tag = identity['popup_id'] if identity else base64.urlsafe_b64encode(os.urandom(6)).decode('ascii')
         self.name_tag = "popup-%s-%s" % (args.iam, self.unique_tag)
-        self.size = self.args.size
-        if self.size == "micro":
-            self.size = "t1.micro"
-            self.ami = "ami-7539b41c"
-        if self.size == "small":
-            self.size = "m1.small"
-            self.ami = "ami-9b3db0f2"
-        self.image = self.conn.get_all_images(self.ami)
+        # With --share the security group (and with --share-key the key pair) outlive this popup
+        share = getattr(args, 'share', None)
+        shared_name = shared.shared_name(args.iam, args.client if share == 'client' else None)
+        self.group_name = shared_name if share else self.name_tag
+        self.key_name = shared_name if share and getattr(args, 'share_key', False) else self.name_tag
+        self.key_material = None
+        self.playbooks = getattr(args, 'playbooks', None) or []
+        if identity:
+            self.size, self.ami, self.baked = identity['size'], identity['ami'], identity['baked']
+        else:
+            self.size, self.ami, self.baked = bake.choose_image(self.conn, self.args.size, self.playbooks,
+                stock=getattr(args, 'stock', False))
+            self._record('identity', popup_id=self.unique_tag, date=self.date, expires=self.expires, size=self.size,
+                ami=self.ami, baked=self.baked, group_name=self.group_name, key_name=self.key_name)
         self.start()
 
+    def _resumed(self, step):
+        """What the journal recorded for step, or None if it wasn't completed"""
+        return self.journal.done(step) if self.journal is not None else None
+
+    def _record(self, step, **data):
+        if self.journal is not None:
+            self.journal.record(step, **data)
+
+    @trace.traced('create.key_pair')
     def _create_key_pair(self):
-        self.kp = self.conn.create_key_pair(self.name_tag)
-        with open('%s/.popup/keys/%s.pem' % (self.home, self.kp.name), 'wb') as f:
+        done = self._resumed('key_pair')
+        if done:
+            self.key_name, self.keyfile = done['key_name'], done['keyfile']
+            self.kp = self.conn.get_all_key_pairs(keynames=[self.key_name])[0]
+            with open(self.keyfile) as f:
+                self.key_material = f.read()
+            return
+        self._make_key_pair()
+        self._record('key_pair', key_name=self.key_name, keyfile=self.keyfile)
+
+    def _make_key_pair(self):
+        self.keyfile = '%s/.popup/keys/%s.pem' % (self.home, self.key_name)
+        if self.key_name != self.name_tag:
+            self.kp, self.key_material = shared.ensure_key_pair(self.conn, self.key_name, self.keyfile)
+            if self.kp is not None:
+                return
+            print("...no private key for shared keypair %s, using a new one" % self.key_name)
+            self.key_name = self.name_tag
+            self.keyfile = '%s/.popup/keys/%s.pem' % (self.home, self.key_name)
+        existing = self.conn.get_all_key_pairs(filters={'key-name': self.key_name}) if self.resuming else []
+        if existing:
+            if not os.path.exists(self.keyfile):
+                raise journal.Unresumable("key pair %s was created but its private key was never saved, "
+                    "run `popup resume --rollback %s` to undo the create" % (self.key_name, self.journal.op))
+            self.kp = existing[0]
+            with open(self.keyfile) as f:
+                self.key_material = f.read()
+            return
+        self.kp = self.conn.create_key_pair(self.key_name)
+        self.key_material = self.kp.material
+        with open(self.keyfile, 'w') as f:
             f.write(self.kp.material)
-            os.chmod(f.name, 0600)
-        
+            os.chmod(f.name, 0o600)
+
     def _create_security_group(self):
-        self.sg = self.conn.create_security_group(self.name_tag, "Popup OpenVPN for %s (%s)" % (self.args.iam, self.date))
-        # SSH, OpenVPN, Mosh, Tor, HTTP/S
-        # XXX Configure this in the playbooks (or next to the playbooks)
-        for triple in [('tcp', 22, 22), ('tcp', 1194, 1194), ('udp', 1194, 1194), ('udp', 60000, 61000), ('tcp', 80, 80),
-            ('tcp', 443, 443), ('tcp', 9001, 9001), ('tcp', 9030, 9030)]:
-            self.sg.authorize(triple[0], triple[1], triple[2], '0.0.0.0/0')
+        if self._resumed('security_group'):
+            self.sg = self.conn.get_all_security_groups(groupnames=[self.group_name])[0]
+            return
+        self._make_security_group()
+        self._record('security_group', group_name=self.group_name)
 
+    def _make_security_group(self):
+        description = "Popup OpenVPN for %s (%s)" % (self.args.iam, self.date)
+        if self.group_name != self.name_tag:
+            self.sg = shared.ensure_security_group(self.conn, self.group_name, description, PORTS)
+            return
+        existing = self.conn.get_all_security_groups(filters={'group-name': self.group_name}) if self.resuming else []
+        if existing:
+            self.sg = existing[0]
+            # Rules go on in one request, so a group either has all of them or none
+            if not self.sg.rules:
+                shared.authorize_all(self.conn, self.group_name, PORTS)
+            return
+        self.sg = self.conn.create_security_group(self.group_name, description)
+        shared.authorize_all(self.conn, self.group_name, PORTS)
 
-    def start(self):
-        self._create_key_pair()
-        self._create_security_group()
-        self.reservation = self.image[0].run(1, 1, key_name=self.kp.name, security_groups=[self.sg.name], instance_type=self.size)
-        self.instance = self.reservation.instances[0]
-        self._update_state()
-        print("...pending")
-        while self.state == u'pending':
-            sys.stdout.write('.')
-            self._update_state()
-            time.sleep(30)
-        self.public_dns = self.instance.public_dns_name
-        self.instance.add_tag('popup_id', self.unique_tag)
-        self.instance.add_tag('start_date', self.date)
-        self.instance.add_tag('owner', self.args.iam)
+    def _spot_price(self):
+        """Bid SPOT_MARKUP over the highest current price across availability zones"""
+        history = self.conn.get_spot_price_history(instance_type=self.size, product_description='Linux/UNIX')
+        latest = {}
+        for point in sorted(history, key=lambda p: p.timestamp):
+            latest[point.availability_zone] = point.price
+        if not latest:
+            return None
+        return round(max(latest.values()) * SPOT_MARKUP, 4)
+
+    def _request_spot(self):
+        """Request count spot instances and wait for them to be fulfilled.
+        Requests still open at the deadline are cancelled. Returns the ids of the spot instances.
+        """
+        price = getattr(self.args, 'max_price', None) or self._spot_price()
+        if price is None:
+            print("...no spot price history for %s" % self.size)
+            return []
+        print("...requesting %d spot instances at $%s/hour" % (self.count, price))
+        requests = backend.request_spot_instances(self.conn, str(price), self.ami, self.count, self.kp.name, [self.sg.name],
+            self.size, client_token=self._client_token('spot'))
+        request_ids = [r.id for r in requests]
+        self.conn.create_tags(request_ids, self._tags())
+        try:
+            fulfilled = waiter.wait_for_spot_requests(self.conn, request_ids, u'active',
+                timeout=getattr(self.args, 'spot_timeout', None) or SPOT_TIMEOUT, tick=lambda pending: sys.stdout.write('.'))
+        except waiter.WaitTimeout as e:
+            self.conn.cancel_spot_instance_requests(e.pending)
+            # A request can be fulfilled while it's being cancelled
+            fulfilled = e.done
+            fulfilled.update((r.id, r) for r in self.conn.get_all_spot_instance_requests(request_ids=e.pending))
+        # Cancelling doesn't terminate an instance that was already launched
+        active = [r for r in fulfilled.values() if r.state in (u'active', u'cancelled') and r.instance_id]
+        self.spot_requests = [r.id for r in active]
+        return [r.instance_id for r in active]
+
+    def _client_token(self, request):
+        """Same for every attempt at this create, so a resumed launch gets the original one back"""
+        op = self.journal.op if self.journal is not None else None
+        return '-'.join(part for part in [op, self.unique_tag, request] if part)
+
+    def _tags(self):
+        tags = dict(getattr(self.args, 'tags', None) or {})
+        tags.update({'popup_id': self.unique_tag, 'start_date': self.date, 'owner': self.args.iam})
         if self.args.client:
-            self.instance.add_tag('client', self.args.client)
+            tags['client'] = self.args.client
+        if self.expires:
+            tags[reaper.EXPIRES_TAG] = self.expires
+        return tags
+
+    def _own_resource_ids(self):
+        """Ids of the key pair and security group if this popup created them.
+        boto 2 doesn't return key pair ids, so real key pairs can't be tagged
+        """
+        ids = []
+        if self.group_name == self.name_tag:
+            ids.append(getattr(self.sg, 'id', None))
+        if self.key_name == self.name_tag:
+            ids.append(getattr(self.kp, 'id', None))
+        return [id for id in ids if id]
 
+    def _write_manifest(self, instance):
         # Manifest files serve as a poor inventory system
         # and a backup location for the server's SSH key
-        with open('%s/.popup/manifests/%s-%s-%s' % (self.home, self.date, self.public_dns, self.unique_tag), 'w') as f:
-            f.write(self.kp.material)
-            os.chmod(f.name, 0600)
+        with open('%s/.popup/manifests/%s-%s-%s' % (self.home, self.date, instance.public_dns_name, self.unique_tag), 'w') as f:
+            f.write(self.key_material)
+            os.chmod(f.name, 0o600)
 
-        self.connection_string = "ssh -i %s/.popup/keys/%s.pem ubuntu@%s" % (self.home, self.kp.name, self.public_dns)
-        return self
+    def start(self):
+        with trace.span('create', popup_id=self.unique_tag, count=self.count):
+            return self._start()
+
+    def _start(self):
+        # Deferred: multiprocessing is the slowest import on the CLI's startup path
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(self.workers)
+        try:
+            keypair = pool.apply_async(self._create_key_pair)
+            with trace.span('create.security_group', group_name=self.group_name):
+                self._create_security_group()
+            keypair.get()
+        finally:
+            pool.close()
+            pool.join()
 
-    def _update_state(self):
-        self.instance.update()
+        tags = self._tags()
+        # Before the launch, so they can be found by tag even if it fails
+        resources = self._own_resource_ids()
+        if resources and not self._resumed('resources_tagged'):
+            with trace.span('create.tag_resources', ids=resources):
+                self.conn.create_tags(resources, tags)
+            self._record('resources_tagged', ids=resources)
+        launched = self._resumed('launched')
+        if launched:
+            instance_ids, untagged, self.spot_requests = launched['instance_ids'], launched['untagged'], launched['spot_requests']
+        else:
+            instance_ids, untagged = self._launch(tags)
+            self._record('launched', instance_ids=instance_ids, untagged=untagged, spot_requests=self.spot_requests)
+        self.instance_ids = list(instance_ids)
+        if untagged and not self._resumed('tagged'):
+            with trace.span('create.tag', instance_ids=untagged):
+                self.conn.create_tags(untagged, tags)
+            self._record('tagged', instance_ids=untagged)
+        if self.detach:
+            return self
+        print("...pending")
+        # Public DNS names are assigned by the time instances are running
+        with trace.span('create.wait_running', instance_ids=instance_ids):
+            ready = waiter.wait_for_state(self.conn, instance_ids, u'running',
+                tick=lambda pending: sys.stdout.write('.'))
+        return self.running(ready)
+
+    def running(self, ready):
+        """Record the instances once they're running; ready is {instance id: instance} as returned
+        by waiter.wait_for_state. Called by start, or by whoever waited for a detached launch.
+        """
+        instance_ids = self.instance_ids
+        self.instances = [ready[id] for id in instance_ids]
+        self.instance = self.instances[0]
         self.state = self.instance.state
+        self.public_dns = self.instance.public_dns_name
 
+        with trace.span('create.record', instance_ids=instance_ids):
+            index.Index().record([discovery.Popup.from_instance(i) for i in self.instances], self.keyfile)
+            for instance in self.instances:
+                self._write_manifest(instance)
+                self.connection_strings.append("ssh -i %s ubuntu@%s" % (self.keyfile, instance.public_dns_name))
+        self._record('manifest', hostnames=[i.public_dns_name for i in self.instances],
+            manifests=[discovery.Popup.from_instance(i).manifest for i in self.instances])
+        self.connection_string = self.connection_strings[0]
+        return self
+
+    def _launch(self, tags):
+        """Spot requests and/or one run request for the rest.
+        Returns (instance ids, the ids that still need tags); every instance of the launch
+        gets its tags in a single request
+        """
+        instance_ids = []
+        if self.spot:
+            with trace.span('create.spot', count=self.count) as span:
+                instance_ids = span['instance_ids'] = self._request_spot()
+        untagged = list(instance_ids)
+        shortfall = self.count - len(instance_ids)
+        if shortfall:
+            if self.spot:
+                print("...%d spot requests unfulfilled, launching on-demand" % shortfall)
+            # Tagged as they're created
+            with trace.span('create.launch', count=shortfall) as span:
+                self.reservation = backend.run_instances(self.conn, self.ami, shortfall, self.kp.name, [self.sg.name],
+                    self.size, tags, client_token=self._client_token('launch'))
+                span['instance_ids'] = [i.id for i in self.reservation.instances]
+            instance_ids.extend(i.id for i in self.reservation.instances)
+        return instance_ids, untagged
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+asyncio control plane, for services that manage many popups from one event loop.
+Python 3.7+ only; nothing else in the package imports it.
+
+Blocking boto calls run on a thread pool of at most `limit` workers, and waiting
+for instances is a coroutine that sleeps on the loop between describes, so a
+thousand pending popups don't hold a thousand threads.
+
+    python3 -m PopupServer.aio [popup arguments]
+
+runs a CLI command under asyncio.run. create and destroy go through the
+Controller; everything else (and create's pool, detach and VPN options, which
+the Controller doesn't cover) runs as one call on the executor.
+"""
+
+import asyncio
+import functools
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import PopupServer, backend, discovery, index, popup, provision, scheduler, waiter
+
+
+# Concurrent blocking calls per Controller
+LIMIT = 16
+
+
+class Controller(object):
+    """create/inventory/stop/destroy as coroutines over one connection"""
+
+    def __init__(self, conn, limit=LIMIT):
+        self.conn = conn
+        self._executor = ThreadPoolExecutor(max_workers=limit)
+
+    async def call(self, fn, *args, **kwargs):
+        """Run a blocking callable on the executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def ec2(self, operation, *args, **kwargs):
+        """Run one of backend.OPERATIONS"""
+        return await self.call(getattr(self.conn, operation), *args, **kwargs)
+
+    async def wait_for_state(self, instance_ids, desired, timeout=None, delay=None, max_delay=None, tick=None):
+        """waiter.wait_for_state without holding a thread between describes"""
+        timeout = waiter.TIMEOUT if timeout is None else timeout
+        delay = waiter.DELAY if delay is None else delay
+        max_delay = waiter.MAX_DELAY if max_delay is None else max_delay
+
+        deadline = time.time() + timeout
+        pending = set(instance_ids)
+        done = {}
+        while True:
+            found = await self.call(waiter._describe_instances, self.conn, set(pending))
+            waiter._settle(found, pending, done, desired, waiter._DEAD_INSTANCE)
+            if tick is not None:
+                tick(pending)
+            if not pending:
+                return done
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise waiter.WaitTimeout(desired, pending, done)
+            await asyncio.sleep(waiter._sleep_for(remaining, delay))
+            delay = min(max_delay, delay * waiter.BACKOFF)
+
+    async def create(self, args, provision_hosts=True):
+        """Launch a popup (or fleet) as `popup create` would. Returns the PopupServer.
+        Only the API calls take a thread; the instances boot while the loop waits.
+        """
+        server = await self.call(PopupServer.PopupServer, self.conn, args, detach=True)
+        ready = await self.wait_for_state(server.instance_ids, u'running')
+        await self.call(server.running, ready)
+        if provision_hosts and not server.baked:
+            await self.call(provision.provision, [(i.public_dns_name, server.keyfile) for i in server.instances],
+                args.playbooks, forks=getattr(args, 'forks', provision.FORKS))
+        return server
+
+    async def inventory(self, owner, client=None, popup_id=None, refresh=False):
+        """discovery.Popup records from the local index, as `popup inventory`"""
+        popups = index.Index()
+        try:
+            return await self.call(popups.lookup, self.conn, owner, client=client, popup_id=popup_id, refresh=refresh)
+        finally:
+            await self.call(popups.wait)
+
+    async def stop(self, owner, client=None, popup_id=None, force=False, wait=False):
+        """Stops the matching on-demand popups. Returns their instance ids"""
+        popups = await self.call(lambda: list(discovery.find_popups(self.conn, owner, client=client, popup_id=popup_id)))
+        instance_ids = [p.id for p in popups if not p.spot_request]
+        if not instance_ids:
+            return []
+        await self.ec2('stop_instances', instance_ids=instance_ids, force=force)
+        state = u'stopping'
+        if wait:
+            await self.wait_for_state(instance_ids, u'stopped')
+            state = u'stopped'
+        await self.call(index.Index().set_state, instance_ids, state)
+        return instance_ids
+
+    async def destroy(self, args):
+        """As `popup destroy`; returns a list of (resource, error).
+        Each popup group is cleaned up as soon as its instances have terminated, while the loop waits for the rest.
+        """
+        if getattr(args, 'dry_run', False):
+            return await self.call(popup.destroy_popup, self.conn, args)
+        popups = await self.call(popup._gather_instances, self.conn, args)
+        spot_requests = await self.call(popup._gather_spot_requests, self.conn, args)
+        spot_requests = sorted(set(spot_requests + [p.spot_request for p in popups if p.spot_request]))
+        failures = []
+        if spot_requests:
+            try:
+                await self.ec2('cancel_spot_instance_requests', spot_requests)
+            except Exception as e:
+                failures.append(('spot requests %s' % ', '.join(spot_requests), e))
+        if not popups:
+            return failures
+        groups = popup._popup_groups(popups)
+        instance_ids = [p.id for p in popups]
+        await self.ec2('terminate_instances', instance_ids=instance_ids)
+        cleanups = {}
+        def tick(pending):
+            for tag, group in groups.items():
+                if tag not in cleanups and not group['ids'] & pending:
+                    cleanups[tag] = asyncio.ensure_future(self.call(popup._cleanup_popup, self.conn, args.iam, tag,
+                        group['manifests'], group['hostnames'], group['key_name'], group['group_name']))
+        try:
+            await self.wait_for_state(instance_ids, u'terminated', tick=tick)
+        except waiter.WaitTimeout as e:
+            failures.extend(('instance %s' % id, e) for id in e.pending)
+        tags = list(cleanups)
+        results = dict(zip(tags, await asyncio.gather(*[cleanups[tag] for tag in tags])))
+        return await self.call(popup._finish_destroy, self.conn, args, groups, results, failures)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+async def run(args):
+    """One CLI command, with the connection and the command itself on the executor"""
+    conn = scheduler.Scheduler(backend.connect(args.backend)) if getattr(args, 'aws', True) else None
+    controller = Controller(conn, getattr(args, 'workers', None) or LIMIT)
+    try:
+        if args.func is popup.destroy_popup:
+            return await controller.destroy(args)
+        if args.func is popup.create_popup and not (getattr(args, 'from_pool', False) or
+                getattr(args, 'detach', False) or getattr(args, 'vpn_users', 0)):
+            server = await controller.create(args)
+            for connection_string in server.connection_strings:
+                print(connection_string)
+            return server
+        return await controller.call(args.func, conn, args)
+    finally:
+        controller.close()
+
+
+def main():
+    asyncio.run(run(popup.get_parser().parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,29 +11,69 @@
 
 """
 SSH Client configuration per popup server
+Every host gets a persistent ControlMaster connection so ansible pays for the
+SSH handshake once per host rather than once per task.
 """
 
 import os
 
 
-def set_env(hostname, configfile):
-    os.environ['ANSIBLE_HOST'] = hostname
-    os.environ['ANSIBLE_TRANSPORT'] = 'ssh'
-    os.environ['ANSIBLE_SSH_ARGS'] = '-F %s' % configfile
+# How long an idle master connection stays up
+CONTROL_PERSIST = '10m'
+
+
+def _config_dir():
+    return '%s/.popup/config' % os.path.expanduser('~')
+
+
+def ssh_config_path(hostname):
+    return '%s/ssh_configs/%s' % (_config_dir(), hostname)
+
+
+def host_config(hostname, keyfile):
+    """The ssh_config stanza for one popup"""
+    return '\n'.join([
+        'Host %s' % hostname,
+        '\tIdentityFile %s' % keyfile,
+        '\tUser ubuntu',
+        '\tSendEnv LANG LC_* GIT_*',
+        '\tHashKnownHosts yes',
+        '\tGSSAPIAuthentication yes',
+        '\tGSSAPIDelegateCredentials no',
+        # Popups are brand new hosts with brand new keys
+        '\tStrictHostKeyChecking no',
+        '\tUserKnownHostsFile %s/known_hosts' % _config_dir(),
+        '\tControlMaster auto',
+        '\tControlPath %s/ssh_control/%%r@%%h:%%p' % _config_dir(),
+        '\tControlPersist %s' % CONTROL_PERSIST,
+        '\tForwardAgent yes',
+        '',
+    ])
 
 
 def ssh_config(hostname, keyfile):
-    configfile = './config/ssh_config/%s' % hostname
-    with open(CFG, 'w') as f:
-        f.write('SendEnv LANG LC_* GIT_*')
-        f.write('HashKnownHosts yes')
-        f.write('GSSAPIAuthentication yes')
-        f.write('GSSAPIDelegateCredentials no')
-        f.write('\n')
-        f.write('Host ' % hostname)
-        f.write('\tIdentityFile ' % keyfile)
-        f.write('\tUser ubuntu')
-        f.write('\tControlMaster auto')
-        f.write('\tControlPath ssh_control/%r@h:@p')
-        f.write('\tForwardAgent yes')
-    set_env(hostname, configfile)
+    """Write ~/.popup/config/ssh_configs/<hostname> and return its path"""
+    configfile = ssh_config_path(hostname)
+    with open(configfile, 'w') as f:
+        f.write(host_config(hostname, keyfile))
+    return configfile
+
+
+def fleet_config(targets, configfile):
+    """Write a single ssh_config covering every (hostname, keyfile) in targets"""
+    with open(configfile, 'w') as f:
+        for hostname, keyfile in targets:
+            f.write(host_config(hostname, keyfile))
+            f.write('\n')
+    return configfile
+
+
+def environment(configfile):
+    """os.environ plus the ansible settings for a run using configfile.
+    Pass it to the ansible subprocess; nothing here touches os.environ itself.
+    """
+    env = dict(os.environ)
+    env['ANSIBLE_TRANSPORT'] = 'ssh'
+    env['ANSIBLE_SSH_ARGS'] = '-F %s' % configfile
+    env['ANSIBLE_HOST_KEY_CHECKING'] = 'False'
+    return env
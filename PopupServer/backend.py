@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Cloud backends popup can drive. A backend is anything with the subset of boto's
+EC2Connection interface listed in OPERATIONS; "ec2" is boto itself and "sim" is
+the in-memory fake_ec2.FakeEC2Connection for tests and load benchmarks.
+"""
+
+import os
+
+
+# TagSpecification on RunInstances needs at least this API version; boto 2 defaults to an older one
+API_VERSION = '2016-11-15'
+
+# Everything PopupServer, popup and their helpers call on a connection
+OPERATIONS = [
+    # images
+    'get_all_images', 'create_image', 'deregister_image',
+    # key pairs
+    'create_key_pair', 'delete_key_pair', 'get_all_key_pairs',
+    # security groups; get_status carries the batched AuthorizeSecurityGroupIngress
+    'create_security_group', 'delete_security_group', 'get_all_security_groups', 'get_status',
+    # instances; get_object carries RunInstances with TagSpecification
+    'run_instances', 'get_object', 'start_instances', 'stop_instances', 'terminate_instances',
+    'get_all_instances', 'get_all_reservations',
+    # tags
+    'create_tags', 'delete_tags',
+    # spot; get_list carries RequestSpotInstances with a ClientToken
+    'get_spot_price_history', 'request_spot_instances', 'get_list', 'get_all_spot_instance_requests',
+    'cancel_spot_instance_requests',
+]
+
+
+def _ec2(**options):
+    # Fail early, and before importing boto, when there are no credentials
+    os.environ['AWS_ACCESS_KEY_ID']
+    os.environ['AWS_SECRET_ACCESS_KEY']
+    from boto.ec2.connection import EC2Connection
+    options.setdefault('api_version', API_VERSION)
+    return EC2Connection(**options)
+
+
+def _sim(**options):
+    from .fake_ec2 import FakeEC2Connection
+    return FakeEC2Connection(**options)
+
+
+BACKENDS = {'ec2': _ec2, 'sim': _sim}
+
+
+def connect(name='ec2', **options):
+    """A new connection to the named backend; options go to its constructor"""
+    try:
+        factory = BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown backend %s, expected one of %s" % (name, ', '.join(sorted(BACKENDS))))
+    return factory(**options)
+
+
+def _reservation_class():
+    try:
+        from boto.ec2.instance import Reservation
+    except ImportError:
+        # Only the sim, which doesn't need it, gets here without boto
+        return None
+    return Reservation
+
+
+def _spot_request_class():
+    try:
+        from boto.ec2.spotinstancerequest import SpotInstanceRequest
+    except ImportError:
+        return None
+    return SpotInstanceRequest
+
+
+def run_instances(conn, image_id, count, key_name, security_groups, instance_type, tags, client_token=None):
+    """RunInstances with tags applied as the instances are created, so there's never an untagged one.
+    boto 2's run_instances can't send TagSpecification, so the request is made by hand
+    the way shared.authorize_all is. Repeating a request with the same client_token returns
+    the original reservation instead of launching again. Returns the reservation.
+    """
+    params = {'ImageId': image_id, 'MinCount': count, 'MaxCount': count, 'KeyName': key_name, 'InstanceType': instance_type}
+    if client_token:
+        params['ClientToken'] = client_token
+    for n, name in enumerate(security_groups, 1):
+        params['SecurityGroup.%d' % n] = name
+    if tags:
+        params['TagSpecification.1.ResourceType'] = 'instance'
+        for n, (key, value) in enumerate(sorted(tags.items()), 1):
+            params['TagSpecification.1.Tag.%d.Key' % n] = key
+            params['TagSpecification.1.Tag.%d.Value' % n] = value
+    return conn.get_object('RunInstances', params, _reservation_class(), verb='POST')
+
+
+def request_spot_instances(conn, price, image_id, count, key_name, security_groups, instance_type, client_token=None):
+    """RequestSpotInstances, made by hand like run_instances since boto 2's request_spot_instances
+    can't send a ClientToken. Returns the spot requests.
+    """
+    spec = 'LaunchSpecification'
+    params = {'SpotPrice': price, 'InstanceCount': count, 'Type': 'one-time', '%s.ImageId' % spec: image_id,
+        '%s.KeyName' % spec: key_name, '%s.InstanceType' % spec: instance_type}
+    if client_token:
+        params['ClientToken'] = client_token
+    for n, name in enumerate(security_groups, 1):
+        params['%s.SecurityGroup.%d' % (spec, n)] = name
+    return conn.get_list('RequestSpotInstances', params, [('item', _spot_request_class())], verb='POST')
+
+
+def missing_operations(conn):
+    """The OPERATIONS conn doesn't implement"""
+    return [op for op in OPERATIONS if not callable(getattr(conn, op, None))]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Pre-baked AMIs. A baked image is a stock AMI with a set of playbooks already applied,
+tagged with a digest of the base AMI and the playbook contents so create can find it again.
+"""
+
+import hashlib
+import os
+import time
+
+
+_ROOT = os.path.abspath(os.path.dirname(__file__))
+PLAYBOOK_DIR = os.path.join(_ROOT, 'playbooks')
+
+# Playbook names, one per line, written by setup.py's build_py
+PLAYBOOK_MANIFEST = os.path.join(PLAYBOOK_DIR, 'MANIFEST')
+
+# Both images are 64-bit ubuntu 12.10 in us-east-1
+STOCK_IMAGES = {
+    'micro': ('t1.micro', 'ami-7539b41c'),
+    'small': ('m1.small', 'ami-9b3db0f2'),
+}
+
+DIGEST_TAG = 'popup_bake'
+
+
+def available_playbooks():
+    """Names of the bundled playbooks, from the install-time manifest if there is one"""
+    try:
+        with open(PLAYBOOK_MANIFEST) as f:
+            return [line.strip() for line in f if line.strip()]
+    except (IOError, OSError):
+        # Running from a checkout
+        return sorted(name for name in os.listdir(PLAYBOOK_DIR) if os.path.isdir(os.path.join(PLAYBOOK_DIR, name)))
+
+
+def playbook_digest(base_ami, playbooks):
+    """sha1 over the base AMI and every file of the selected playbooks, in a stable order"""
+    digest = hashlib.sha1(base_ami.encode('utf-8'))
+    for name in sorted(set(playbooks)):
+        digest.update(name.encode('utf-8'))
+        for root, dirs, files in sorted(os.walk(os.path.join(PLAYBOOK_DIR, name))):
+            dirs.sort()
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                digest.update(os.path.relpath(path, PLAYBOOK_DIR).encode('utf-8'))
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()
+
+
+def image_name(digest, now=None):
+    """AMI names must be unique, and bake --force registers the replacement before retiring the old image"""
+    now = time.time() if now is None else now
+    return 'popup-%s-%d' % (digest[:16], now * 1000)
+
+
+def find_baked_image(conn, base_ami, playbooks):
+    """Returns the id of an available baked image for these playbooks, or None"""
+    digest = playbook_digest(base_ami, playbooks)
+    images = conn.get_all_images(owners=['self'], filters={'tag:%s' % DIGEST_TAG: digest, 'state': 'available'})
+    return images[0].id if images else None
+
+
+def choose_image(conn, size, playbooks, stock=False):
+    """Returns (instance type, AMI id, baked) for a popup of this size.
+    The baked image matching playbooks wins unless stock is set or there isn't one.
+    """
+    instance_type, base_ami = STOCK_IMAGES[size]
+    if not stock and playbooks:
+        baked = find_baked_image(conn, base_ami, playbooks)
+        if baked:
+            return (instance_type, baked, True)
+    return (instance_type, base_ami, False)
+
+
+def create_baked_image(conn, instance_id, base_ami, playbooks):
+    """Snapshot a provisioned instance. Returns the new (still pending) image id"""
+    digest = playbook_digest(base_ami, playbooks)
+    image_id = conn.create_image(instance_id, image_name(digest),
+        description="Popup %s with %s" % (base_ami, ', '.join(sorted(playbooks))))
+    conn.create_tags([image_id], {DIGEST_TAG: digest, 'base_ami': base_ami, 'playbooks': ','.join(sorted(playbooks))})
+    return image_id
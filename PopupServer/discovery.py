@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Find popup instances without scanning the whole account.
+Owner, client, popup_id and state are sent to EC2 as filters and results are
+paged through lazily.
+"""
+
+import os
+
+from collections import namedtuple
+
+
+# Everything but terminated
+LIVE_STATES = [u'pending', u'running', u'shutting-down', u'stopping', u'stopped']
+
+PAGE_SIZE = 100
+
+
+# States of spot requests that may still launch (or are running) an instance
+LIVE_SPOT_STATES = [u'open', u'active']
+
+# Warm pool members (see pool.py) are tagged pool=standby, or pool=claimed-<token>
+# while being claimed. They aren't anyone's popup until the claim is done.
+POOL_TAG = 'pool'
+POOL_STANDBY = 'standby'
+
+
+def is_pool_member(tags):
+    value = tags.get(POOL_TAG) or ''
+    return value == POOL_STANDBY or value.startswith('claimed-')
+
+
+class Popup(namedtuple('Popup', 'id popup_id owner client start_date public_dns_name state launch_time tags spot_request key_name security_group instance_type')):
+    """One popup instance, as seen by EC2. spot_request is None for on-demand instances"""
+    __slots__ = ()
+
+    @classmethod
+    def from_instance(cls, instance):
+        tags = dict(instance.tags)
+        groups = [getattr(g, 'name', g) for g in getattr(instance, 'groups', None) or []]
+        return cls(instance.id, tags.get('popup_id'), tags.get('owner'), tags.get('client'), tags.get('start_date'),
+            instance.public_dns_name, instance.state, instance.launch_time, tags,
+            getattr(instance, 'spot_instance_request_id', None), getattr(instance, 'key_name', None),
+            groups[0] if groups else None, getattr(instance, 'instance_type', None))
+
+    @property
+    def name(self):
+        """Name of the popup's own key pair and security group, unless they're shared"""
+        return "popup-%s-%s" % (self.owner, self.popup_id)
+
+    @property
+    def keyfile(self):
+        """Where create saved the private key"""
+        return '%s/.popup/keys/%s.pem' % (os.path.expanduser('~'), self.key_name or self.name)
+
+    @property
+    def manifest(self):
+        return "%s-%s-%s" % (self.start_date, self.public_dns_name, self.popup_id)
+
+
+def popup_filters(owner, client=None, popup_id=None, states=LIVE_STATES, tags=None, tag_keys=None, instance_ids=None):
+    """tags is an optional dict of extra tag filters, tag_keys tags that must be present with any value"""
+    filters = dict(('tag:%s' % k, v) for k, v in (tags or {}).items())
+    if tag_keys:
+        filters['tag-key'] = list(tag_keys)
+    if instance_ids:
+        filters['instance-id'] = list(instance_ids)
+    filters['tag:owner'] = owner
+    if client:
+        filters['tag:client'] = client
+    if popup_id:
+        filters['tag:popup_id'] = popup_id
+    if states:
+        filters['instance-state-name'] = list(states)
+    return filters
+
+
+def find_popups(conn, owner, client=None, popup_id=None, states=LIVE_STATES, tags=None, page_size=PAGE_SIZE,
+        tag_keys=None, instance_ids=None, pool=False):
+    """Yields a Popup for every matching instance, one page of results at a time.
+    Pool members are left out unless pool is set or tags asks for them by POOL_TAG.
+    """
+    pool = pool or POOL_TAG in (tags or {})
+    filters = popup_filters(owner, client, popup_id, states, tags, tag_keys, instance_ids)
+    next_token = None
+    while True:
+        reservations = conn.get_all_reservations(filters=filters, max_results=page_size, next_token=next_token)
+        for reservation in reservations:
+            for instance in reservation.instances:
+                # Popups predating the popup_id tag aren't ours to manage
+                if 'popup_id' in instance.tags and (pool or not is_pool_member(instance.tags)):
+                    yield Popup.from_instance(instance)
+        next_token = getattr(reservations, 'next_token', None)
+        if not next_token:
+            return
+
+
+def find_spot_requests(conn, owner, client=None, popup_id=None, states=LIVE_SPOT_STATES):
+    """Returns the ids of matching spot requests, including ones that never launched anything"""
+    filters = popup_filters(owner, client, popup_id, None)
+    if states:
+        filters['state'] = list(states)
+    return [r.id for r in conn.get_all_spot_instance_requests(filters=filters)]
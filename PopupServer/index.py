@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Local index of popups in ~/.popup/index.db (SQLite)
+Rows are written as popups are created, stopped and destroyed. Once an owner's
+rows are older than TTL seconds they are reconciled against EC2 in a background
+thread while the cached answer is returned.
+"""
+
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+from . import discovery
+
+
+# Seconds before an owner's entries are reconciled with EC2
+TTL = 300
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS popups (
+    id TEXT PRIMARY KEY,
+    popup_id TEXT,
+    owner TEXT,
+    client TEXT,
+    start_date TEXT,
+    public_dns_name TEXT,
+    state TEXT,
+    launch_time TEXT,
+    key_path TEXT,
+    spot_request TEXT,
+    key_name TEXT,
+    security_group TEXT,
+    instance_type TEXT
+);
+CREATE INDEX IF NOT EXISTS popups_owner ON popups (owner, client, popup_id);
+CREATE TABLE IF NOT EXISTS syncs (
+    owner TEXT PRIMARY KEY,
+    synced_at REAL
+);
+"""
+
+# Columns added since the first release, for indexes created before them
+_MIGRATIONS = [('spot_request', "ALTER TABLE popups ADD COLUMN spot_request TEXT"),
+    ('key_name', "ALTER TABLE popups ADD COLUMN key_name TEXT"),
+    ('security_group', "ALTER TABLE popups ADD COLUMN security_group TEXT"),
+    ('instance_type', "ALTER TABLE popups ADD COLUMN instance_type TEXT")]
+
+_COLUMNS = ['id', 'popup_id', 'owner', 'client', 'start_date', 'public_dns_name', 'state', 'launch_time', 'spot_request',
+    'key_name', 'security_group', 'instance_type', 'key_path']
+
+
+class Index(object):
+    def __init__(self, path=None):
+        self.path = path or '%s/.popup/index.db' % os.path.expanduser('~')
+        self._sync_lock = threading.Lock()
+        self._reconciler = None
+        with self._transaction() as db:
+            db.executescript(_SCHEMA)
+            columns = set(row['name'] for row in db.execute("PRAGMA table_info(popups)"))
+            for column, statement in _MIGRATIONS:
+                if column not in columns:
+                    db.execute(statement)
+
+    def _connect(self):
+        # One connection per call; sqlite3 connections can't cross threads
+        import sqlite3
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connect()
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def record(self, popups, key_path=None):
+        """Insert or refresh the entries for a sequence of discovery.Popup"""
+        with self._transaction() as db:
+            self._insert(db, popups, key_path)
+
+    def _insert(self, db, popups, key_path=None):
+        # Pool members aren't listed until they're claimed
+        popups = [p for p in popups if not discovery.is_pool_member(p.tags)]
+        rows = [tuple(getattr(p, c) for c in _COLUMNS[:-1]) + (key_path or p.keyfile,) for p in popups]
+        db.executemany("INSERT OR REPLACE INTO popups (%s) VALUES (%s)" % (', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))), rows)
+
+    def set_state(self, instance_ids, state):
+        with self._transaction() as db:
+            db.executemany("UPDATE popups SET state = ? WHERE id = ?", [(state, id) for id in instance_ids])
+
+    def forget(self, instance_ids):
+        with self._transaction() as db:
+            db.executemany("DELETE FROM popups WHERE id = ?", [(id,) for id in instance_ids])
+
+    def find(self, owner, client=None, popup_id=None):
+        """Returns the cached discovery.Popup records for owner"""
+        query = "SELECT * FROM popups WHERE owner = ?"
+        params = [owner]
+        if client:
+            query += " AND client = ?"
+            params.append(client)
+        if popup_id:
+            query += " AND popup_id = ?"
+            params.append(popup_id)
+        with self._transaction() as db:
+            rows = db.execute(query + " ORDER BY start_date, popup_id, id", params).fetchall()
+        return [self._popup(row) for row in rows]
+
+    def _popup(self, row):
+        tags = dict((t, row[t]) for t in ['popup_id', 'owner', 'client', 'start_date'] if row[t] is not None)
+        return discovery.Popup(row['id'], row['popup_id'], row['owner'], row['client'], row['start_date'],
+            row['public_dns_name'], row['state'], row['launch_time'], tags, row['spot_request'], row['key_name'],
+            row['security_group'], row['instance_type'])
+
+    def synced_at(self, owner):
+        with self._transaction() as db:
+            row = db.execute("SELECT synced_at FROM syncs WHERE owner = ?", (owner,)).fetchone()
+        return row['synced_at'] if row else None
+
+    def is_stale(self, owner, ttl=None):
+        synced = self.synced_at(owner)
+        return synced is None or time.time() - synced > (TTL if ttl is None else ttl)
+
+    def sync(self, conn, owner):
+        """Replace owner's entries with what EC2 has right now"""
+        with self._sync_lock:
+            began = time.time()
+            popups = list(discovery.find_popups(conn, owner))
+            with self._transaction() as db:
+                db.execute("DELETE FROM popups WHERE owner = ?", (owner,))
+                self._insert(db, popups)
+                db.execute("INSERT OR REPLACE INTO syncs (owner, synced_at) VALUES (?, ?)", (owner, began))
+            return popups
+
+    def stream(self, conn, owner, client=None, popup_id=None):
+        """Like sync, but yields each popup as soon as its page of results arrives.
+        Only an unfiltered stream replaces owner's entries; a filtered one refreshes the ones it saw.
+        """
+        began = time.time()
+        popups = []
+        for popup in discovery.find_popups(conn, owner, client, popup_id):
+            popups.append(popup)
+            yield popup
+        with self._sync_lock:
+            with self._transaction() as db:
+                if client or popup_id:
+                    self._insert(db, popups)
+                    return
+                db.execute("DELETE FROM popups WHERE owner = ?", (owner,))
+                self._insert(db, popups)
+                db.execute("INSERT OR REPLACE INTO syncs (owner, synced_at) VALUES (?, ?)", (owner, began))
+
+    def lookup(self, conn, owner, client=None, popup_id=None, refresh=False, ttl=None):
+        """Answer from the index.
+        refresh forces a synchronous sync first, as does an owner that has never been synced.
+        Otherwise stale entries are returned as-is while a reconcile runs in the background;
+        the thread isn't a daemon so it finishes before the process exits.
+        """
+        if refresh or self.synced_at(owner) is None:
+            self.sync(conn, owner)
+        elif self.is_stale(owner, ttl) and self._reconciler is None:
+            self._reconciler = threading.Thread(target=self.sync, args=(conn, owner))
+            self._reconciler.start()
+        return self.find(owner, client, popup_id)
+
+    def wait(self):
+        """Block until a background reconcile, if any, is done"""
+        if self._reconciler is not None:
+            self._reconciler.join()
+            self._reconciler = None
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Operation journals in ~/.popup/operations/<op>.json, one per create.
+Each completed step is appended (and the file atomically rewritten) as soon as
+it's done, so a create that was killed, or detached, can be resumed from the
+last completed step or rolled back by `popup resume`.
+"""
+
+import base64
+import errno
+import json
+import os
+import threading
+import time
+
+
+RUNNING = 'running'
+DETACHED = 'detached'
+DONE = 'done'
+FAILED = 'failed'
+ROLLED_BACK = 'rolled-back'
+
+
+class Unresumable(Exception):
+    """An interrupted step can't be picked up again; the operation can only be rolled back"""
+
+
+def operations_dir():
+    return '%s/.popup/operations' % os.path.expanduser('~')
+
+
+def _path(op):
+    return os.path.join(operations_dir(), '%s.json' % op)
+
+
+def new_op():
+    return base64.urlsafe_b64encode(os.urandom(6)).decode('ascii')
+
+
+def pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Journal(object):
+    def __init__(self, data):
+        self.data = data
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, op, command, args):
+        """A new journal for op; args is the command's argparse.Namespace"""
+        saved = dict((k, v) for k, v in vars(args).items() if isinstance(v, (str, int, float, bool, list, dict, type(None))))
+        now = time.time()
+        journal = cls({'op': op, 'command': command, 'args': saved, 'state': RUNNING, 'pid': os.getpid(),
+            'created': now, 'updated': now, 'steps': []})
+        journal._write()
+        return journal
+
+    @classmethod
+    def load(cls, op):
+        with open(_path(op)) as f:
+            return cls(json.load(f))
+
+    @property
+    def op(self):
+        return self.data['op']
+
+    @property
+    def state(self):
+        """The recorded state, or 'interrupted' for a running one whose process is gone"""
+        state = self.data['state']
+        if state == RUNNING and not pid_alive(self.data.get('pid')):
+            return 'interrupted'
+        return state
+
+    @property
+    def steps(self):
+        return [step for step, _, _ in self.data['steps']]
+
+    def done(self, step):
+        """The data recorded with step, or None if it hasn't completed"""
+        for name, data, _ in self.data['steps']:
+            if name == step:
+                return data
+        return None
+
+    def record(self, step, **data):
+        with self.lock:
+            self.data['steps'].append([step, data, time.time()])
+            self._write()
+
+    def set_state(self, state, pid=None):
+        with self.lock:
+            self.data['state'] = state
+            if pid is not None:
+                self.data['pid'] = pid
+            self._write()
+
+    def _write(self):
+        self.data['updated'] = time.time()
+        if not os.path.isdir(operations_dir()):
+            os.makedirs(operations_dir())
+        path = _path(self.op)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+
+def operations():
+    """Every journal, oldest first"""
+    if not os.path.isdir(operations_dir()):
+        return []
+    journals = [Journal.load(name[:-len('.json')]) for name in os.listdir(operations_dir()) if name.endswith('.json')]
+    return sorted(journals, key=lambda j: j.data['created'])
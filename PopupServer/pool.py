@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Warm standby pool: provisioned popups kept in the stopped state, tagged pool=standby.
+Claiming one retags it for the caller and starts it, which takes seconds instead of
+a launch plus provisioning.
+"""
+
+import argparse
+import base64
+import os
+import time
+
+from datetime import datetime
+
+from . import PopupServer, discovery, index, provision, reaper, waiter
+
+
+POOL_TAG = discovery.POOL_TAG
+SPEC_TAG = 'pool_spec'
+STANDBY = discovery.POOL_STANDBY
+
+# Seconds between tagging a member as ours and checking nobody else did the same
+CLAIM_SETTLE = 1.0
+
+
+def spec(size, playbooks):
+    """Pool members are interchangeable only if they have the same size and playbooks"""
+    return '%s:%s' % (size, ','.join(sorted(playbooks)))
+
+
+def standby(conn, owner, size, playbooks, states=(u'stopped',)):
+    """Popup records for the pool members matching size and playbooks"""
+    return list(discovery.find_popups(conn, owner, states=list(states),
+        tags={POOL_TAG: STANDBY, SPEC_TAG: spec(size, playbooks)}))
+
+
+def fill(conn, args, count):
+    """Top the pool up to count members. Returns the ids of the new members"""
+    members = standby(conn, args.iam, args.size, args.playbooks, states=(u'pending', u'running', u'stopping', u'stopped'))
+    missing = count - len(members)
+    if missing <= 0:
+        return []
+    # Members share a security group and keypair so claiming one never strands the others
+    builder = argparse.Namespace(iam=args.iam, size=args.size, client=None, playbooks=args.playbooks, count=missing,
+        workers=args.workers, share='owner', share_key=True, stock=False,
+        tags={POOL_TAG: STANDBY, SPEC_TAG: spec(args.size, args.playbooks)})
+    server = PopupServer.PopupServer(conn, builder)
+    if args.playbooks and not server.baked:
+        provision.provision([(i.public_dns_name, server.keyfile) for i in server.instances], args.playbooks, forks=args.forks)
+    ids = [i.id for i in server.instances]
+    conn.stop_instances(instance_ids=ids)
+    waiter.wait_for_state(conn, ids, u'stopped')
+    index.Index().set_state(ids, u'stopped')
+    return ids
+
+
+def _pool_tag(conn, member):
+    current = [i for r in conn.get_all_instances(instance_ids=[member.id]) for i in r.instances]
+    return current[0].tags.get(POOL_TAG) if current else None
+
+
+def _try_claim(conn, member):
+    """Tag member as ours if it's still on standby, then check nobody else did the same"""
+    # The standby list may be stale; tagging a member someone else has claimed would take it from them
+    if _pool_tag(conn, member) != STANDBY:
+        return False
+    token = 'claimed-%s' % base64.urlsafe_b64encode(os.urandom(6)).decode('ascii')
+    conn.create_tags([member.id], {POOL_TAG: token})
+    time.sleep(CLAIM_SETTLE)
+    return _pool_tag(conn, member) == token
+
+
+def claim(conn, args, count=1):
+    """Take up to count stopped members out of the pool, retag them for args.iam/args.client and start them.
+    Returns (instances, keyfiles) for the ones that were claimed, possibly none.
+    """
+    claimed = []
+    for member in standby(conn, args.iam, args.size, args.playbooks):
+        if len(claimed) == count:
+            break
+        if _try_claim(conn, member):
+            claimed.append(member)
+    if not claimed:
+        return ([], [])
+
+    ids = [m.id for m in claimed]
+    tags = {'owner': args.iam, 'start_date': str(datetime.date(datetime.now())).replace('-', ''),
+        'popup_id': base64.urlsafe_b64encode(os.urandom(6)).decode('ascii')}
+    if args.client:
+        tags['client'] = args.client
+    # Standby members don't expire; the clock starts when they're claimed
+    expires = reaper.expires_tag(getattr(args, 'lifetime', None))
+    if expires:
+        tags[reaper.EXPIRES_TAG] = expires
+    conn.create_tags(ids, tags)
+    conn.delete_tags(ids, [POOL_TAG, SPEC_TAG])
+    conn.start_instances(instance_ids=ids)
+    ready = waiter.wait_for_state(conn, ids, u'running')
+    instances = [ready[id] for id in ids]
+
+    home = os.path.expanduser('~')
+    popups = [discovery.Popup.from_instance(i) for i in instances]
+    keyfiles = ['%s/.popup/keys/%s.pem' % (home, p.key_name) for p in popups]
+    index.Index().record(popups)
+    for popup, keyfile in zip(popups, keyfiles):
+        # Manifest files serve as a poor inventory system and a backup location for the server's SSH key
+        with open(keyfile) as key, open('%s/.popup/manifests/%s' % (home, popup.manifest), 'w') as f:
+            f.write(key.read())
+            os.chmod(f.name, 0o600)
+    return (instances, keyfiles)
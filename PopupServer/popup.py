@@ -14,148 +14,588 @@
 Command-line tool for managing popup servers
 """
 
-import pdb
+from __future__ import absolute_import
+
 import argparse
+import glob
 import os
 import os.path
+import shutil
+import subprocess
 import sys
+import threading
 import time
 
-import boto
-import boto.ec2
-
-from datetime import datetime
-
-from boto.ec2.connection import EC2Connection
-
-import PopupServer
+# boto, multiprocessing and sqlite3 are imported where they're used so that
+# --help, --version and license don't pay for them
+from PopupServer import PopupServer, backend, bake, discovery, index, journal, pool, provision, reaper, records, scheduler, shared, trace, vpn, waiter
 
 
+@trace.traced('gather')
 def _gather_instances(conn, args):
     """Try and locate popup EC2 instances. The three options are by: userid, "client" (which is really an arbitrary string),
     tag (which is a short random string associated with a specific popup
 
-    Returns a list of EC2 instance ids, unique tags, and (if applicable) the manifest files
+    Returns a list of discovery.Popup records for the live (not terminated) matches
     """
-    reservations = conn.get_all_instances()
-    instances = [ i for r in reservations for i in r.instances ]
-    stop_these = []
-    unique_tags = []
-    manifests = []
-    for instance in instances:
-        try:
-            if instance.tags['owner'] == args.iam:
-                if args.all:
-                    stop_these.append(instance.id)
-                    unique_tags.append(instance.tags['popup_id'])
-                    manifests.append("%s-%s-%s" % (instance.tags['start_date'], instance.public_dns_name, instance.tags['popup_id']))
-                    continue
-                if args.client:
-                    try:
-                        if instance.tags['client'] == args.client:
-                            stop_these.append(instance.id)
-                            unique_tags.append(instance.tags['popup_id'])
-                            continue
-                    except KeyError:
-                        continue
-                if args.tag:
-                    if instance.tags['popup_id'] == args.tag:
-                        stop_these.append(instance.id)
-                        unique_tags.append(instance.tags['popup_id'])
-        except KeyError:
-            continue
-    return (stop_these, unique_tags, manifests)
+    if getattr(args, 'pool', False):
+        return list(discovery.find_popups(conn, args.iam, tags={pool.POOL_TAG: pool.STANDBY}))
+    if args.all:
+        return list(discovery.find_popups(conn, args.iam))
+    if args.client:
+        return list(discovery.find_popups(conn, args.iam, client=args.client))
+    if args.tag:
+        return list(discovery.find_popups(conn, args.iam, popup_id=args.tag))
+    return []
+
+
+def _gather_spot_requests(conn, args):
+    """Spot request ids for the same selection as _gather_instances"""
+    if getattr(args, 'pool', False):
+        return []
+    if args.all:
+        return discovery.find_spot_requests(conn, args.iam)
+    if args.client:
+        return discovery.find_spot_requests(conn, args.iam, client=args.client)
+    if args.tag:
+        return discovery.find_spot_requests(conn, args.iam, popup_id=args.tag)
+    return []
+
+
+def _spawn_refill(args, count):
+    """Run `popup pool fill` in the background so the caller doesn't wait on the replacement"""
+    log = open('%s/.popup/pool.log' % os.path.expanduser('~'), 'a')
+    subprocess.Popen([sys.executable, '-m', 'PopupServer.popup', '-i', args.iam, 'pool', 'fill', '-n', str(count),
+        '-s', args.size, '-p'] + list(args.playbooks), stdout=log, stderr=subprocess.STDOUT, close_fds=True)
 
 
 def create_popup(conn, args):
-    print("Creating EC2 instance...")
-    server = PopupServer.PopupServer(conn, args)
-    print(server.connection_string)
+    count = args.count
+    if getattr(args, 'from_pool', False):
+        print("Claiming from the pool...")
+        target = len(pool.standby(conn, args.iam, args.size, args.playbooks))
+        instances, keyfiles = pool.claim(conn, args, count)
+        for instance, keyfile in zip(instances, keyfiles):
+            print("ssh -i %s ubuntu@%s" % (keyfile, instance.public_dns_name))
+        if instances and args.refill:
+            _spawn_refill(args, target)
+        count -= len(instances)
+        if not count:
+            return
+        print("...pool had %d, launching %d more" % (len(instances), count))
+        args.count = count
+    ops = journal.Journal.create(journal.new_op(), 'create', args)
+    print("Creating EC2 instance... (operation %s)" % ops.op)
+    detach = getattr(args, 'detach', False)
+    prepared = None
+    if getattr(args, 'vpn_users', 0) and not detach:
+        # DH parameters and the CA are cached; the first time they're generated while the instances boot
+        prepared = threading.Thread(target=vpn.prepare, args=(args.iam,))
+        prepared.start()
+    try:
+        server = PopupServer.PopupServer(conn, args, journal=ops, detach=detach)
+    except BaseException:
+        ops.set_state(journal.FAILED)
+        raise
+    if detach:
+        # Set before the resume starts writing to the same journal
+        ops.set_state(journal.DETACHED)
+        _spawn_resume(args, ops.op)
+        print("...launched %s, finishing in the background" % ', '.join(server.instance_ids))
+        print("popup status %s" % ops.op)
+        return server
+    _finish_create(server, args, ops, prepared)
+    return server
+
+
+def _finish_create(server, args, ops, prepared=None):
+    """Provision (unless baked or already done), issue --vpn-users profiles and mark the operation done.
+    VPN server artifacts go up in the same ansible run as the playbooks while client certificates are issued.
+    """
+    names = [] if server.baked else list(args.playbooks or [])
+    playbooks = list(names)
+    vpn_users = getattr(args, 'vpn_users', 0)
+    extra_vars = None
+    profiles = None
+    if vpn_users:
+        if prepared is not None:
+            prepared.join()
+        extra_vars = {'vpn_dir': vpn.server_artifacts(args.iam, server.unique_tag)}
+        playbooks.append(vpn.UPLOAD_PLAYBOOK)
+        names.append('vpn')
+        from multiprocessing.pool import ThreadPool
+        issuer = ThreadPool(1)
+        profiles = issuer.apply_async(vpn.profiles, (args.iam, server.unique_tag, vpn.user_names(vpn_users),
+            [i.public_dns_name for i in server.instances], getattr(args, 'workers', vpn.WORKERS)))
+        issuer.close()
+    if playbooks and not ops.done('provisioned'):
+        print("...provisioning %s" % ', '.join(names))
+        unreachable = provision.provision([(i.public_dns_name, server.keyfile) for i in server.instances],
+            playbooks, forks=args.forks, extra_vars=extra_vars)
+        for hostname in unreachable:
+            sys.stderr.write("...%s never accepted SSH, not provisioned\n" % hostname)
+        if vpn_users and not unreachable:
+            vpn.mark_uploaded(args.iam, server.unique_tag)
+        ops.record('provisioned', unreachable=unreachable)
+    for connection_string in server.connection_strings:
+        print(connection_string)
+    if profiles is not None:
+        paths = profiles.get()
+        ops.record('vpn', profiles=paths)
+        for path in paths:
+            print(path)
+    ops.set_state(journal.DONE)
+
+
+def _spawn_resume(args, op):
+    """Run `popup resume` in the background to wait for, record and provision a detached create"""
+    log = open('%s/%s.log' % (journal.operations_dir(), op), 'a')
+    subprocess.Popen([sys.executable, '-m', 'PopupServer.popup', '-i', args.iam, '-b', getattr(args, 'backend', 'ec2'), 'resume', op],
+        stdout=log, stderr=subprocess.STDOUT, close_fds=True)
+
+
+def operation_status(conn, args):
+    """One line per journaled operation, or the steps of one"""
+    if args.op:
+        ops = journal.Journal.load(args.op)
+        print("%s %s %s" % (ops.op, ops.data['command'], ops.state))
+        for step, data, at in ops.data['steps']:
+            print("%s %s" % (time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(at)), step))
+        return
+    now = time.time()
+    for ops in journal.operations():
+        steps = ops.steps
+        identity = ops.done('identity') or {}
+        print("%s %-8s %-11s %-16s %-10s %ds ago" % (ops.op, ops.data['command'], ops.state,
+            steps[-1] if steps else '-', identity.get('popup_id', '-'), now - ops.data['updated']))
+
+
+def resume(conn, args):
+    """Pick a create back up from its last completed step, or undo it with --rollback"""
+    ops = journal.Journal.load(args.op)
+    if ops.data['state'] in (journal.DONE, journal.ROLLED_BACK):
+        print("Operation %s is already %s" % (ops.op, ops.data['state']))
+        return
+    ops.set_state(journal.RUNNING, pid=os.getpid())
+    create_args = argparse.Namespace(**ops.data['args'])
+    try:
+        if args.rollback:
+            return _rollback(conn, create_args, ops)
+        print("Resuming operation %s after %s" % (ops.op, ops.steps[-1] if ops.steps else 'nothing'))
+        server = PopupServer.PopupServer(conn, create_args, journal=ops)
+        _finish_create(server, create_args, ops)
+        return server
+    except journal.Unresumable as e:
+        ops.set_state(journal.FAILED)
+        sys.stderr.write("...%s\n" % e)
+        raise SystemExit(1)
+    except BaseException:
+        ops.set_state(journal.FAILED)
+        raise
+
+
+@trace.traced('rollback')
+def _rollback(conn, args, ops):
+    """Cancel, terminate and delete whatever the operation got as far as creating.
+    Instances are found by tag as well as from the journal, in case it was killed between
+    launching and recording them. Returns a list of (resource, error) like destroy_popup.
+    """
+    identity = ops.done('identity')
+    failures = []
+    if identity is not None:
+        popup_id = identity['popup_id']
+        launched = ops.done('launched') or {}
+        spot_requests = sorted(set(discovery.find_spot_requests(conn, args.iam, popup_id=popup_id) +
+            launched.get('spot_requests', [])))
+        if spot_requests:
+            print("Cancelling spot requests %s" % spot_requests)
+            conn.cancel_spot_instance_requests(spot_requests)
+        instance_ids = sorted(set([p.id for p in discovery.find_popups(conn, args.iam, popup_id=popup_id)] +
+            launched.get('instance_ids', [])))
+        if instance_ids:
+            print("Terminating %s" % instance_ids)
+            conn.terminate_instances(instance_ids=instance_ids)
+            waiter.wait_for_state(conn, instance_ids, u'terminated', tick=_dot)
+            sys.stdout.write('\n')
+            index.Index().forget(instance_ids)
+        manifest = ops.done('manifest') or {}
+        key_pair = ops.done('key_pair') or {}
+        failures = _cleanup_popup(conn, args.iam, popup_id, manifest.get('manifests', []), manifest.get('hostnames', []),
+            key_pair.get('key_name', identity['key_name']), identity['group_name'])
+        for resource, error in failures:
+            sys.stderr.write("...failed to remove %s: %s\n" % (resource, error))
+    ops.set_state(journal.ROLLED_BACK)
+    print("...rolled back %s" % ops.op)
+    return failures
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _written_manifests(tag):
+    """{manifest: hostname} for what create wrote for popup_id tag.
+    A stopped instance has no DNS name, so the one it had is read back from the manifest's name.
+    """
+    found = {}
+    for path in glob.glob('%s/.popup/manifests/*-%s' % (os.path.expanduser('~'), tag)):
+        name = os.path.basename(path)
+        found[name] = name.split('-', 1)[1][:-len(tag) - 1]
+    return found
+
+
+@trace.traced('destroy.cleanup')
+def _cleanup_popup(conn, iam, tag, manifests, hostnames, key_name, group_name):
+    """Delete the AWS resources and local files belonging to one popup group.
+    Shared key pairs and security groups are left to _release_shared.
+    Every step is attempted; returns a list of (resource, error) for the ones that failed.
+    """
+    HOME = os.path.expanduser('~')
+    written = _written_manifests(tag)
+    manifests = sorted(set(manifests) | set(written))
+    hostnames = sorted(set(hostnames) | set(written.values()))
+    steps = []
+    if not shared.is_shared(group_name, iam):
+        steps.append(('security group %s' % group_name, lambda: conn.delete_security_group(group_name)))
+    if not shared.is_shared(key_name, iam):
+        steps.append(('keypair %s' % key_name, lambda: conn.delete_key_pair(key_name)))
+        steps.append(('key %s.pem' % key_name, lambda: _remove("%s/.popup/keys/%s.pem" % (HOME, key_name))))
+    for manifest in manifests:
+        steps.append(('manifest %s' % manifest, lambda m=manifest: _remove("%s/.popup/manifests/%s" % (HOME, m))))
+    for hostname in hostnames:
+        if hostname:
+            steps.append(('ssh config %s' % hostname, lambda h=hostname: _remove("%s/.popup/config/ssh_configs/%s" % (HOME, h))))
+    if os.path.isdir(vpn.popup_dir(iam, tag)):
+        steps.append(('vpn profiles %s' % tag, lambda: shutil.rmtree(vpn.popup_dir(iam, tag))))
+    failures = []
+    for resource, step in steps:
+        try:
+            step()
+        except Exception as e:
+            failures.append((resource, e))
+    return failures
 
 
+@trace.traced('destroy.release_shared')
+def _release_shared(conn, group_names, key_names):
+    """Delete shared security groups and key pairs no live instance uses any more"""
+    HOME = os.path.expanduser('~')
+    failures = []
+    for name in sorted(group_names):
+        try:
+            if shared.in_use(conn, group_name=name):
+                print("...keeping shared security group %s" % name)
+            else:
+                conn.delete_security_group(name)
+        except Exception as e:
+            failures.append(('security group %s' % name, e))
+    for name in sorted(key_names):
+        try:
+            if shared.in_use(conn, key_name=name):
+                print("...keeping shared keypair %s" % name)
+                continue
+            # A concurrent create may have picked the key up; look again once things have settled
+            time.sleep(shared.SETTLE)
+            if shared.in_use(conn, key_name=name):
+                print("...keeping shared keypair %s, it's back in use" % name)
+                continue
+            conn.delete_key_pair(name)
+        except Exception as e:
+            # The private key stays until the key pair is really gone
+            failures.append(('keypair %s' % name, e))
+            continue
+        # Instances launched with the key keep it, and the .pem is the only way into them
+        if shared.in_use(conn, key_name=name):
+            sys.stderr.write("...keypair %s was picked up while it was deleted, keeping its private key\n" % name)
+        else:
+            _remove("%s/.popup/keys/%s.pem" % (HOME, name))
+    return failures
+
+
+def bake_popup(conn, args):
+    """Boot a stock popup, apply the playbooks and snapshot it into an AMI that create picks up.
+    The builder popup is destroyed afterwards. Returns the image id.
+    """
+    instance_type, base_ami = bake.STOCK_IMAGES[args.size]
+    existing = bake.find_baked_image(conn, base_ami, args.playbooks)
+    if existing and not args.force:
+        print("%s already baked into %s" % (', '.join(args.playbooks), existing))
+        return existing
+
+    print("Creating builder instance...")
+    builder = argparse.Namespace(iam=args.iam, size=args.size, client=None, playbooks=args.playbooks,
+        stock=True, count=1, workers=args.workers)
+    server = PopupServer.PopupServer(conn, builder)
+    try:
+        print("...applying %s" % ', '.join(args.playbooks))
+        if provision.provision([(server.public_dns, server.keyfile)], args.playbooks, forks=args.forks):
+            sys.stderr.write("...%s never accepted SSH\n" % server.public_dns)
+            return None
+        print("...creating image")
+        image_id = bake.create_baked_image(conn, server.instance.id, base_ami, args.playbooks)
+        image = waiter.wait_for_image_state(conn, [image_id], u'available', tick=_dot)[image_id]
+        sys.stdout.write('\n')
+        if image.state != u'available':
+            sys.stderr.write("...image %s is %s\n" % (image_id, image.state))
+            return None
+        # Only retire the old image once the new one can replace it
+        if existing:
+            conn.deregister_image(existing)
+    finally:
+        destroy_popup(conn, argparse.Namespace(iam=args.iam, all=False, client=None, tag=server.unique_tag,
+            workers=args.workers))
+    print(image_id)
+    return image_id
+
+
+@trace.traced('destroy')
 def destroy_popup(conn, args):
     """Terminate EC2 popup instance(s) plus associated resources (keypair, security group).
-    Also remove local manifest files and ssh keys.
+    Also remove local manifest files, ssh keys and ssh configs.
+
+    All matches are terminated with one request. As soon as every instance of a popup
+    group has terminated its resources are cleaned up on a worker pool.
+    Returns a list of (resource, error) for anything that couldn't be removed.
     """
-    HOME = os.path.expanduser('~')
-    instance_ids, unique_tags, manifests = _gather_instances(conn, args)
+    popups = _gather_instances(conn, args)
+    failures = []
+    # Cancel spot requests first so nothing new launches behind our back
+    spot_requests = sorted(set(_gather_spot_requests(conn, args) + [p.spot_request for p in popups if p.spot_request]))
+    if getattr(args, 'dry_run', False):
+        _preview(args, popups, 'destroyed')
+        if spot_requests:
+            sys.stderr.write("...would cancel spot requests %s\n" % ', '.join(spot_requests))
+        return failures
+    if spot_requests:
+        print("Cancelling spot requests %s" % spot_requests)
+        try:
+            conn.cancel_spot_instance_requests(spot_requests)
+        except Exception as e:
+            failures.append(('spot requests %s' % ', '.join(spot_requests), e))
+    if not popups:
+        print("Nothing to destroy")
+        return failures
+    instance_ids = [p.id for p in popups]
+    groups = _popup_groups(popups)
+
     print("Terminating %s" % instance_ids)
-    for id in instance_ids:
-        conn.terminate_instances(instance_ids=[id])
-        wait_for_state(conn, id, u'terminated')
-    for tag in unique_tags:
-        name = "popup-%s-%s" % (args.iam, tag)
-        print("...delete security group")
-        conn.delete_security_group(name)
-        print("...delete keypair")
-        conn.delete_key_pair(name)
-        print("...cleanup local manifest and key")
-        os.remove("%s/.popup/keys/%s" % (HOME, name))
-    for manifest in manifests:
-        os.remove("%s/.popup/manifests/%s" % (HOME, manifest))
-    #XXX Remove .popup/configs/ssh_configs
+    with trace.span('destroy.terminate', instance_ids=instance_ids):
+        conn.terminate_instances(instance_ids=instance_ids)
+
+    # If we don't wait for the instances to terminate, we can't delete the security groups
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(getattr(args, 'workers', 8) or 1)
+    cleanups = {}
+    def tick(pending):
+        _dot(pending)
+        for tag, group in groups.items():
+            if tag not in cleanups and not group['ids'] & pending:
+                cleanups[tag] = pool.apply_async(_cleanup_popup, (conn, args.iam, tag, group['manifests'],
+                    group['hostnames'], group['key_name'], group['group_name']))
+
+    print("...waiting for instances to terminate")
+    try:
+        with trace.span('destroy.wait_terminated', instance_ids=instance_ids):
+            waiter.wait_for_state(conn, instance_ids, u'terminated', tick=tick)
+    except waiter.WaitTimeout as e:
+        for id in e.pending:
+            failures.append(('instance %s' % id, e))
+    finally:
+        pool.close()
+        pool.join()
+    sys.stdout.write('\n')
+    return _finish_destroy(conn, args, groups, dict((tag, cleanups[tag].get()) for tag in cleanups), failures)
+
+
+def _popup_groups(popups):
+    """{popup_id: what _cleanup_popup needs}; every instance in a fleet shares one popup_id"""
+    groups = {}
+    for p in popups:
+        group = groups.setdefault(p.popup_id, {'ids': set(), 'manifests': [], 'hostnames': [],
+            'key_name': p.key_name or p.name, 'group_name': p.security_group or p.name})
+        group['ids'].add(p.id)
+        group['manifests'].append(p.manifest)
+        group['hostnames'].append(p.public_dns_name)
+    return groups
+
+
+def _finish_destroy(conn, args, groups, results, failures):
+    """Release shared resources and report, once every group in results {popup_id: failures} is cleaned up"""
+    # Shared resources are only released once, after every cleanup has run
+    failures.extend(_release_shared(conn,
+        set(groups[t]['group_name'] for t in results if shared.is_shared(groups[t]['group_name'], args.iam)),
+        set(groups[t]['key_name'] for t in results if shared.is_shared(groups[t]['key_name'], args.iam))))
+    index.Index().forget([id for tag in results for id in groups[tag]['ids']])
+    for tag in sorted(results):
+        failures.extend(results[tag])
+    for resource, error in failures:
+        sys.stderr.write("...failed to remove %s: %s\n" % (resource, error))
+    print("...destroyed %d of %d popups" % (len([t for t in results if not results[t]]), len(groups)))
+    return failures
+
+
+def _preview(args, popups, action):
+    """--dry-run: the records of what would be affected, in --format"""
+    records.write(sys.stdout, [records.record(p) for p in popups], args.format, args.columns, args.sort)
+    sys.stderr.write("...%d would be %s\n" % (len(popups), action))
 
 
 def inventory(conn, args):
-    """Queries EC2 for running instances created by this program
-    It should really xref against the manifests directory
+    """Lists popups created by this program from the local index.
+    The index is reconciled with EC2 when it's older than its TTL. With --refresh, or for an
+    owner never seen before, popups are listed as each page arrives from EC2 instead.
     """
-    reservations = conn.get_all_instances()
-    instances = [ i for r in reservations for i in r.instances ]
-    for instance in instances:
-        if instance.state != u'terminated':
-            try:
-                if instance.tags['owner'] == args.iam:
-                    if args.detailed:
-                        print "instance id: %s" % instance.id
-                        print "public DNS: %s" % instance.public_dns_name
-                        print "state: %s" % instance.state
-                        print "launch time: %s" % instance.launch_time
-                    for tag in ['start_date', 'client', 'owner', 'popup_id']:
-                        try:
-                            print "%s: %s" % (tag, instance.tags[tag])
-                        except KeyError:
-                            continue
-            except KeyError:
-                continue
+    popups = index.Index()
+    if getattr(args, 'pool', False):
+        # The index doesn't keep pool members
+        found = discovery.find_popups(conn, args.iam, tags={pool.POOL_TAG: pool.STANDBY})
+    elif args.refresh or popups.synced_at(args.iam) is None:
+        found = popups.stream(conn, args.iam, client=args.client, popup_id=args.tag)
+    else:
+        found = popups.lookup(conn, args.iam, client=args.client, popup_id=args.tag)
+    if args.format != 'text':
+        records.write(sys.stdout, (records.record(p) for p in found), args.format, args.columns, args.sort)
+        popups.wait()
+        return
+    for popup in found:
+        if args.detailed:
+            print("instance id: %s" % popup.id)
+            print("public DNS: %s" % popup.public_dns_name)
+            print("state: %s" % popup.state)
+            print("launch time: %s" % popup.launch_time)
+            if popup.spot_request:
+                print("spot request: %s" % popup.spot_request)
+        for tag in ['start_date', 'client', 'owner', 'popup_id']:
+            if tag in popup.tags:
+                print("%s: %s" % (tag, popup.tags[tag]))
+    popups.wait()
+
+
+def vpn_profile(conn, args):
+    """.ovpn bundles for a running popup, issuing whatever certificates are missing.
+    The server side is only uploaded if it hasn't been yet, or with --upload.
+    """
+    popups = list(discovery.find_popups(conn, args.iam, popup_id=args.tag, states=[u'running']))
+    if not popups:
+        print("No running popup %s" % args.tag)
+        return []
+    users = args.names or vpn.user_names(args.users)
+    upload = args.upload or not vpn.was_uploaded(args.iam, args.tag)
+    if upload:
+        print("...uploading the VPN server configuration to %d instances" % len(popups))
+    paths, unreachable = vpn.setup(args.iam, args.tag, users, [(p.public_dns_name, p.keyfile) for p in popups],
+        workers=args.workers, forks=args.forks, upload_artifacts=upload)
+    for hostname in unreachable:
+        sys.stderr.write("...%s never accepted SSH, not configured\n" % hostname)
+    for path in paths:
+        print(path)
+    return paths
 
 
 def license(conn, args):
     license_text = open("LICENSE.txt").read()
-    print license_text
+    print(license_text)
+
+
+def pool_fill(conn, args):
+    print("Filling the %s pool to %d..." % (pool.spec(args.size, args.playbooks), args.count))
+    added = pool.fill(conn, args, args.count)
+    print("...added %d" % len(added))
+
+
+def pool_status(conn, args):
+    counts = {}
+    for popup in discovery.find_popups(conn, args.iam, tags={pool.POOL_TAG: pool.STANDBY}):
+        key = (popup.tags.get(pool.SPEC_TAG), popup.state)
+        counts[key] = counts.get(key, 0) + 1
+    for (spec, state), count in sorted(counts.items()):
+        print("%s %s: %d" % (spec, state, count))
 
 
+def pool_drain(conn, args):
+    args.pool = True
+    args.all = args.client = args.tag = None
+    return destroy_popup(conn, args)
+
+
+@trace.traced('stop')
 def stop_popup(conn, args):
-    instance_ids, unique_tags, _ = _gather_instances(conn, args)
+    popups = _gather_instances(conn, args)
+    # One-time spot instances can't be stopped, only terminated
+    for popup in popups:
+        if popup.spot_request:
+            sys.stderr.write("...%s is a spot instance (%s) and can't be stopped, destroy it instead\n" % (popup.id, popup.spot_request))
+    instance_ids = [p.id for p in popups if not p.spot_request]
+    if getattr(args, 'dry_run', False):
+        _preview(args, [p for p in popups if not p.spot_request], 'stopped')
+        return
+    if not instance_ids:
+        print("Nothing to stop")
+        return
     print("Stopping %s" % instance_ids)
-    conn.stop_instances(instance_ids=instance_ids, force=args.force)
+    with trace.span('stop.request', instance_ids=instance_ids):
+        conn.stop_instances(instance_ids=instance_ids, force=args.force)
+    state = u'stopping'
+    if args.wait:
+        print("...waiting for instances to stop")
+        with trace.span('stop.wait_stopped', instance_ids=instance_ids):
+            waiter.wait_for_state(conn, instance_ids, u'stopped', tick=_dot)
+        state = u'stopped'
+    index.Index().set_state(instance_ids, state)
+
+
+def reap(conn, args):
+    """Stop popups whose --lifetime is up (or destroy them with --terminate), once or as a daemon"""
+    terminate = None
+    if args.terminate:
+        def terminate(popup_ids):
+            # popup_id filters take a list, so this is still one batch
+            destroy_popup(conn, argparse.Namespace(iam=args.iam, all=False, client=None, tag=popup_ids,
+                workers=args.workers))
+    def report(popups):
+        now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        if args.terminate:
+            print("%s destroyed %s" % (now, [p.id for p in popups]))
+        else:
+            # Spot instances can't be stopped, the reaper terminates them
+            for action, state, ids in [('stopped', u'stopping', [p.id for p in popups if not p.spot_request]),
+                    ('terminated', u'shutting-down', [p.id for p in popups if p.spot_request])]:
+                if ids:
+                    print("%s %s %s" % (now, action, ids))
+                    index.Index().set_state(ids, state)
+        sys.stdout.flush()
+    try:
+        reaper.Reaper(conn, args.iam, terminate=terminate, resync=args.resync).run(once=args.once, on_reap=report)
+    except KeyboardInterrupt:
+        pass
 
 
-def wait_for_state(conn, id, desired):
-    """ If we don't wait for the instance to terminate, we can't delete the security group
-    It's ugly.
-    """
-    reservations = conn.get_all_instances(filters={'instance-id': id})
-    instance = reservations[0].instances[0]
-    state = instance.state
-    print("...waiting for instance %s to terminate" % id)
-    while True:
-        if state == desired:
-            return True
-        else:
-            sys.stdout.write('.')
-            time.sleep(10)
-            instance.update()
+def _dot(pending):
+    sys.stdout.write('.')
+    sys.stdout.flush()
+
+
+def _add_output_arguments(parser, default):
+    parser.add_argument('--format', choices=records.FORMATS + (['text'] if default == 'text' else []), default=default,
+        help='Output format; every one but table is written as results arrive')
+    parser.add_argument('--columns', type=records.parse_columns, default=records.DEFAULT_COLUMNS, metavar='COLUMN,...',
+        help='Columns to output, from %s' % ', '.join(records.COLUMNS))
+    parser.add_argument('--sort', choices=records.COLUMNS, help='Sort table output by this column')
 
 
 def get_parser():
-    _ROOT = os.path.abspath(os.path.dirname(__file__))
     IAM_ID = os.environ.get('IAM_ID') or os.environ['USER']
 
     parser = argparse.ArgumentParser(prog='popup', description='Manage EC2 popup instances', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-i', '--iam', type=str, metavar='IAMID', 
         help='Your IAM id. We attempt to read an IAM_ID environemnt variable and fallback to your username. This is the primary key used to identify AWS resources belonging to you',
         default=IAM_ID)
+    parser.add_argument('-b', '--backend', choices=sorted(backend.BACKENDS), default='ec2',
+        help='Cloud backend; sim is an in-memory EC2 that forgets everything on exit')
+    parser.add_argument('-S', '--api-stats', action='store_true', help='Print API calls, retries and time spent throttled on exit', default=False)
+    parser.add_argument('--profile', action='store_true', help='Print time spent per phase and API call on exit', default=False)
+    parser.add_argument('--trace-file', type=str, metavar='PATH', help='Append a JSON line per phase and API call span to PATH')
     parser.add_argument('-v', '--version', action='version', version="popup version 0.2.0")
     
 
@@ -163,45 +603,126 @@ def get_parser():
     parser_create = subparsers.add_parser('create', help='Create a popup group (instance, keypair, security group)')
     parser_create.add_argument('-s', '--size', type=str, help='Instance size (micro or small)', default='micro')
     parser_create.add_argument('-c', '--client', type=str, help="Tag instance with this client's name (an arbitrary string)")
-    parser_create.add_argument('-l', '--lifetime', type=int, help='Will stop in this many hours', default=12)
+    parser_create.add_argument('-l', '--lifetime', type=int, help='Stopped by `popup reaper` after this many hours (0: never)', default=12)
+    parser_create.add_argument('-n', '--count', type=int, help='Launch a fleet of this many instances sharing one keypair and security group', default=1)
+    parser_create.add_argument('-w', '--workers', type=int, help='Maximum number of concurrent AWS requests', default=8)
 
-    playbook_dir = os.path.join(_ROOT, 'playbooks')
-    playbooks = [name for name in os.listdir(playbook_dir) if os.path.isdir("%s/%s" % (name, playbook_dir))]
+    playbooks = bake.available_playbooks()
     parser_create.add_argument('-p', '--playbooks', nargs='*', choices=playbooks, help='Setup the selected features', default=['mosh', 'openvpn', 'tmux'])
+    parser_create.add_argument('--forks', type=int, help='Hosts ansible provisions in parallel', default=provision.FORKS)
+    parser_create.add_argument('--spot', action='store_true', help='Launch spot instances, falling back to on-demand', default=False)
+    parser_create.add_argument('--max-price', type=float, help='Spot bid in dollars per hour (default: a markup over the current spot price)')
+    parser_create.add_argument('--spot-timeout', type=int, help='Seconds to wait for spot requests before launching on-demand', default=PopupServer.SPOT_TIMEOUT)
+    parser_create.add_argument('--share', choices=['owner', 'client'], help='Reuse one security group for all of your popups (or all popups for this client)')
+    parser_create.add_argument('--share-key', action='store_true', help='With --share, reuse the keypair as well', default=False)
+    parser_create.add_argument('--from-pool', action='store_true', help='Start a stopped popup from the warm pool if one matches', default=False)
+    parser_create.add_argument('--no-refill', dest='refill', action='store_false', help="Don't replace claimed pool members in the background")
+    parser_create.add_argument('--stock', action='store_true', help='Boot the stock image even if the playbooks have been baked', default=False)
+    parser_create.add_argument('--detach', action='store_true', help='Return once the instances are launched and finish in the background', default=False)
+    parser_create.add_argument('--vpn-users', type=int, help='Issue OpenVPN client profiles for this many users', default=0)
     parser_create.set_defaults(func=create_popup)
 
+    parser_status = subparsers.add_parser('status', help='List create operations, or the steps one has completed')
+    parser_status.add_argument('op', nargs='?', help='Operation id printed by create')
+    parser_status.set_defaults(func=operation_status, aws=False)
+
+    parser_resume = subparsers.add_parser('resume', help='Finish an interrupted or detached create')
+    parser_resume.add_argument('op', help='Operation id printed by create')
+    parser_resume.add_argument('--rollback', action='store_true', help='Undo whatever the operation created instead', default=False)
+    parser_resume.set_defaults(func=resume)
+
+    parser_bake = subparsers.add_parser('bake', help='Build an AMI with the selected playbooks already applied')
+    parser_bake.add_argument('-s', '--size', type=str, help='Instance size (micro or small)', default='micro')
+    parser_bake.add_argument('-p', '--playbooks', nargs='*', choices=playbooks, help='Bake in the selected features', default=['mosh', 'openvpn', 'tmux'])
+    parser_bake.add_argument('-f', '--force', action='store_true', help='Rebuild even if a matching image exists', default=False)
+    parser_bake.add_argument('--forks', type=int, help='Hosts ansible provisions in parallel', default=provision.FORKS)
+    parser_bake.add_argument('-w', '--workers', type=int, help='Maximum number of concurrent AWS requests', default=8)
+    parser_bake.set_defaults(func=bake_popup)
+
     parser_destroy = subparsers.add_parser('destroy', help='Destroy a popup group and associated resources')
     destroy_group = parser_destroy.add_mutually_exclusive_group(required=True)
     destroy_group.add_argument('-a', '--all', action='store_true', help='Delete all of your popups and resources')
     destroy_group.add_argument('-c', '--client', type=str, help='Delete all of your instances with this client name')
     destroy_group.add_argument('-t', '--tag', type=str, help='Unique resource tag to be deleted')
+    destroy_group.add_argument('--pool', action='store_true', help='Delete the warm pool, which --all leaves alone')
+    parser_destroy.add_argument('-w', '--workers', type=int, help='Maximum number of concurrent cleanups', default=8)
+    parser_destroy.add_argument('--dry-run', action='store_true', help="List what would be destroyed and don't destroy it", default=False)
+    _add_output_arguments(parser_destroy, 'table')
     parser_destroy.set_defaults(func=destroy_popup)
     
     parser_inventory = subparsers.add_parser('inventory', help='List popups you have running in AWS')
     parser_inventory.add_argument('-d', '--detailed', action='store_true', help='Provide additional EC2 specific information')
+    parser_inventory.add_argument('-c', '--client', type=str, help='Only list popups for this client')
+    parser_inventory.add_argument('-t', '--tag', type=str, help='Only list the popup with this unique tag')
+    parser_inventory.add_argument('-r', '--refresh', action='store_true', help='Resync the local index with EC2 first', default=False)
+    parser_inventory.add_argument('--pool', action='store_true', help='List the warm pool instead of your popups', default=False)
+    _add_output_arguments(parser_inventory, 'text')
     parser_inventory.set_defaults(func=inventory)
     
     parser_stop = subparsers.add_parser('stop', help='Stop running instances')
     parser_stop.add_argument('-f', '--force', action='store_true', help='Force shutdown', default=False)
+    parser_stop.add_argument('-W', '--wait', action='store_true', help='Wait until the instances have stopped', default=False)
+    parser_stop.add_argument('--dry-run', action='store_true', help="List what would be stopped and don't stop it", default=False)
+    _add_output_arguments(parser_stop, 'table')
     stop_group = parser_stop.add_mutually_exclusive_group(required=True)
     stop_group.add_argument('-a', '--all', action='store_true', help='Stop (not terminate) all of your instances')
     stop_group.add_argument('-c', '--client', type=str, help='Stop (not terminate) all instances for this client')
     stop_group.add_argument('-t', '--tag', type=str, help='Unique resource tag to be stopped')
     parser_stop.set_defaults(func=stop_popup)
 
+    parser_reaper = subparsers.add_parser('reaper', help='Stop popups that have outlived their --lifetime')
+    parser_reaper.add_argument('-1', '--once', action='store_true', help="Reap what's due now and exit instead of running as a daemon", default=False)
+    parser_reaper.add_argument('--terminate', action='store_true', help='Destroy expired popups instead of stopping them', default=False)
+    parser_reaper.add_argument('--resync', type=int, help='Seconds between looking for new popups', default=reaper.RESYNC)
+    parser_reaper.add_argument('-w', '--workers', type=int, help='Maximum number of concurrent cleanups', default=8)
+    parser_reaper.set_defaults(func=reap)
+
+    parser_pool = subparsers.add_parser('pool', help='Manage a warm pool of stopped, provisioned popups')
+    pool_subparsers = parser_pool.add_subparsers()
+    parser_pool_fill = pool_subparsers.add_parser('fill', help='Top the pool up to COUNT members')
+    parser_pool_fill.add_argument('-n', '--count', type=int, help='Number of members to keep', default=2)
+    parser_pool_fill.add_argument('-s', '--size', type=str, help='Instance size (micro or small)', default='micro')
+    parser_pool_fill.add_argument('-p', '--playbooks', nargs='*', choices=playbooks, help='Setup the selected features', default=['mosh', 'openvpn', 'tmux'])
+    parser_pool_fill.add_argument('--forks', type=int, help='Hosts ansible provisions in parallel', default=provision.FORKS)
+    parser_pool_fill.add_argument('-w', '--workers', type=int, help='Maximum number of concurrent AWS requests', default=8)
+    parser_pool_fill.set_defaults(func=pool_fill)
+    parser_pool_status = pool_subparsers.add_parser('status', help='Count pool members')
+    parser_pool_status.set_defaults(func=pool_status)
+    parser_pool_drain = pool_subparsers.add_parser('drain', help='Destroy every pool member')
+    parser_pool_drain.add_argument('-w', '--workers', type=int, help='Maximum number of concurrent cleanups', default=8)
+    parser_pool_drain.set_defaults(func=pool_drain)
+
+    parser_vpn = subparsers.add_parser('vpn-profile', help='Fetch OpenVPN client profiles (.ovpn) for a popup')
+    parser_vpn.add_argument('-t', '--tag', type=str, required=True, help='Unique resource tag of the popup')
+    vpn_group = parser_vpn.add_mutually_exclusive_group()
+    vpn_group.add_argument('-u', '--users', type=int, help='Profiles for user1..userN', default=1)
+    vpn_group.add_argument('--names', type=lambda value: [n for n in value.split(',') if n], metavar='NAME,...', help='Profiles for these users')
+    parser_vpn.add_argument('--upload', action='store_true', help='Upload the server configuration even if it already has been', default=False)
+    parser_vpn.add_argument('--forks', type=int, help='Hosts ansible configures in parallel', default=provision.FORKS)
+    parser_vpn.add_argument('-w', '--workers', type=int, help='Certificates issued in parallel', default=vpn.WORKERS)
+    parser_vpn.set_defaults(func=vpn_profile)
+
     parser_license = subparsers.add_parser('license', help="http://github.com/jayed/popup/LICENSE")
-    parser_license.set_defaults(func=license)
+    parser_license.set_defaults(func=license, aws=False)
     return parser
 
 
 def main():
-    AWS_ACCESS_KEY_ID = os.environ['AWS_ACCESS_KEY_ID']
-    AWS_SECRET_ACCESS_KEY = os.environ['AWS_SECRET_ACCESS_KEY']
-    conn = EC2Connection()
-    parser = get_parser() 
-    #pdb.set_trace()
+    parser = get_parser()
     args = parser.parse_args()
-    args.func(conn, args)
+    if args.profile or args.trace_file:
+        trace.enable(args.trace_file)
+    # Subcommands that never talk to AWS set aws=False
+    conn = scheduler.Scheduler(backend.connect(args.backend)) if getattr(args, 'aws', True) else None
+    try:
+        with trace.span('command', func=args.func.__name__):
+            args.func(conn, args)
+    finally:
+        if conn is not None and args.api_stats:
+            sys.stderr.write(conn.report() + '\n')
+        if args.profile:
+            sys.stderr.write(trace.report() + '\n')
+        trace.disable()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Apply playbooks to freshly created popups with ansible-playbook.
+All hosts go into one inventory and one run, sharing an ssh_config with
+persistent ControlMaster connections.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import tempfile
+import time
+
+from . import ansible_env, trace
+from .bake import PLAYBOOK_DIR
+
+
+FORKS = 10
+SSH_TIMEOUT = 300
+
+
+def playbook_path(name):
+    """Playbooks are named by their directory; a path is used as is"""
+    if os.path.isabs(name):
+        return name
+    return os.path.join(PLAYBOOK_DIR, name, '%s.yaml' % name)
+
+
+def _ssh_is_up(target):
+    hostname, port = target
+    try:
+        socket.create_connection((hostname, port), 5).close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+
+def wait_for_ssh(hostnames, port=22, timeout=SSH_TIMEOUT, delay=2.0, max_delay=15.0):
+    """A running instance isn't necessarily accepting SSH yet.
+    Returns the hostnames that still weren't when the deadline passed.
+    """
+    from multiprocessing.pool import ThreadPool
+    deadline = time.time() + timeout
+    pending = list(hostnames)
+    pool = ThreadPool(min(len(pending), FORKS) or 1)
+    try:
+        while pending:
+            up = pool.map(_ssh_is_up, [(h, port) for h in pending])
+            pending = [h for h, ok in zip(pending, up) if not ok]
+            remaining = deadline - time.time()
+            if not pending or remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(max_delay, delay * 1.5)
+    finally:
+        pool.close()
+        pool.join()
+    return pending
+
+
+@trace.traced('provision')
+def provision(targets, playbooks, forks=FORKS, ssh_timeout=SSH_TIMEOUT, extra_vars=None):
+    """Run playbooks (with sudo, as ubuntu) against every (hostname, keyfile) in targets
+    with a single ansible-playbook invocation. extra_vars is a dict passed to -e as JSON.
+    Returns the hostnames skipped because SSH never came up.
+    Raises subprocess.CalledProcessError if ansible fails.
+    """
+    if not targets or not playbooks:
+        return []
+    with trace.span('provision.wait_ssh', hosts=len(targets)) as span:
+        unreachable = span['unreachable'] = wait_for_ssh([hostname for hostname, _ in targets], timeout=ssh_timeout)
+    targets = [(hostname, keyfile) for hostname, keyfile in targets if hostname not in unreachable]
+    if not targets:
+        return unreachable
+    for hostname, keyfile in targets:
+        ansible_env.ssh_config(hostname, keyfile)
+    fd, inventory = tempfile.mkstemp(prefix='popup-inventory-')
+    configfile = inventory + '.ssh_config'
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write('[popups]\n')
+            f.write(''.join('%s\n' % hostname for hostname, _ in targets))
+        ansible_env.fleet_config(targets, configfile)
+        with trace.span('provision.ansible', hosts=len(targets), playbooks=list(playbooks)):
+            # As JSON, so values with spaces or quotes arrive intact
+            extra = ['-e', json.dumps(extra_vars, sort_keys=True)] if extra_vars else []
+            subprocess.check_call(['ansible-playbook', '-i', inventory, '-u', 'ubuntu', '-f', str(forks), '--sudo'] + extra +
+                [playbook_path(name) for name in playbooks], env=ansible_env.environment(configfile))
+    finally:
+        os.remove(inventory)
+        if os.path.exists(configfile):
+            os.remove(configfile)
+    return unreachable
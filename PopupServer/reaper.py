@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Lifetime enforcement. create tags every popup with its expiry time and the
+reaper stops (or terminates) popups once it passes.
+
+Expiry times live in a min-heap built from one filtered describe, so the reaper
+sleeps until the next deadline instead of polling. Due popups are re-described
+by id in one batch before acting, in case their lifetime was extended, and new
+popups are merged in by a periodic filtered resync rather than a rebuild.
+"""
+
+import calendar
+import heapq
+import sys
+import time
+
+from . import discovery
+
+
+EXPIRES_TAG = 'expires'
+_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Seconds between resyncs that pick up new popups
+RESYNC = 300
+# Instances acted on per request
+BATCH = 100
+# Seconds to back off after a cycle failed
+ERROR_DELAY = 30
+
+# States worth stopping; anything else is already on its way down
+_RUNNING = [u'pending', u'running']
+
+
+def expires_tag(hours, now=None):
+    """The expires tag value for a popup living hours from now, or None for no limit"""
+    if not hours:
+        return None
+    return time.strftime(_FORMAT, time.gmtime((time.time() if now is None else now) + hours * 3600))
+
+
+def expires_at(popup):
+    """Epoch seconds a discovery.Popup expires, or None if it doesn't (or the tag is garbage)"""
+    value = popup.tags.get(EXPIRES_TAG)
+    try:
+        return calendar.timegm(time.strptime(value, _FORMAT)) if value else None
+    except ValueError:
+        return None
+
+
+class Reaper(object):
+    """Stops owner's popups as they expire, or with terminate=callable hands their popup_ids to it instead.
+    One-time spot instances can't be stopped, so those are terminated either way.
+    """
+
+    def __init__(self, conn, owner, terminate=None, batch=BATCH, resync=RESYNC):
+        self.conn = conn
+        self.owner = owner
+        self.terminate = terminate
+        self.batch = batch
+        self.resync = resync
+        self.states = list(discovery.LIVE_STATES) if terminate else list(_RUNNING)
+        # (expires, instance id); may hold stale entries, checked against known when popped
+        self.heap = []
+        # {instance id: expires} for what's in the heap
+        self.known = {}
+        self.synced_at = None
+
+    def _push(self, popup):
+        expires = expires_at(popup)
+        if expires is None or self.known.get(popup.id) == expires:
+            return
+        self.known[popup.id] = expires
+        heapq.heappush(self.heap, (expires, popup.id))
+
+    def sync(self):
+        """Merge in every expiring popup of owner's, from one filtered describe"""
+        self.synced_at = time.time()
+        seen = set()
+        for popup in discovery.find_popups(self.conn, self.owner, states=self.states, tag_keys=[EXPIRES_TAG]):
+            seen.add(popup.id)
+            self._push(popup)
+        # Gone (or stopped by someone else) since the last sync
+        for id in set(self.known) - seen:
+            del self.known[id]
+
+    def next_deadline(self):
+        while self.heap and self.known.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def _due(self, now):
+        due = []
+        while len(due) < self.batch and self.next_deadline() is not None and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[1])
+        return due
+
+    def _confirm(self, ids, now):
+        """The popups among ids that are still live and still expired, re-queueing any that were extended"""
+        expired = []
+        current = dict((p.id, p) for p in discovery.find_popups(self.conn, self.owner, states=self.states,
+            instance_ids=ids))
+        for id in ids:
+            del self.known[id]
+            popup = current.get(id)
+            if popup is None:
+                continue
+            expires = expires_at(popup)
+            if expires is not None and expires <= now:
+                expired.append(popup)
+            else:
+                self._push(popup)
+        return expired
+
+    def reap(self, now=None):
+        """Act on everything that's due. Returns the discovery.Popup records that were stopped or terminated"""
+        now = time.time() if now is None else now
+        reaped = []
+        while True:
+            ids = self._due(now)
+            if not ids:
+                return reaped
+            expired = self._confirm(ids, now)
+            if not expired:
+                continue
+            if self.terminate:
+                self.terminate(sorted(set(p.popup_id for p in expired)))
+            else:
+                spot = [p.id for p in expired if p.spot_request]
+                if spot:
+                    self.conn.terminate_instances(instance_ids=spot)
+                on_demand = [p.id for p in expired if not p.spot_request]
+                if on_demand:
+                    self.conn.stop_instances(instance_ids=on_demand)
+            reaped.extend(expired)
+
+    def run(self, once=False, sleep=time.sleep, on_reap=None):
+        """Reap until interrupted, or just what's due right now with once.
+        A failed cycle is logged and retried after ERROR_DELAY from a fresh sync; with once it's raised.
+        """
+        while True:
+            try:
+                if self.synced_at is None or time.time() - self.synced_at >= self.resync:
+                    self.sync()
+                reaped = self.reap()
+                if reaped and on_reap is not None:
+                    on_reap(reaped)
+            except Exception as e:
+                if once:
+                    raise
+                sys.stderr.write("%s reaper cycle failed, retrying in %ds: %s\n" % (
+                    time.strftime(_FORMAT, time.gmtime()), ERROR_DELAY, e))
+                # Start over from a full sync: what this cycle popped is neither in the heap nor
+                # reliably out of known, and a sync skips whatever known already has
+                self.heap, self.known, self.synced_at = [], {}, None
+                sleep(ERROR_DELAY)
+                continue
+            if once:
+                return
+            deadline = self.next_deadline()
+            wake = self.synced_at + self.resync
+            if deadline is not None:
+                wake = min(wake, deadline)
+            sleep(max(0.0, wake - time.time()))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Flat records of popups for inventory and for stop/destroy --dry-run.
+Every format but table writes each record as soon as it arrives, so a large
+account streams out a page of instances at a time.
+"""
+
+import argparse
+import calendar
+import csv
+import json
+import time
+
+from collections import OrderedDict
+
+
+# On-demand dollars per hour, for the uptime cost estimate
+HOURLY_PRICE = {'t1.micro': 0.02, 'm1.small': 0.06}
+
+COLUMNS = ['id', 'popup_id', 'owner', 'client', 'dns', 'state', 'instance_type', 'launch_time', 'age', 'cost',
+    'spot_request', 'tags']
+DEFAULT_COLUMNS = ['id', 'popup_id', 'client', 'dns', 'state', 'launch_time', 'age', 'cost']
+FORMATS = ['table', 'json', 'jsonl', 'csv']
+
+# States an instance is billed in
+_BILLED = set([u'pending', u'running', u'stopping', u'shutting-down'])
+
+
+def _launched_at(launch_time):
+    """Seconds since the epoch for EC2's ISO 8601 launch_time, or None"""
+    try:
+        return calendar.timegm(time.strptime(launch_time[:19], '%Y-%m-%dT%H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
+
+def record(popup, now=None):
+    """Every column for a discovery.Popup. age is in seconds since launch and cost is
+    an estimate of the on-demand dollars spent since then, None when it's not billed
+    """
+    now = time.time() if now is None else now
+    launched = _launched_at(popup.launch_time)
+    age = int(now - launched) if launched is not None else None
+    price = HOURLY_PRICE.get(popup.instance_type)
+    cost = None
+    if age is not None and price is not None and popup.state in _BILLED:
+        cost = round(age / 3600.0 * price, 4)
+    return OrderedDict([('id', popup.id), ('popup_id', popup.popup_id), ('owner', popup.owner), ('client', popup.client),
+        ('dns', popup.public_dns_name), ('state', popup.state), ('instance_type', popup.instance_type),
+        ('launch_time', popup.launch_time), ('age', age), ('cost', cost), ('spot_request', popup.spot_request),
+        ('tags', dict(popup.tags))])
+
+
+def parse_columns(value):
+    """argparse type for a comma separated list of COLUMNS"""
+    columns = [c.strip() for c in value.split(',') if c.strip()]
+    unknown = [c for c in columns if c not in COLUMNS]
+    if unknown or not columns:
+        raise argparse.ArgumentTypeError("unknown columns %s (choose from %s)" % (', '.join(unknown), ', '.join(COLUMNS)))
+    return columns
+
+
+def _select(rec, columns):
+    return OrderedDict((c, rec[c]) for c in columns)
+
+
+def _cell(value):
+    """Flat text for table and csv"""
+    if value is None:
+        return ''
+    if isinstance(value, dict):
+        return ','.join('%s=%s' % item for item in sorted(value.items()))
+    return '%s' % value
+
+
+def _age(seconds):
+    if seconds is None:
+        return ''
+    hours, minutes = divmod(seconds // 60, 60)
+    return '%dd%02dh' % divmod(hours, 24) if hours >= 24 else '%dh%02dm' % (hours, minutes)
+
+
+def _sort_key(column):
+    # None sorts first without comparing it to anything else
+    return lambda rec: (rec[column] is not None, rec[column])
+
+
+def write(out, records, fmt='jsonl', columns=None, sort=None):
+    """Writes records (any iterable, consumed lazily) to out in fmt.
+    sort only applies to table, which has to see every record to size its columns.
+    """
+    columns = columns or DEFAULT_COLUMNS
+    if fmt == 'jsonl':
+        for rec in records:
+            out.write(json.dumps(_select(rec, columns)) + '\n')
+            out.flush()
+    elif fmt == 'json':
+        out.write('[')
+        for n, rec in enumerate(records):
+            out.write((',\n' if n else '\n') + json.dumps(_select(rec, columns)))
+            out.flush()
+        out.write('\n]\n')
+    elif fmt == 'csv':
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(columns)
+        for rec in records:
+            writer.writerow([_cell(rec[c]) for c in columns])
+            out.flush()
+    elif fmt == 'table':
+        records = list(records)
+        if sort:
+            records.sort(key=_sort_key(sort))
+        rows = [columns] + [[_age(rec[c]) if c == 'age' else _cell(rec[c]) for c in columns] for rec in records]
+        widths = [max(len(row[n]) for row in rows) for n in range(len(columns))]
+        for row in rows:
+            out.write('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() + '\n')
+    else:
+        raise ValueError("Unknown format %s" % fmt)
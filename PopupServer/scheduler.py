@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Every cloud call goes through a Scheduler wrapped around the connection.
+Each API action draws from its own token bucket, throttled and transient
+errors are retried with exponential backoff (with jitter), and all retries
+share one budget so a struggling endpoint can't stall a bulk operation forever.
+"""
+
+import random
+import socket
+import threading
+import time
+
+from collections import defaultdict
+
+from . import backend, trace
+
+
+# (refill per second, burst) per action; the rest get DEFAULT_RATE
+DEFAULT_RATE = (20.0, 100)
+RATES = {
+    'run_instances': (2.0, 5),
+    'start_instances': (2.0, 5),
+    'stop_instances': (2.0, 5),
+    'terminate_instances': (5.0, 20),
+    'request_spot_instances': (2.0, 5),
+    'create_image': (1.0, 2),
+    'create_tags': (10.0, 50),
+    'get_status': (10.0, 50),
+}
+
+# Seconds. Module level so tests and benchmarks can shrink them.
+BASE_DELAY = 0.5
+MAX_DELAY = 20.0
+MAX_ATTEMPTS = 8
+# Retries a Scheduler may make in total
+RETRY_BUDGET = 200
+
+THROTTLED = set(['RequestLimitExceeded', 'Throttling', 'ThrottlingException'])
+TRANSIENT = set(['InternalError', 'Unavailable', 'ServiceUnavailable'])
+
+# Ids EC2 has just handed out can take a moment to be accepted by other calls
+NOT_YET_VISIBLE = {
+    'create_tags': set(['InvalidInstanceID.NotFound', 'InvalidGroup.NotFound', 'InvalidSpotInstanceRequestID.NotFound']),
+}
+
+# Raw requests (get_object, get_list) are scheduled as the operation they stand for
+RAW_ACTIONS = {'RunInstances': 'run_instances', 'RequestSpotInstances': 'request_spot_instances'}
+
+# Retrying these after an error other than throttling might do them twice
+NOT_IDEMPOTENT = set(['run_instances', 'request_spot_instances', 'create_image', 'create_key_pair',
+    'create_security_group'])
+
+
+def _client_token(args, kwargs):
+    """A launch carrying a client token can be repeated safely"""
+    params = args[1] if len(args) > 1 and isinstance(args[1], dict) else kwargs.get('params') or {}
+    return params.get('ClientToken')
+
+
+def _error_code(e):
+    return getattr(e, 'error_code', None)
+
+
+def _resource_ids(args, kwargs):
+    """The instance (or other resource) ids a call is about, for its trace span"""
+    ids = kwargs.get('instance_ids') or kwargs.get('resource_ids') or kwargs.get('request_ids')
+    if ids is None and args and isinstance(args[0], (list, tuple, set)):
+        ids = args[0]
+    return sorted(ids) if isinstance(ids, (list, tuple, set)) else None
+
+
+def is_throttled(e):
+    return _error_code(e) in THROTTLED
+
+
+def is_transient(e):
+    return _error_code(e) in TRANSIENT or (getattr(e, 'status', None) or 0) >= 500 or isinstance(e, socket.error)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token, returning how many seconds to wait before using it"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class Scheduler(object):
+    """Wraps a connection; backend.OPERATIONS are scheduled, everything else passes straight through"""
+
+    def __init__(self, conn, rates=None, retry_budget=None):
+        self.conn = conn
+        self.rates = dict(RATES, **(rates or {}))
+        self.retry_budget = RETRY_BUDGET if retry_budget is None else retry_budget
+        self.lock = threading.Lock()
+        self._buckets = {}
+        # {action: {'calls': n, 'retries': n, 'throttled': n, 'throttled_time': seconds}}
+        self.stats = defaultdict(lambda: {'calls': 0, 'retries': 0, 'throttled': 0, 'throttled_time': 0.0})
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if name not in backend.OPERATIONS or not callable(attr):
+            return attr
+        def scheduled(*args, **kwargs):
+            action = RAW_ACTIONS.get(args[0], name) if name in ('get_object', 'get_list') and args else name
+            return self.call(action, attr, *args, **kwargs)
+        return scheduled
+
+    def _bucket(self, action):
+        with self.lock:
+            if action not in self._buckets:
+                self._buckets[action] = TokenBucket(*self.rates.get(action, DEFAULT_RATE))
+            return self._buckets[action]
+
+    def _record(self, action, **counts):
+        with self.lock:
+            stats = self.stats[action]
+            for key, value in counts.items():
+                stats[key] += value
+
+    def _take_retry(self):
+        with self.lock:
+            if self.retry_budget <= 0:
+                return False
+            self.retry_budget -= 1
+            return True
+
+    def call(self, action, fn, *args, **kwargs):
+        with trace.span(action, kind='api') as span:
+            ids = _resource_ids(args, kwargs)
+            if ids:
+                span['ids'] = ids
+            return self._call(span, action, fn, *args, **kwargs)
+
+    def _call(self, span, action, fn, *args, **kwargs):
+        delay = BASE_DELAY
+        attempt = 1
+        idempotent = action not in NOT_IDEMPOTENT or bool(_client_token(args, kwargs))
+        while True:
+            wait = self._bucket(action).reserve()
+            if wait:
+                self._record(action, throttled_time=wait)
+                span['throttled_time'] = span.get('throttled_time', 0.0) + wait
+                time.sleep(wait)
+            self._record(action, calls=1)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttled(e)
+                if not (throttled or (is_transient(e) and idempotent)
+                        or _error_code(e) in NOT_YET_VISIBLE.get(action, ())):
+                    raise
+                if attempt >= MAX_ATTEMPTS or not self._take_retry():
+                    raise
+                pause = random.uniform(delay / 2, delay)
+                self._record(action, retries=1, throttled=int(throttled), throttled_time=pause if throttled else 0.0)
+                span['retries'] = attempt
+                time.sleep(pause)
+                delay = min(MAX_DELAY, delay * 2)
+                attempt += 1
+
+    def metrics(self):
+        """{action: stats} plus a 'total' entry"""
+        with self.lock:
+            metrics = dict((action, dict(stats)) for action, stats in self.stats.items())
+        total = {'calls': 0, 'retries': 0, 'throttled': 0, 'throttled_time': 0.0}
+        for stats in metrics.values():
+            for key in total:
+                total[key] += stats[key]
+        metrics['total'] = total
+        return metrics
+
+    def report(self):
+        lines = ["%-32s %6s %7s %9s %10s" % ('action', 'calls', 'retries', 'throttled', 'waited')]
+        metrics = self.metrics()
+        for action in sorted(metrics, key=lambda a: (a == 'total', a)):
+            stats = metrics[action]
+            lines.append("%-32s %6d %7d %9d %9.2fs" % (action, stats['calls'], stats['retries'], stats['throttled'],
+                stats['throttled_time']))
+        return '\n'.join(lines)
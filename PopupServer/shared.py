@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Security groups and key pairs shared between popups.
+A shared resource is reused by every popup of an owner (or of an owner's client)
+and only deleted once no live instance references it. EC2 itself is the
+reference count: instances are looked up by group name or key name.
+"""
+
+import os
+
+from . import discovery
+
+
+# Seconds a released key pair must stay unused before it's deleted; a create that
+# picked it up just before the teardown has launched by then
+SETTLE = 5.0
+
+
+def shared_name(owner, client=None):
+    if client:
+        return "popup-%s-client-%s" % (owner, client)
+    return "popup-%s-shared" % owner
+
+
+def is_shared(name, owner):
+    return name.startswith("popup-%s-client-" % owner) or name == shared_name(owner)
+
+
+def authorize_all(conn, group_name, rules, cidr_ip='0.0.0.0/0'):
+    """Open every (protocol, from port, to port) in rules with a single AuthorizeSecurityGroupIngress.
+    boto's authorize_security_group only sends one rule per request.
+    """
+    params = {'GroupName': group_name}
+    for n, (ip_protocol, from_port, to_port) in enumerate(rules, 1):
+        params['IpPermissions.%d.IpProtocol' % n] = ip_protocol
+        params['IpPermissions.%d.FromPort' % n] = from_port
+        params['IpPermissions.%d.ToPort' % n] = to_port
+        params['IpPermissions.%d.IpRanges.1.CidrIp' % n] = cidr_ip
+    return conn.get_status('AuthorizeSecurityGroupIngress', params, verb='POST')
+
+
+def _duplicate(e):
+    return getattr(e, 'error_code', None) in ('InvalidGroup.Duplicate', 'InvalidKeyPair.Duplicate')
+
+
+def ensure_security_group(conn, name, description, rules):
+    """Returns the security group called name, creating and authorizing it if it doesn't exist"""
+    groups = conn.get_all_security_groups(filters={'group-name': name})
+    if groups:
+        return groups[0]
+    try:
+        group = conn.create_security_group(name, description)
+    except Exception as e:
+        # Another popup created it first
+        if _duplicate(e):
+            return conn.get_all_security_groups(filters={'group-name': name})[0]
+        raise
+    authorize_all(conn, name, rules)
+    return group
+
+
+def ensure_key_pair(conn, name, keyfile):
+    """Returns (key pair, private key) for the key pair called name.
+    An existing key pair is only reusable if its private key is in keyfile; otherwise returns (None, None).
+    """
+    existing = conn.get_all_key_pairs(filters={'key-name': name})
+    if existing:
+        if not os.path.exists(keyfile):
+            return (None, None)
+        with open(keyfile) as f:
+            return (existing[0], f.read())
+    try:
+        kp = conn.create_key_pair(name)
+    except Exception as e:
+        # Another popup created it first and owns the private key file
+        if _duplicate(e) and os.path.exists(keyfile):
+            return ensure_key_pair(conn, name, keyfile)
+        if _duplicate(e):
+            return (None, None)
+        raise
+    with open(keyfile, 'w') as f:
+        f.write(kp.material)
+        os.chmod(f.name, 0o600)
+    return (kp, kp.material)
+
+
+def in_use(conn, group_name=None, key_name=None):
+    """Number of live instances using the security group and/or key pair"""
+    filters = {'instance-state-name': discovery.LIVE_STATES}
+    if group_name:
+        filters['instance.group-name'] = group_name
+    if key_name:
+        filters['key-name'] = key_name
+    return len([i for r in conn.get_all_instances(filters=filters) for i in r.instances])
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+from PopupServer import shared, waiter
+
+
+def make_args(**kwargs):
+    defaults = dict(iam='tester', size='micro', client=None, lifetime=12, count=1, workers=8,
+        playbooks=['mosh', 'openvpn', 'tmux'])
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+
+class PopupHomeTestCase(unittest.TestCase):
+    """Points ~ at a scratch directory laid out the way setup.py installs ~/.popup"""
+
+    def setUp(self):
+        self._home = os.environ.get('HOME')
+        self.home = tempfile.mkdtemp()
+        os.environ['HOME'] = self.home
+        self._delay = waiter.DELAY
+        self._settle = shared.SETTLE
+        for d in ['keys', 'manifests', 'config/ssh_configs', 'config/ssh_control']:
+            os.makedirs(os.path.join(self.home, '.popup', d))
+        waiter.DELAY = 0.01
+        shared.SETTLE = 0
+
+    def tearDown(self):
+        if self._home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = self._home
+        shutil.rmtree(self.home)
+        waiter.DELAY = self._delay
+        shared.SETTLE = self._settle
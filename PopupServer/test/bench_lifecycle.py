@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+Drive create, inventory, stop and destroy against the sim backend at several
+fleet sizes and report API calls and wall-clock time per phase. Provisioning
+(ansible) isn't part of it. Times are scaled down like bench_waiter's.
+
+    python -m PopupServer.test.bench_lifecycle --sizes 1 10 100 --latency 0.005 --throttle 5
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from PopupServer import PopupServer, backend, index, popup, scheduler, waiter
+from PopupServer.test import make_args
+
+
+def _create(conn, args, size):
+    if args.mode == 'fleet':
+        PopupServer.PopupServer(conn, make_args(count=size, workers=args.workers))
+    else:
+        for _ in range(size):
+            PopupServer.PopupServer(conn, make_args(workers=args.workers))
+
+
+def _inventory(conn, args, size):
+    popups = index.Index().lookup(conn, 'tester', refresh=True)
+    assert len(popups) == size, popups
+
+
+def _stop(conn, args, size):
+    popup.stop_popup(conn, make_args(all=True, client=None, tag=None, force=False, wait=True))
+
+
+def _destroy(conn, args, size):
+    failures = popup.destroy_popup(conn, make_args(all=True, client=None, tag=None, workers=args.workers))
+    assert not failures, failures
+
+
+PHASES = [('create', _create), ('inventory', _inventory), ('stop', _stop), ('destroy', _destroy)]
+
+
+def run(args, size):
+    """[(phase, calls, retries, seconds)] for one lifecycle of size popups, in a scratch ~"""
+    sim = backend.connect('sim', latency=args.latency, boot_time=args.transition, stop_time=args.transition,
+        terminate_time=args.transition, throttle={'*': args.throttle} if args.throttle else None)
+    conn = scheduler.Scheduler(sim)
+    home, stdout = os.environ.get('HOME'), sys.stdout
+    os.environ['HOME'] = tempfile.mkdtemp()
+    for d in ['keys', 'manifests', 'config/ssh_configs', 'config/ssh_control']:
+        os.makedirs(os.path.join(os.environ['HOME'], '.popup', d))
+    results = []
+    try:
+        for name, phase in PHASES:
+            calls, retries = sum(sim.calls.values()), conn.metrics()['total']['retries']
+            began = time.time()
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                phase(conn, args, size)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            results.append((name, sum(sim.calls.values()) - calls, conn.metrics()['total']['retries'] - retries,
+                time.time() - began))
+    finally:
+        shutil.rmtree(os.environ['HOME'])
+        os.environ['HOME'] = home
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the popup lifecycle against the sim backend')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[1, 10, 100], help='Popups per run')
+    parser.add_argument('--mode', choices=['fleet', 'single'], default='fleet',
+        help='One create --count N, or N separate creates')
+    parser.add_argument('--latency', type=float, default=0.005, help='Seconds per API call')
+    parser.add_argument('--transition', type=float, default=0.2, help='Seconds for boot, stop and terminate')
+    parser.add_argument('--throttle', type=int, help='Throttle every nth call of each action')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='Maximum number of concurrent AWS requests')
+    args = parser.parse_args()
+
+    waiter.DELAY = args.transition / 10
+    waiter.MAX_DELAY = args.transition
+    scheduler.BASE_DELAY = args.latency
+    print("%6s %-10s %8s %8s %10s" % ('popups', 'phase', 'calls', 'retries', 'time'))
+    for size in args.sizes:
+        for name, calls, retries, elapsed in run(args, size):
+            print("%6d %-10s %8d %8d %9.3fs" % (size, name, calls, retries, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time how long `popup --version` takes to start, and with -X importtime (python
+3.7+) which imports dominate. Exits non-zero if the median start time goes over
+--threshold milliseconds, so it can guard against import-time regressions.
+
+    python -m PopupServer.test.bench_startup --runs 20 --threshold 250
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+_VERSION = [sys.executable, '-c', 'import sys; sys.argv = ["popup", "--version"]; from PopupServer import popup; popup.main()']
+
+
+def _env():
+    env = dict(os.environ)
+    # No credentials: --version mustn't need them
+    env.pop('AWS_ACCESS_KEY_ID', None)
+    env.pop('AWS_SECRET_ACCESS_KEY', None)
+    env.setdefault('IAM_ID', 'bench')
+    return env
+
+
+def start_times(runs):
+    """Wall clock milliseconds for each of runs starts"""
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            began = time.time()
+            subprocess.check_call(_VERSION, stdout=devnull, stderr=devnull, env=_env())
+            times.append((time.time() - began) * 1000)
+    return times
+
+
+def slowest_imports(top):
+    """[(cumulative microseconds, module)] from -X importtime, or [] where it isn't supported"""
+    if sys.version_info < (3, 7):
+        return []
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime'] + _VERSION[1:], stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, env=_env(), universal_newlines=True)
+    _, report = proc.communicate()
+    imports = []
+    for line in report.splitlines():
+        fields = line.split('|')
+        if line.startswith('import time:') and len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]), fields[2].strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark CLI startup')
+    parser.add_argument('--runs', type=int, default=10, help='Starts to time')
+    parser.add_argument('--top', type=int, default=15, help='Slowest imports to list')
+    parser.add_argument('--threshold', type=float, help='Fail if the median start takes longer (ms)')
+    args = parser.parse_args()
+
+    times = sorted(start_times(args.runs))
+    median = times[len(times) // 2]
+    print("%-8s %8s %8s %8s" % ('starts', 'min', 'median', 'max'))
+    print("%-8d %7.1fms %7.1fms %7.1fms" % (len(times), times[0], median, times[-1]))
+    imports = slowest_imports(args.top)
+    if imports:
+        print("\n%10s  %s" % ('cumulative', 'module'))
+        for usec, module in imports:
+            print("%8.1fms  %s" % (usec / 1000.0, module))
+    if args.threshold is not None and median > args.threshold:
+        sys.stderr.write("median start %.1fms is over the %.1fms threshold\n" % (median, args.threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare fixed-interval, per-instance polling with the batched waiter against
+the fake EC2 connection. Times are scaled down; the defaults mimic the old 30 s
+sleep against a ~45 s boot at 1/100th speed.
+
+    python -m PopupServer.test.bench_waiter --count 30
+"""
+
+import argparse
+import time
+
+from PopupServer import waiter
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+
+def fixed_interval(conn, instances, desired, interval):
+    """What PopupServer.start used to do, once per instance"""
+    for instance in instances:
+        instance.update()
+        while instance.state != desired:
+            time.sleep(interval)
+            instance.update()
+
+
+def batched(conn, instances, desired, interval):
+    waiter.wait_for_state(conn, [i.id for i in instances], desired)
+
+
+def run(strategy, args):
+    conn = FakeEC2Connection(latency=args.latency, boot_time=args.boot_time)
+    instances = conn.run_instances('ami-7539b41c', args.count, args.count).instances
+    began = time.time()
+    strategy(conn, instances, u'running', args.interval)
+    return conn.calls['describe_instances'], time.time() - began
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark instance state polling')
+    parser.add_argument('--count', type=int, default=10, help='Instances to wait on')
+    parser.add_argument('--boot-time', type=float, default=0.45, help='Seconds from pending to running')
+    parser.add_argument('--latency', type=float, default=0.002, help='Seconds per API call')
+    parser.add_argument('--interval', type=float, default=0.3, help='Fixed polling interval')
+    args = parser.parse_args()
+
+    waiter.DELAY = args.interval / 15
+    waiter.MAX_DELAY = args.interval
+    print("%-8s %8s %14s" % ('strategy', 'calls', 'time-to-ready'))
+    for name, strategy in [('fixed', fixed_interval), ('waiter', batched)]:
+        calls, elapsed = run(strategy, args)
+        print("%-8s %8d %13.3fs" % (name, calls, elapsed))
+
+
+if __name__ == '__main__':
+    main()
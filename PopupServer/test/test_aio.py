@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import unittest
+
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+try:
+    import asyncio
+    from PopupServer import aio
+except (ImportError, SyntaxError):
+    aio = None
+
+
+def _run(*coros):
+    """Results of the coroutines, run concurrently on a fresh loop. No await here so python 2 can load the module"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(asyncio.gather(*coros))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@unittest.skipIf(aio is None or sys.version_info < (3, 7), 'asyncio control plane needs python 3.7+')
+class ControllerTest(PopupHomeTestCase):
+    def test_lifecycle(self):
+        conn = FakeEC2Connection(boot_time=0.05, stop_time=0.05, terminate_time=0.05)
+        controller = aio.Controller(conn, limit=4)
+        try:
+            servers = _run(*[controller.create(make_args(client='c%d' % n), provision_hosts=False) for n in range(5)])
+            popups, = _run(controller.inventory('tester', refresh=True))
+            stopped, = _run(controller.stop('tester', client='c0', wait=True))
+            failures, = _run(controller.destroy(make_args(all=True, client=None, tag=None, workers=4)))
+        finally:
+            controller.close()
+        self.assertEqual(len(popups), 5)
+        self.assertEqual(stopped, [servers[0].instance.id])
+        self.assertEqual(failures, [])
+        self.assertEqual(set(i.state for i in conn.instances.values()), set([u'terminated']))
+
+    def test_booting_and_terminating_do_not_hold_a_thread(self):
+        conn = FakeEC2Connection(boot_time=0.3, terminate_time=0.3)
+        controller = aio.Controller(conn, limit=2)
+        try:
+            began = time.time()
+            _run(*[controller.create(make_args(client='c%d' % n), provision_hosts=False) for n in range(6)])
+            created = time.time() - began
+            began = time.time()
+            failures, = _run(controller.destroy(make_args(all=True, client=None, tag=None, workers=2)))
+            destroyed = time.time() - began
+        finally:
+            controller.close()
+        # Three rounds of two creates each would take 0.9s if a thread waited out every boot
+        self.assertTrue(created < 0.8, created)
+        self.assertTrue(destroyed < 0.8, destroyed)
+        self.assertEqual(failures, [])
+        self.assertEqual(len(os.listdir('%s/.popup/manifests' % self.home)), 0)
+
+    def test_concurrency_is_limited(self):
+        conn = FakeEC2Connection(latency=0.02)
+        controller = aio.Controller(conn, limit=3)
+        try:
+            _run(*[controller.ec2('get_all_instances') for _ in range(12)])
+        finally:
+            controller.close()
+        self.assertEqual(conn.calls['describe_instances'], 12)
+        self.assertEqual(conn.max_inflight, 3)
+
+    def test_waiting_does_not_hold_a_thread(self):
+        conn = FakeEC2Connection(boot_time=0.2)
+        ids = [i.id for i in conn.run_instances('ami-7539b41c', 20, 20).instances]
+        # One worker is enough for twenty concurrent waits
+        controller = aio.Controller(conn, limit=1)
+        try:
+            results = _run(*[controller.wait_for_state([id], u'running') for id in ids])
+        finally:
+            controller.close()
+        self.assertEqual(sorted(id for r in results for id in r), sorted(ids))
+
+
+if __name__ == '__main__':
+    unittest.main()
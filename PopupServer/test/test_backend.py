@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import inspect
+import unittest
+
+from PopupServer import backend
+from PopupServer.fake_ec2 import FakeEC2Connection, FakeEC2Error
+
+
+def _arg_names(fn):
+    spec = inspect.getfullargspec(fn) if hasattr(inspect, 'getfullargspec') else inspect.getargspec(fn)
+    return spec.args
+
+
+class BackendTest(unittest.TestCase):
+    def test_both_backends_cover_every_operation(self):
+        from boto.ec2.connection import EC2Connection
+        self.assertEqual(backend.missing_operations(EC2Connection), [])
+        self.assertEqual(backend.missing_operations(FakeEC2Connection()), [])
+
+    def test_sim_takes_only_what_boto_takes(self):
+        # Anything else passes the tests and fails with a TypeError against EC2
+        from boto.ec2.connection import EC2Connection
+        for op in backend.OPERATIONS:
+            boto_args = _arg_names(getattr(EC2Connection, op))
+            sim_args = _arg_names(getattr(FakeEC2Connection, op))
+            self.assertEqual([arg for arg in sim_args if arg not in boto_args], [], op)
+
+    def test_connect(self):
+        conn = backend.connect('sim', boot_time=0.5)
+        self.assertTrue(isinstance(conn, FakeEC2Connection))
+        self.assertEqual(conn.boot_time, 0.5)
+        self.assertRaises(ValueError, backend.connect, 'gce')
+
+
+class SimulatorTest(unittest.TestCase):
+    def test_throttling_is_deterministic(self):
+        conn = FakeEC2Connection(throttle={'describe_instances': 3})
+        outcomes = []
+        for _ in range(6):
+            try:
+                conn.get_all_instances()
+                outcomes.append('ok')
+            except FakeEC2Error as e:
+                outcomes.append(e.error_code)
+        self.assertEqual(outcomes, ['ok', 'ok', 'RequestLimitExceeded'] * 2)
+        self.assertEqual(conn.throttled['describe_instances'], 2)
+        # Other actions aren't affected
+        conn.create_key_pair('k1')
+
+    def test_instance_quota(self):
+        conn = FakeEC2Connection(quotas={'instances': 5})
+        self.assertEqual(len(conn.run_instances('ami-7539b41c', 2, 4).instances), 4)
+        # Only one slot left: fewer than min_count fails, otherwise it's capped
+        self.assertRaises(FakeEC2Error, conn.run_instances, 'ami-7539b41c', 2, 2)
+        self.assertEqual(len(conn.run_instances('ami-7539b41c', 1, 3).instances), 1)
+        conn.terminate_instances([i.id for i in conn.instances.values()])
+        self.assertEqual(len(conn.run_instances('ami-7539b41c', 5, 5).instances), 5)
+
+    def test_group_and_key_quotas(self):
+        conn = FakeEC2Connection(quotas={'security_groups': 1, 'key_pairs': 1})
+        conn.create_security_group('a', 'a')
+        conn.create_key_pair('a')
+        try:
+            conn.create_security_group('b', 'b')
+            self.fail('expected SecurityGroupLimitExceeded')
+        except FakeEC2Error as e:
+            self.assertEqual(e.error_code, 'SecurityGroupLimitExceeded')
+        self.assertRaises(FakeEC2Error, conn.create_key_pair, 'b')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import unittest
+
+from PopupServer import PopupServer, bake, popup, provision
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection, FakeEC2Error
+
+
+class BakeTest(PopupHomeTestCase):
+    def setUp(self):
+        PopupHomeTestCase.setUp(self)
+        self.conn = FakeEC2Connection(image_time=0.05)
+        self.applied = []
+        self._provision = provision.provision
+        provision.provision = lambda targets, playbooks, forks, **kwargs: self.applied.append((targets, playbooks)) or []
+
+    def tearDown(self):
+        provision.provision = self._provision
+        PopupHomeTestCase.tearDown(self)
+
+    def _bake(self, **kwargs):
+        defaults = dict(iam='tester', size='micro', playbooks=['mosh', 'tmux'], force=False, forks=5, workers=4)
+        defaults.update(kwargs)
+        return popup.bake_popup(self.conn, argparse.Namespace(**defaults))
+
+    def test_digest_depends_on_base_and_playbooks(self):
+        digest = bake.playbook_digest('ami-7539b41c', ['mosh', 'tmux'])
+        self.assertEqual(digest, bake.playbook_digest('ami-7539b41c', ['tmux', 'mosh']))
+        self.assertNotEqual(digest, bake.playbook_digest('ami-9b3db0f2', ['mosh', 'tmux']))
+        self.assertNotEqual(digest, bake.playbook_digest('ami-7539b41c', ['mosh']))
+
+    def test_bake_then_create_uses_baked_image(self):
+        image_id = self._bake()
+        self.assertEqual(len(self.applied), 1)
+        self.assertEqual(self.conn.images[image_id].state, u'available')
+        # The builder is gone
+        self.assertEqual(self.conn.security_groups, {})
+        server = PopupServer.PopupServer(self.conn, make_args(playbooks=['tmux', 'mosh']))
+        self.assertTrue(server.baked)
+        self.assertEqual(self.conn.instances[server.instance.id].image_id, image_id)
+
+    def test_create_falls_back_to_stock(self):
+        self._bake()
+        server = PopupServer.PopupServer(self.conn, make_args(playbooks=['mosh', 'tor']))
+        self.assertFalse(server.baked)
+        self.assertEqual(server.ami, 'ami-7539b41c')
+
+    def test_existing_image_is_reused(self):
+        image_id = self._bake()
+        self.assertEqual(self._bake(), image_id)
+        self.assertEqual(len(self.applied), 1)
+
+    def test_force_replaces_the_image(self):
+        old = self._bake()
+        new = self._bake(force=True)
+        self.assertNotEqual(new, old)
+        self.assertEqual(len(self.applied), 2)
+        # The old image is only retired once the new one is available
+        self.assertEqual([i for i in self.conn.images if self.conn.images[i].owner_id == 'self'], [new])
+        server = PopupServer.PopupServer(self.conn, make_args(playbooks=['mosh', 'tmux']))
+        self.assertEqual(self.conn.instances[server.instance.id].image_id, new)
+
+    def test_image_names_are_unique(self):
+        server = PopupServer.PopupServer(self.conn, make_args())
+        self.conn.create_image(server.instance.id, 'popup-abc')
+        self.assertRaises(FakeEC2Error, self.conn.create_image, server.instance.id, 'popup-abc')
+        self.assertNotEqual(bake.image_name('abc' * 10, now=1), bake.image_name('abc' * 10, now=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from PopupServer import bake
+
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _run(code, *argv):
+    """Runs code in a fresh interpreter without AWS credentials; returns (status, output)"""
+    env = dict(os.environ, IAM_ID='tester')
+    env.pop('AWS_ACCESS_KEY_ID', None)
+    env.pop('AWS_SECRET_ACCESS_KEY', None)
+    proc = subprocess.Popen([sys.executable, '-c', code] + list(argv), cwd=_ROOT, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    output = proc.communicate()[0]
+    return proc.returncode, output
+
+
+class StartupTest(unittest.TestCase):
+    def test_parser_leaves_heavy_imports_alone(self):
+        status, output = _run("import sys; from PopupServer import popup; popup.get_parser(); "
+            "print(sorted(m for m in ['boto', 'multiprocessing.pool', 'sqlite3', 'pdb'] if m in sys.modules))")
+        self.assertEqual(status, 0, output)
+        self.assertEqual(output.strip(), '[]')
+
+    def test_version_and_license_need_no_credentials(self):
+        main = "import sys; sys.argv[0] = 'popup'; from PopupServer import popup; popup.main()"
+        status, output = _run(main, '--version')
+        self.assertEqual(status, 0, output)
+        self.assertIn('popup version', output)
+        status, output = _run(main, 'license')
+        self.assertEqual(status, 0, output)
+        self.assertIn('Meangrape', output)
+
+    def test_playbooks_from_manifest(self):
+        manifest = bake.PLAYBOOK_MANIFEST
+        fd, bake.PLAYBOOK_MANIFEST = tempfile.mkstemp()
+        try:
+            os.write(fd, b'mosh\ntmux\n')
+            os.close(fd)
+            self.assertEqual(bake.available_playbooks(), ['mosh', 'tmux'])
+            os.remove(bake.PLAYBOOK_MANIFEST)
+            # A checkout has no manifest and falls back to the directory
+            self.assertEqual(bake.available_playbooks(), ['mosh', 'openvpn', 'sshd', 'tmux', 'tor'])
+        finally:
+            bake.PLAYBOOK_MANIFEST = manifest
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import unittest
+
+from PopupServer import PopupServer, backend
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+
+class CreateTest(PopupHomeTestCase):
+    def test_single_popup(self):
+        conn = FakeEC2Connection()
+        server = PopupServer.PopupServer(conn, make_args(client='acme'))
+        self.assertEqual(len(conn.instances), 1)
+        instance = list(conn.instances.values())[0]
+        self.assertEqual(instance.tags['owner'], 'tester')
+        self.assertEqual(instance.tags['client'], 'acme')
+        self.assertEqual(instance.tags['popup_id'], server.unique_tag)
+        self.assertEqual(len(conn.security_groups[server.name_tag].rules), len(PopupServer.PORTS))
+        self.assertTrue(os.path.exists('%s/.popup/keys/%s.pem' % (self.home, server.name_tag)))
+        self.assertEqual(len(os.listdir('%s/.popup/manifests' % self.home)), 1)
+        self.assertTrue(server.connection_string.endswith('ubuntu@%s' % instance.public_dns_name))
+
+    def test_stock_image_is_not_described(self):
+        conn = FakeEC2Connection()
+        PopupServer.PopupServer(conn, make_args(stock=True))
+        self.assertEqual(conn.calls['describe_images'], 0)
+
+    def test_fleet_uses_one_run_request(self):
+        conn = FakeEC2Connection(boot_time=0.05)
+        server = PopupServer.PopupServer(conn, make_args(count=5))
+        self.assertEqual(conn.calls['run_instances'], 1)
+        self.assertEqual(len(server.instances), 5)
+        self.assertEqual(len(server.connection_strings), 5)
+        self.assertTrue(all(i.state == u'running' for i in conn.instances.values()))
+        self.assertEqual(len(os.listdir('%s/.popup/manifests' % self.home)), 5)
+
+    def test_fleet_setup_is_concurrent(self):
+        conn = FakeEC2Connection(latencies={'create_key_pair': 0.2, 'create_security_group': 0.2})
+        began = time.time()
+        PopupServer.PopupServer(conn, make_args(count=3, workers=8))
+        elapsed = time.time() - began
+        # The key pair is created while the security group is
+        self.assertTrue(conn.max_inflight > 1)
+        self.assertTrue(elapsed < 0.35, elapsed)
+
+    def test_tags_are_batched(self):
+        conn = FakeEC2Connection()
+        server = PopupServer.PopupServer(conn, make_args(count=4, client='acme'))
+        # One for the key pair and security group; the fleet is tagged as it's launched
+        self.assertEqual(conn.calls['create_tags'], 1)
+        for resource in list(conn.instances.values()) + [conn.security_groups[server.name_tag], conn.key_pairs[server.name_tag]]:
+            self.assertEqual(resource.tags['popup_id'], server.unique_tag)
+            self.assertEqual(resource.tags['client'], 'acme')
+        self.assertEqual(server.instance.tags['owner'], 'tester')
+
+    def test_run_instances_request_carries_tags(self):
+        conn = FakeEC2Connection()
+        requests = []
+        get_object = conn.get_object
+        def recording(action, params, cls, **kwargs):
+            requests.append((action, dict(params)))
+            return get_object(action, params, cls, **kwargs)
+        conn.get_object = recording
+        server = PopupServer.PopupServer(conn, make_args(count=2))
+        (action, params), = requests
+        self.assertEqual(action, 'RunInstances')
+        self.assertEqual(params['TagSpecification.1.ResourceType'], 'instance')
+        tags = dict((params['TagSpecification.1.Tag.%d.Key' % n], params['TagSpecification.1.Tag.%d.Value' % n])
+            for n in range(1, 6) if 'TagSpecification.1.Tag.%d.Key' % n in params)
+        self.assertEqual(tags['popup_id'], server.unique_tag)
+        self.assertEqual(params['SecurityGroup.1'], server.group_name)
+
+    def test_launch_tags(self):
+        conn = FakeEC2Connection()
+        server = PopupServer.PopupServer(conn, make_args(count=4))
+        self.assertEqual(conn.calls['create_tags'], 1)
+        self.assertEqual(set(i.tags['popup_id'] for i in conn.instances.values()), set([server.unique_tag]))
+
+    def test_shared_resources_keep_their_tags(self):
+        conn = FakeEC2Connection()
+        server = PopupServer.PopupServer(conn, make_args(share='owner', share_key=True))
+        self.assertNotIn('popup_id', conn.security_groups[server.group_name].tags)
+        self.assertNotIn('popup_id', conn.key_pairs[server.key_name].tags)
+
+
+class SpotTest(PopupHomeTestCase):
+    def test_spot_fleet(self):
+        conn = FakeEC2Connection(spot_time=0.02)
+        server = PopupServer.PopupServer(conn, make_args(count=3, spot=True, spot_timeout=5))
+        self.assertEqual(conn.calls['run_instances'], 0)
+        self.assertEqual(len(server.spot_requests), 3)
+        self.assertEqual(set(i.spot_instance_request_id for i in server.instances), set(server.spot_requests))
+        # Bid over the highest zone's price
+        self.assertEqual(set(r.price for r in conn.spot_requests.values()), set(['0.0048']))
+        self.assertEqual(conn.spot_requests[server.spot_requests[0]].tags['popup_id'], server.unique_tag)
+
+    def test_spot_request_carries_a_client_token(self):
+        conn = FakeEC2Connection(spot_time=0.02)
+        requests = []
+        get_list = conn.get_list
+        def recording(action, params, markers, **kwargs):
+            requests.append((action, dict(params)))
+            return get_list(action, params, markers, **kwargs)
+        conn.get_list = recording
+        server = PopupServer.PopupServer(conn, make_args(count=2, spot=True, spot_timeout=5))
+        (action, params), = requests
+        self.assertEqual(action, 'RequestSpotInstances')
+        self.assertEqual(params['LaunchSpecification.SecurityGroup.1'], server.group_name)
+        # Sending it again gets the same requests back
+        again = backend.request_spot_instances(conn, params['SpotPrice'], server.ami, 2, server.key_name, [server.group_name],
+            server.size, client_token=params['ClientToken'])
+        self.assertEqual(sorted(r.id for r in again), sorted(server.spot_requests))
+        self.assertEqual(len(conn.spot_requests), 2)
+
+    def test_unfulfilled_requests_fall_back_to_on_demand(self):
+        conn = FakeEC2Connection(spot_time=None)
+        server = PopupServer.PopupServer(conn, make_args(count=2, spot=True, max_price=0.01, spot_timeout=0.05))
+        self.assertEqual(set(r.state for r in conn.spot_requests.values()), set([u'cancelled']))
+        self.assertEqual(conn.calls['run_instances'], 1)
+        self.assertEqual(len(server.instances), 2)
+        self.assertEqual(server.spot_requests, [])
+
+    def test_partial_fulfilment(self):
+        conn = FakeEC2Connection(spot_time=0.0, spot_capacity=1)
+        server = PopupServer.PopupServer(conn, make_args(count=3, spot=True, spot_timeout=0.05))
+        self.assertEqual(len(server.spot_requests), 1)
+        self.assertEqual(len(server.instances), 3)
+        self.assertEqual(len(conn.reservations[-1].instances), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+from PopupServer import PopupServer, popup
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+
+def destroy_args(**kwargs):
+    defaults = dict(all=False, client=None, tag=None, workers=4)
+    defaults.update(kwargs)
+    return make_args(**defaults)
+
+
+class DestroyTest(PopupHomeTestCase):
+    def setUp(self):
+        PopupHomeTestCase.setUp(self)
+        self.conn = FakeEC2Connection(terminate_time=0.05)
+        self.fleet = PopupServer.PopupServer(self.conn, make_args(count=3, client='training'))
+        self.single = PopupServer.PopupServer(self.conn, make_args())
+        for instance in self.fleet.instances + self.single.instances:
+            open('%s/.popup/config/ssh_configs/%s' % (self.home, instance.public_dns_name), 'w').close()
+
+    def test_destroy_all(self):
+        failures = popup.destroy_popup(self.conn, destroy_args(all=True))
+        self.assertEqual(failures, [])
+        self.assertEqual(self.conn.calls['terminate_instances'], 1)
+        self.assertEqual(set(i.state for i in self.conn.instances.values()), set([u'terminated']))
+        self.assertEqual(self.conn.security_groups, {})
+        self.assertEqual(self.conn.key_pairs, {})
+        for d in ['keys', 'manifests', 'config/ssh_configs']:
+            self.assertEqual(os.listdir('%s/.popup/%s' % (self.home, d)), [])
+
+    def test_stopped_popup_leaves_no_files(self):
+        popup.stop_popup(self.conn, make_args(all=True, client=None, tag=None, force=False, wait=True))
+        self.assertEqual(self.conn.instances[self.single.instance.id].public_dns_name, '')
+        self.assertEqual(popup.destroy_popup(self.conn, destroy_args(all=True)), [])
+        for d in ['keys', 'manifests', 'config/ssh_configs']:
+            self.assertEqual(os.listdir('%s/.popup/%s' % (self.home, d)), [])
+
+    def test_destroy_by_client_leaves_others(self):
+        popup.destroy_popup(self.conn, destroy_args(client='training'))
+        self.assertEqual(list(self.conn.security_groups), [self.single.name_tag])
+        self.assertEqual(self.conn.instances[self.single.instance.id].state, u'running')
+        self.assertEqual(len(os.listdir('%s/.popup/manifests' % self.home)), 1)
+
+    def test_failures_do_not_abort_the_batch(self):
+        # Someone already removed the group behind our back
+        del self.conn.security_groups[self.fleet.name_tag]
+        failures = popup.destroy_popup(self.conn, destroy_args(all=True))
+        self.assertEqual([resource for resource, _ in failures], ['security group %s' % self.fleet.name_tag])
+        self.assertEqual(self.conn.key_pairs, {})
+        self.assertEqual(os.listdir('%s/.popup/keys' % self.home), [])
+
+    def test_spot_requests_are_cancelled(self):
+        conn = FakeEC2Connection(spot_time=0.0)
+        server = PopupServer.PopupServer(conn, make_args(count=2, spot=True, spot_timeout=5))
+        # An open request that never launched anything
+        conn.spot_time = None
+        orphan = conn.request_spot_instances('0.01', 'ami-7539b41c')[0].id
+        conn.create_tags([orphan], {'owner': 'tester', 'popup_id': server.unique_tag})
+        self.assertEqual(popup.destroy_popup(conn, destroy_args(tag=server.unique_tag)), [])
+        self.assertEqual(conn.calls['cancel_spot_instance_requests'], 1)
+        self.assertEqual(conn.spot_requests[orphan].state, u'cancelled')
+        self.assertEqual(set(conn.instances[i.id].state for i in server.instances), set([u'terminated']))
+
+
+class SharedResourceTest(PopupHomeTestCase):
+    def test_shared_resources_outlive_all_but_the_last_popup(self):
+        conn = FakeEC2Connection()
+        first = PopupServer.PopupServer(conn, make_args(share='owner', share_key=True))
+        second = PopupServer.PopupServer(conn, make_args(share='owner', share_key=True))
+        self.assertEqual(conn.calls['create_security_group'], 1)
+        self.assertEqual(conn.calls['authorize_security_group'], 1)
+        self.assertEqual(conn.calls['create_key_pair'], 1)
+        self.assertEqual(list(conn.security_groups), ['popup-tester-shared'])
+        self.assertEqual(first.keyfile, second.keyfile)
+
+        self.assertEqual(popup.destroy_popup(conn, destroy_args(tag=first.unique_tag)), [])
+        self.assertEqual(list(conn.security_groups), ['popup-tester-shared'])
+        self.assertEqual(list(conn.key_pairs), ['popup-tester-shared'])
+        self.assertTrue(os.path.exists(second.keyfile))
+
+        self.assertEqual(popup.destroy_popup(conn, destroy_args(tag=second.unique_tag)), [])
+        self.assertEqual(conn.security_groups, {})
+        self.assertEqual(conn.key_pairs, {})
+        self.assertFalse(os.path.exists(second.keyfile))
+
+    def test_shared_key_picked_up_during_release_is_kept(self):
+        conn = FakeEC2Connection()
+        server = PopupServer.PopupServer(conn, make_args(share='owner', share_key=True))
+        delete_key_pair = conn.delete_key_pair
+        def racing_create(name):
+            # Another create launches with the key just as it's deleted
+            conn.run_instances('ami-7539b41c', key_name=name)
+            return delete_key_pair(name)
+        conn.delete_key_pair = racing_create
+        popup.destroy_popup(conn, destroy_args(tag=server.unique_tag))
+        self.assertTrue(os.path.exists(server.keyfile))
+
+    def test_shared_key_kept_if_delete_fails(self):
+        conn = FakeEC2Connection()
+        server = PopupServer.PopupServer(conn, make_args(share='owner', share_key=True))
+        def fails(name):
+            raise Exception('RequestLimitExceeded')
+        conn.delete_key_pair = fails
+        failures = popup.destroy_popup(conn, destroy_args(tag=server.unique_tag))
+        self.assertEqual([resource for resource, _ in failures], ['keypair popup-tester-shared'])
+        self.assertTrue(os.path.exists(server.keyfile))
+
+    def test_per_client_group_with_own_keys(self):
+        conn = FakeEC2Connection()
+        server = PopupServer.PopupServer(conn, make_args(share='client', client='acme'))
+        self.assertEqual(list(conn.security_groups), ['popup-tester-client-acme'])
+        self.assertEqual(list(conn.key_pairs), [server.name_tag])
+        popup.destroy_popup(conn, destroy_args(client='acme'))
+        self.assertEqual(conn.security_groups, {})
+        self.assertEqual(conn.key_pairs, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
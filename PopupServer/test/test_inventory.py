@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from PopupServer import PopupServer, discovery, index
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+
+class DiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeEC2Connection()
+        self.mine = self._launch(3, owner='tester', popup_id='abc', client='acme', start_date='20130101')
+        self.other = self._launch(1, owner='tester', popup_id='def', start_date='20130101')
+        self._launch(5, owner='someone', popup_id='xyz', start_date='20130101')
+        self._launch(5)
+
+    def _launch(self, count, **tags):
+        ids = []
+        for _ in range(count):
+            instance = self.conn.run_instances('ami-7539b41c').instances[0]
+            self.conn.create_tags([instance.id], tags)
+            ids.append(instance.id)
+        return ids
+
+    def test_filters_are_pushed_to_ec2(self):
+        popups = list(discovery.find_popups(self.conn, 'tester', client='acme'))
+        self.assertEqual(sorted(p.id for p in popups), sorted(self.mine))
+        self.assertEqual(set(p.name for p in popups), set(['popup-tester-abc']))
+        self.assertEqual(self.conn.calls['describe_instances'], 1)
+
+    def test_results_are_paged_lazily(self):
+        popups = discovery.find_popups(self.conn, 'tester', page_size=2)
+        first = next(popups)
+        self.assertEqual(self.conn.calls['describe_instances'], 1)
+        rest = list(popups)
+        self.assertEqual(sorted([first.id] + [p.id for p in rest]), sorted(self.mine + self.other))
+        self.assertEqual(self.conn.calls['describe_instances'], 2)
+
+    def test_terminated_instances_are_skipped(self):
+        self.conn.terminate_instances(self.other)
+        popups = list(discovery.find_popups(self.conn, 'tester'))
+        self.assertEqual(sorted(p.id for p in popups), sorted(self.mine))
+
+
+class IndexTest(PopupHomeTestCase):
+    def setUp(self):
+        PopupHomeTestCase.setUp(self)
+        self.conn = FakeEC2Connection()
+        self.server = PopupServer.PopupServer(self.conn, make_args(count=2, client='acme'))
+        self.index = index.Index()
+
+    def test_create_records_popups(self):
+        popups = self.index.find('tester', client='acme')
+        self.assertEqual(sorted(p.id for p in popups), sorted(i.id for i in self.server.instances))
+        self.assertEqual(set(p.state for p in popups), set([u'running']))
+
+    def test_fresh_index_answers_without_ec2(self):
+        self.index.sync(self.conn, 'tester')
+        calls = self.conn.calls['describe_instances']
+        popups = self.index.lookup(self.conn, 'tester', popup_id=self.server.unique_tag)
+        self.assertEqual(len(popups), 2)
+        self.assertEqual(self.conn.calls['describe_instances'], calls)
+
+    def test_stale_index_reconciles_in_background(self):
+        self.index.sync(self.conn, 'tester')
+        self.conn.terminate_instances([self.server.instance.id])
+        calls = self.conn.calls['describe_instances']
+        # Slow enough that the cached answer comes back first
+        self.conn.latency = 0.2
+        self.assertEqual(len(self.index.lookup(self.conn, 'tester', ttl=0)), 2)
+        self.index.wait()
+        self.assertEqual(self.conn.calls['describe_instances'], calls + 1)
+        self.assertEqual(len(self.index.find('tester')), 1)
+
+    def test_refresh_forces_sync(self):
+        self.index.sync(self.conn, 'tester')
+        self.conn.terminate_instances([self.server.instance.id])
+        self.assertEqual(len(self.index.lookup(self.conn, 'tester', refresh=True)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
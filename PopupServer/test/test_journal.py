@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import threading
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from PopupServer import journal, popup, waiter
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+
+class Killed(BaseException):
+    pass
+
+
+class JournalTest(PopupHomeTestCase):
+    def setUp(self):
+        PopupHomeTestCase.setUp(self)
+        self._wait_for_state = waiter.wait_for_state
+        self._spawn_resume = popup._spawn_resume
+
+    def tearDown(self):
+        waiter.wait_for_state = self._wait_for_state
+        popup._spawn_resume = self._spawn_resume
+        PopupHomeTestCase.tearDown(self)
+
+    def _interrupted_create(self, conn, **kwargs):
+        """A create killed while waiting for its instances; returns its journal"""
+        def killed(*args, **kwargs):
+            raise Killed()
+        waiter.wait_for_state = killed
+        self.assertRaises(Killed, popup.create_popup, conn, make_args(playbooks=[], **kwargs))
+        waiter.wait_for_state = self._wait_for_state
+        ops, = journal.operations()
+        return ops
+
+    def _killed_before(self, conn, step, **kwargs):
+        """A create killed after doing step but before recording it; returns its journal"""
+        record = journal.Journal.record
+        skipped = []
+        def killed(ops, name, **data):
+            if name == step:
+                skipped.append(name)
+            if not skipped:
+                return record(ops, name, **data)
+            # A pool thread that dies leaves create waiting forever, so the kill lands on the main thread
+            if threading.current_thread().name == 'MainThread':
+                raise Killed()
+        journal.Journal.record = killed
+        try:
+            self.assertRaises(Killed, popup.create_popup, conn, make_args(playbooks=[], **kwargs))
+        finally:
+            journal.Journal.record = record
+        ops, = journal.operations()
+        return ops
+
+    def test_steps_are_recorded(self):
+        conn = FakeEC2Connection()
+        server = popup.create_popup(conn, make_args(playbooks=[], count=2))
+        ops, = journal.operations()
+        self.assertEqual(ops.state, journal.DONE)
+        self.assertEqual(ops.steps, ['identity', 'security_group', 'key_pair', 'resources_tagged', 'launched', 'manifest'])
+        self.assertEqual(ops.done('identity')['popup_id'], server.unique_tag)
+        self.assertEqual(sorted(ops.done('launched')['instance_ids']), sorted(conn.instances))
+
+    def test_resume_skips_completed_steps(self):
+        conn = FakeEC2Connection()
+        ops = self._interrupted_create(conn, count=3, client='acme')
+        self.assertEqual(ops.state, journal.FAILED)
+        self.assertEqual(ops.steps[-1], 'launched')
+        calls = dict(conn.calls)
+        server = popup.resume(conn, argparse.Namespace(op=ops.op, rollback=False))
+        for call in ['create_key_pair', 'create_security_group', 'run_instances', 'create_tags']:
+            self.assertEqual(conn.calls[call], calls[call], call)
+        self.assertEqual(len(conn.instances), 3)
+        self.assertEqual(server.unique_tag, ops.done('identity')['popup_id'])
+        self.assertEqual(server.args.client, 'acme')
+        self.assertEqual(len(server.connection_strings), 3)
+        self.assertEqual(journal.Journal.load(ops.op).state, journal.DONE)
+
+    def test_resumed_launch_is_not_repeated(self):
+        conn = FakeEC2Connection()
+        ops = self._killed_before(conn, 'launched', count=2)
+        self.assertEqual(ops.steps[-1], 'resources_tagged')
+        launched = sorted(conn.instances)
+        server = popup.resume(conn, argparse.Namespace(op=ops.op, rollback=False))
+        # The launch was sent again with the same client token and got the original instances back
+        self.assertEqual(conn.calls['run_instances'], 2)
+        self.assertEqual(sorted(conn.instances), launched)
+        self.assertEqual(sorted(server.instance_ids), launched)
+        self.assertEqual(journal.Journal.load(ops.op).state, journal.DONE)
+
+    def test_unrecorded_security_group_is_adopted(self):
+        conn = FakeEC2Connection()
+        ops = self._killed_before(conn, 'security_group')
+        server = popup.resume(conn, argparse.Namespace(op=ops.op, rollback=False))
+        self.assertEqual(conn.calls['create_security_group'], 1)
+        self.assertEqual(conn.calls['authorize_security_group'], 1)
+        self.assertEqual(list(conn.security_groups), [server.group_name])
+        self.assertEqual(journal.Journal.load(ops.op).state, journal.DONE)
+
+    def test_unrecorded_key_pair_is_adopted(self):
+        conn = FakeEC2Connection()
+        ops = self._killed_before(conn, 'key_pair')
+        server = popup.resume(conn, argparse.Namespace(op=ops.op, rollback=False))
+        self.assertEqual(conn.calls['create_key_pair'], 1)
+        self.assertEqual(server.key_material, conn.key_pairs[server.key_name].material)
+
+    def test_lost_private_key_points_to_rollback(self):
+        conn = FakeEC2Connection()
+        ops = self._killed_before(conn, 'key_pair')
+        os.remove('%s/.popup/keys/%s.pem' % (self.home, ops.done('identity')['key_name']))
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.assertRaises(SystemExit, popup.resume, conn, argparse.Namespace(op=ops.op, rollback=False))
+            self.assertIn('resume --rollback %s' % ops.op, sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(journal.Journal.load(ops.op).state, journal.FAILED)
+        popup.resume(conn, argparse.Namespace(op=ops.op, rollback=True))
+        self.assertEqual(conn.key_pairs, {})
+        self.assertEqual(conn.security_groups, {})
+
+    def test_rollback(self):
+        conn = FakeEC2Connection()
+        ops = self._interrupted_create(conn, count=2)
+        popup.resume(conn, argparse.Namespace(op=ops.op, rollback=True))
+        self.assertEqual(set(i.state for i in conn.instances.values()), set([u'terminated']))
+        self.assertEqual(conn.security_groups, {})
+        self.assertEqual(conn.key_pairs, {})
+        self.assertEqual(os.listdir('%s/.popup/keys' % self.home), [])
+        self.assertEqual(journal.Journal.load(ops.op).state, journal.ROLLED_BACK)
+
+    def test_detach_returns_after_launch(self):
+        conn = FakeEC2Connection(boot_time=10)
+        spawned = []
+        popup._spawn_resume = lambda args, op: spawned.append(op)
+        server = popup.create_popup(conn, make_args(playbooks=[], detach=True))
+        ops, = journal.operations()
+        self.assertEqual(spawned, [ops.op])
+        self.assertEqual(ops.state, journal.DETACHED)
+        self.assertEqual(server.instance_ids, list(conn.instances))
+        self.assertEqual(server.instances, [])
+        self.assertEqual(os.listdir('%s/.popup/manifests' % self.home), [])
+
+    def test_dead_process_is_interrupted(self):
+        ops = journal.Journal.create(journal.new_op(), 'create', make_args())
+        self.assertEqual(ops.state, journal.RUNNING)
+        ops.set_state(journal.RUNNING, pid=2 ** 22 + 1)
+        self.assertEqual(journal.Journal.load(ops.op).state, 'interrupted')
+
+
+if __name__ == '__main__':
+    unittest.main()
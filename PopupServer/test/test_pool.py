@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+from PopupServer import index, pool, popup, provision
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+
+class PoolTest(PopupHomeTestCase):
+    def setUp(self):
+        PopupHomeTestCase.setUp(self)
+        self._settle = pool.CLAIM_SETTLE
+        self._provision = provision.provision
+        self._spawn_refill = popup._spawn_refill
+        pool.CLAIM_SETTLE = 0
+        provision.provision = lambda targets, playbooks, forks, **kwargs: []
+        self.refills = []
+        popup._spawn_refill = lambda args, count: self.refills.append(count)
+        self.conn = FakeEC2Connection()
+        self.args = make_args(playbooks=['mosh', 'tmux'], forks=5, from_pool=True, refill=True)
+        pool.fill(self.conn, self.args, 3)
+
+    def tearDown(self):
+        pool.CLAIM_SETTLE = self._settle
+        provision.provision = self._provision
+        popup._spawn_refill = self._spawn_refill
+        PopupHomeTestCase.tearDown(self)
+
+    def test_fill_leaves_stopped_members(self):
+        members = pool.standby(self.conn, 'tester', 'micro', ['tmux', 'mosh'])
+        self.assertEqual(len(members), 3)
+        self.assertEqual(len(self.conn.security_groups), 1)
+        self.assertEqual(pool.fill(self.conn, self.args, 3), [])
+        self.assertEqual(len(pool.fill(self.conn, self.args, 4)), 1)
+
+    def test_claim_retags_and_starts(self):
+        launches = self.conn.calls['run_instances']
+        popup.create_popup(self.conn, make_args(playbooks=['mosh', 'tmux'], client='acme', from_pool=True, refill=True, forks=5))
+        self.assertEqual(self.conn.calls['run_instances'], launches)
+        running = [i for i in self.conn.instances.values() if i.state == u'running']
+        self.assertEqual(len(running), 1)
+        self.assertEqual(running[0].tags['client'], 'acme')
+        self.assertTrue('pool' not in running[0].tags)
+        self.assertEqual(len(pool.standby(self.conn, 'tester', 'micro', ['mosh', 'tmux'])), 2)
+        self.assertEqual(self.refills, [3])
+        self.assertTrue(any(running[0].public_dns_name in m for m in os.listdir('%s/.popup/manifests' % self.home)))
+
+    def test_stale_standby_list_does_not_steal_a_claim(self):
+        members = pool.standby(self.conn, 'tester', 'micro', ['mosh', 'tmux'])
+        instances, _ = pool.claim(self.conn, make_args(playbooks=['mosh', 'tmux'], client='acme'), count=3)
+        self.assertEqual(len(instances), 3)
+        # A second claim working from the list taken before the first one finished
+        standby = pool.standby
+        pool.standby = lambda *args, **kwargs: members
+        try:
+            self.assertEqual(pool.claim(self.conn, make_args(playbooks=['mosh', 'tmux'], client='bob')), ([], []))
+        finally:
+            pool.standby = standby
+        self.assertEqual(set(self.conn.instances[i.id].tags['client'] for i in instances), set(['acme']))
+
+    def test_claimed_popup_destroy_keeps_pool_resources(self):
+        instances, _ = pool.claim(self.conn, self.args)
+        popup.destroy_popup(self.conn, make_args(all=False, client=None, tag=instances[0].tags['popup_id'], workers=2))
+        self.assertEqual(len(self.conn.security_groups), 1)
+        self.assertEqual(len(self.conn.key_pairs), 1)
+
+    def test_everyday_commands_leave_the_pool_alone(self):
+        mine = popup.create_popup(self.conn, make_args(playbooks=[], forks=5))
+        self.assertEqual([p.id for p in index.Index().lookup(self.conn, 'tester', refresh=True)], [mine.instance.id])
+        popup.stop_popup(self.conn, make_args(all=True, client=None, tag=None, force=False, wait=False))
+        popup.destroy_popup(self.conn, make_args(all=True, client=None, tag=None, workers=2))
+        self.assertEqual(self.conn.instances[mine.instance.id].state, u'terminated')
+        self.assertEqual(len(pool.standby(self.conn, 'tester', 'micro', ['mosh', 'tmux'])), 3)
+        self.assertEqual(len(self.conn.security_groups), 1)
+        popup.destroy_popup(self.conn, make_args(all=False, client=None, tag=None, pool=True, workers=2))
+        self.assertEqual(pool.standby(self.conn, 'tester', 'micro', ['mosh', 'tmux']), [])
+
+    def test_empty_pool_falls_back_to_launch(self):
+        popup.create_popup(self.conn, make_args(playbooks=['tor'], from_pool=True, refill=True, forks=5))
+        self.assertEqual(self.conn.calls['run_instances'], 2)
+        self.assertEqual(self.refills, [])
+
+    def test_drain(self):
+        popup.pool_drain(self.conn, make_args(workers=2))
+        self.assertEqual(pool.standby(self.conn, 'tester', 'micro', ['mosh', 'tmux']), [])
+        self.assertEqual(self.conn.security_groups, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from PopupServer import PopupServer, popup, reaper
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+
+class _Woken(Exception):
+    pass
+
+
+class ReaperTest(PopupHomeTestCase):
+    def setUp(self):
+        PopupHomeTestCase.setUp(self)
+        self.conn = FakeEC2Connection(stop_time=0.05, terminate_time=0.05)
+
+    def _create(self, expires_in, **kwargs):
+        server = PopupServer.PopupServer(self.conn, make_args(**kwargs))
+        self.conn.create_tags([i.id for i in server.instances], {reaper.EXPIRES_TAG: reaper.expires_tag(1, time.time() - 3600 + expires_in)})
+        return server
+
+    def test_lifetime_is_tagged(self):
+        server = PopupServer.PopupServer(self.conn, make_args(lifetime=2, count=2))
+        expected = time.time() + 2 * 3600
+        for resource in [self.conn.instances[i.id] for i in server.instances] + [self.conn.security_groups[server.name_tag]]:
+            self.assertTrue(abs(reaper.expires_at(resource) - expected) < 5)
+        forever = PopupServer.PopupServer(self.conn, make_args(lifetime=0))
+        self.assertNotIn(reaper.EXPIRES_TAG, self.conn.instances[forever.instance.id].tags)
+
+    def test_once_stops_only_expired_popups(self):
+        expired = self._create(-60, count=2)
+        alive = self._create(3600)
+        forever = PopupServer.PopupServer(self.conn, make_args(lifetime=0))
+        describes = self.conn.calls['describe_instances']
+        reaped = []
+        reaper.Reaper(self.conn, 'tester').run(once=True, on_reap=reaped.extend)
+        self.assertEqual(sorted(p.id for p in reaped), sorted(i.id for i in expired.instances))
+        self.assertEqual(self.conn.calls['stop_instances'], 1)
+        # One describe to build the heap, one to confirm the due batch
+        self.assertEqual(self.conn.calls['describe_instances'] - describes, 2)
+        for server in [alive, forever]:
+            self.assertEqual(self.conn.instances[server.instance.id].state, u'running')
+
+    def test_extended_lifetime_is_respected(self):
+        server = self._create(-60)
+        r = reaper.Reaper(self.conn, 'tester')
+        r.sync()
+        # Someone bumps the lifetime after the heap was built
+        self.conn.create_tags([server.instance.id], {reaper.EXPIRES_TAG: reaper.expires_tag(1)})
+        self.assertEqual(r.reap(), [])
+        self.assertEqual(self.conn.calls['stop_instances'], 0)
+        self.assertTrue(r.next_deadline() > time.time())
+
+    def test_sleeps_until_the_next_deadline(self):
+        self._create(30)
+        slept = []
+        def sleep(seconds):
+            slept.append(seconds)
+            raise _Woken()
+        self.assertRaises(_Woken, reaper.Reaper(self.conn, 'tester', resync=600).run, sleep=sleep)
+        self.assertTrue(25 < slept[0] <= 30, slept)
+
+    def test_resync_is_incremental(self):
+        first = self._create(3600)
+        r = reaper.Reaper(self.conn, 'tester')
+        r.sync()
+        second = self._create(1800)
+        r.sync()
+        self.assertEqual(len(r.heap), 2)
+        self.assertEqual(sorted(r.known), sorted([first.instance.id, second.instance.id]))
+
+    def test_terminate_destroys_in_one_batch(self):
+        expired = [self._create(-60), self._create(-30)]
+        popup.reap(self.conn, make_args(once=True, terminate=True, resync=reaper.RESYNC))
+        self.assertEqual(self.conn.calls['terminate_instances'], 1)
+        for server in expired:
+            self.assertEqual(self.conn.instances[server.instance.id].state, u'terminated')
+        self.assertEqual(self.conn.security_groups, {})
+
+    def test_spot_popups_are_terminated_not_stopped(self):
+        self.conn.spot_time = 0.02
+        spot = self._create(-60, spot=True, spot_timeout=5)
+        on_demand = self._create(-60)
+        r = reaper.Reaper(self.conn, 'tester')
+        r.sync()
+        self.assertEqual(len(r.reap()), 2)
+        self.assertEqual(self.conn.calls['stop_instances'], 1)
+        self.assertEqual(self.conn.calls['terminate_instances'], 1)
+        self.assertIn(self.conn.instances[spot.instance.id].state, [u'shutting-down', u'terminated'])
+        self.assertIn(self.conn.instances[on_demand.instance.id].state, [u'stopping', u'stopped'])
+
+    def _fail_once(self, throttle):
+        """Runs a reaper whose first cycle is throttled until it sleeps a second time"""
+        self.conn.throttle = throttle
+        slept = []
+        def sleep(seconds):
+            slept.append(seconds)
+            if len(slept) == 2:
+                raise _Woken()
+            self.conn.throttle = {}
+        self.assertRaises(_Woken, reaper.Reaper(self.conn, 'tester').run, sleep=sleep)
+        self.assertEqual(slept[0], reaper.ERROR_DELAY)
+
+    def test_failed_stop_is_retried(self):
+        server = self._create(-60)
+        self._fail_once({'stop_instances': 1})
+        self.assertEqual(self.conn.calls['stop_instances'], 2)
+        self.assertNotEqual(self.conn.instances[server.instance.id].state, u'running')
+
+    def test_failed_confirm_is_retried(self):
+        server = self._create(-60)
+        # The sync's describe goes through, the one confirming the due batch fails
+        self._fail_once({'describe_instances': self.conn.calls['describe_instances'] + 2})
+        self.assertEqual(self.conn.calls['stop_instances'], 1)
+        self.assertNotEqual(self.conn.instances[server.instance.id].state, u'running')
+
+
+if __name__ == '__main__':
+    unittest.main()
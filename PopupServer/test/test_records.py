@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import csv
+import json
+import sys
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from PopupServer import discovery, popup, records
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+
+def _popup(id, state=u'running', launch_time='2013-01-01T00:00:00.000Z', instance_type='t1.micro'):
+    return discovery.Popup(id, 'abc', 'tester', 'acme', '20130101', 'ec2-%s.example.com' % id, state, launch_time,
+        {'owner': 'tester', 'popup_id': 'abc'}, None, None, None, instance_type)
+
+
+class RecordTest(unittest.TestCase):
+    def test_age_and_cost(self):
+        rec = records.record(_popup('i-1'), now=1356998400 + 7200)
+        self.assertEqual(rec['age'], 7200)
+        self.assertEqual(rec['cost'], 0.04)
+        self.assertEqual(records.record(_popup('i-2', state=u'stopped'), now=1356998400 + 7200)['cost'], None)
+        self.assertEqual(records.record(_popup('i-3', launch_time=None))['age'], None)
+
+    def test_jsonl_streams(self):
+        out = StringIO()
+        seen = []
+        def produce():
+            for n in range(3):
+                # Everything before this record has already been written
+                seen.append(out.getvalue().count('\n'))
+                yield records.record(_popup('i-%d' % n))
+        records.write(out, produce(), 'jsonl', ['id', 'state'])
+        self.assertEqual(seen, [0, 1, 2])
+        self.assertEqual([json.loads(line) for line in out.getvalue().splitlines()],
+            [{'id': 'i-%d' % n, 'state': 'running'} for n in range(3)])
+
+    def test_json_and_csv(self):
+        recs = [records.record(_popup('i-%d' % n)) for n in range(2)]
+        out = StringIO()
+        records.write(out, iter(recs), 'json', ['id', 'tags'])
+        self.assertEqual(json.loads(out.getvalue())[1], {'id': 'i-1', 'tags': {'owner': 'tester', 'popup_id': 'abc'}})
+        out = StringIO()
+        records.write(out, iter(recs), 'csv', ['id', 'dns', 'tags'])
+        rows = list(csv.reader(StringIO(out.getvalue())))
+        self.assertEqual(rows[0], ['id', 'dns', 'tags'])
+        self.assertEqual(rows[2], ['i-1', 'ec2-i-1.example.com', 'owner=tester,popup_id=abc'])
+
+    def test_table_sorts(self):
+        recs = [records.record(_popup('i-%d' % n, launch_time='2013-01-0%dT00:00:00.000Z' % (3 - n))) for n in range(3)]
+        out = StringIO()
+        records.write(out, recs, 'table', ['id', 'launch_time'], sort='launch_time')
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0].split(), ['id', 'launch_time'])
+        self.assertEqual([line.split()[0] for line in lines[1:]], ['i-2', 'i-1', 'i-0'])
+
+    def test_parse_columns(self):
+        self.assertEqual(records.parse_columns('id, dns'), ['id', 'dns'])
+        self.assertRaises(argparse.ArgumentTypeError, records.parse_columns, 'id,size')
+
+
+class OutputTest(PopupHomeTestCase):
+    def setUp(self):
+        PopupHomeTestCase.setUp(self)
+        self._stdout, self._stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self._stdout, self._stderr
+        PopupHomeTestCase.tearDown(self)
+
+    def _launch(self, conn, count):
+        instances = conn.run_instances('ami-7539b41c', count, count, instance_type='t1.micro').instances
+        conn.create_tags([i.id for i in instances], {'owner': 'tester', 'popup_id': 'abc', 'start_date': '20130101'})
+        return sorted(i.id for i in instances)
+
+    def test_inventory_jsonl(self):
+        conn = FakeEC2Connection()
+        ids = self._launch(conn, 3)
+        popup.inventory(conn, make_args(tag=None, refresh=True, detailed=False, format='jsonl',
+            columns=['id', 'instance_type'], sort=None))
+        rows = [json.loads(line) for line in sys.stdout.getvalue().splitlines()]
+        self.assertEqual(sorted(r['id'] for r in rows), ids)
+        self.assertEqual(set(r['instance_type'] for r in rows), set(['t1.micro']))
+
+    def test_dry_runs_change_nothing(self):
+        conn = FakeEC2Connection()
+        ids = self._launch(conn, 2)
+        options = dict(all=True, tag=None, dry_run=True, format='csv', columns=['id', 'state'], sort=None)
+        popup.stop_popup(conn, make_args(force=False, wait=False, **options))
+        popup.destroy_popup(conn, make_args(**options))
+        self.assertEqual(conn.calls['stop_instances'], 0)
+        self.assertEqual(conn.calls['terminate_instances'], 0)
+        self.assertEqual(set(i.state for i in conn.instances.values()), set([u'running']))
+        rows = list(csv.reader(StringIO(sys.stdout.getvalue())))
+        self.assertEqual(rows, [['id', 'state']] + [[id, 'running'] for id in ids] + [['id', 'state']] + [[id, 'running'] for id in ids])
+
+
+if __name__ == '__main__':
+    unittest.main()
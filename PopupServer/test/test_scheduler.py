@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from PopupServer import PopupServer, scheduler
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection, FakeEC2Error
+
+
+class SchedulerTest(PopupHomeTestCase):
+    def setUp(self):
+        PopupHomeTestCase.setUp(self)
+        self._delays = scheduler.BASE_DELAY, scheduler.MAX_DELAY
+        scheduler.BASE_DELAY, scheduler.MAX_DELAY = 0.001, 0.01
+
+    def tearDown(self):
+        scheduler.BASE_DELAY, scheduler.MAX_DELAY = self._delays
+        PopupHomeTestCase.tearDown(self)
+
+    def test_throttled_calls_are_retried(self):
+        conn = scheduler.Scheduler(FakeEC2Connection(throttle={'describe_instances': 2}))
+        for _ in range(4):
+            conn.get_all_instances()
+        stats = conn.metrics()['get_all_instances']
+        self.assertEqual((stats['calls'], stats['retries'], stats['throttled']), (7, 3, 3))
+        # Anything that isn't an operation passes straight through
+        self.assertEqual(conn.calls['describe_instances'], 7)
+
+    def test_retry_budget_is_shared(self):
+        conn = scheduler.Scheduler(FakeEC2Connection(throttle={'*': 1}), retry_budget=3)
+        self.assertRaises(FakeEC2Error, conn.get_all_instances)
+        self.assertRaises(FakeEC2Error, conn.get_all_key_pairs)
+        self.assertEqual(conn.metrics()['total']['retries'], 3)
+
+    def test_transient_errors(self):
+        conn = scheduler.Scheduler(FakeEC2Connection())
+        attempts = []
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise FakeEC2Error('InternalError: try again')
+            return 'ok'
+        self.assertEqual(conn.call('get_all_instances', flaky), 'ok')
+        # Might already have launched something
+        del attempts[:]
+        self.assertRaises(FakeEC2Error, conn.call, 'run_instances', flaky)
+        self.assertEqual(len(attempts), 1)
+        # Not retryable at all
+        self.assertRaises(FakeEC2Error, conn.delete_security_group, 'missing')
+        self.assertEqual(conn.metrics()['delete_security_group']['retries'], 0)
+
+    def test_rate_limit(self):
+        conn = scheduler.Scheduler(FakeEC2Connection(), rates={'create_tags': (50.0, 1)})
+        instance = conn.run_instances('ami-7539b41c').instances[0]
+        began = time.time()
+        for n in range(6):
+            conn.create_tags([instance.id], {'n': str(n)})
+        self.assertTrue(time.time() - began >= 0.09)
+        self.assertTrue(conn.metrics()['create_tags']['throttled_time'] > 0.05)
+
+    def test_bulk_create_under_throttling_tags_everything(self):
+        fake = FakeEC2Connection(throttle={'*': 2})
+        # So the create's own tagging request is the one that's throttled
+        fake.create_tags([], {})
+        server = PopupServer.PopupServer(scheduler.Scheduler(fake), make_args(count=10))
+        self.assertEqual(len(fake.instances), 10)
+        for instance in fake.instances.values():
+            self.assertEqual(instance.tags['popup_id'], server.unique_tag)
+        self.assertTrue(sum(fake.throttled.values()) > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
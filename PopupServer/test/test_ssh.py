@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import subprocess
+import unittest
+
+from PopupServer import ansible_env, provision
+from PopupServer.test import PopupHomeTestCase
+
+
+class SSHConfigTest(PopupHomeTestCase):
+    def test_host_config(self):
+        path = ansible_env.ssh_config('ec2-1.example.com', '/keys/popup.pem')
+        self.assertEqual(path, '%s/.popup/config/ssh_configs/ec2-1.example.com' % self.home)
+        lines = [line.strip() for line in open(path).read().splitlines()]
+        self.assertEqual(lines[0], 'Host ec2-1.example.com')
+        self.assertTrue('IdentityFile /keys/popup.pem' in lines)
+        self.assertTrue('ControlMaster auto' in lines)
+        self.assertTrue('ControlPath %s/.popup/config/ssh_control/%%r@%%h:%%p' % self.home in lines)
+        self.assertTrue('ControlPersist %s' % ansible_env.CONTROL_PERSIST in lines)
+
+    def test_environment_leaves_os_environ_alone(self):
+        before = dict(os.environ)
+        env = ansible_env.environment('/tmp/fleet')
+        self.assertEqual(env['ANSIBLE_SSH_ARGS'], '-F /tmp/fleet')
+        self.assertEqual(dict(os.environ), before)
+
+
+class ProvisionTest(PopupHomeTestCase):
+    def setUp(self):
+        PopupHomeTestCase.setUp(self)
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        self.runs = []
+        self._check_call = subprocess.check_call
+        self._wait_for_ssh = provision.wait_for_ssh
+        subprocess.check_call = self._record
+        provision.wait_for_ssh = lambda hostnames, timeout: [h for h in hostnames if h.startswith('down')]
+
+    def tearDown(self):
+        subprocess.check_call = self._check_call
+        provision.wait_for_ssh = self._wait_for_ssh
+        self.listener.close()
+        PopupHomeTestCase.tearDown(self)
+
+    def _record(self, cmd, env=None):
+        inventory = open(cmd[cmd.index('-i') + 1]).read()
+        config = open(env['ANSIBLE_SSH_ARGS'].split()[1]).read()
+        self.runs.append((cmd, inventory, config))
+
+    def test_one_run_for_all_hosts(self):
+        targets = [('h%d.example.com' % i, '/keys/k.pem') for i in range(3)] + [('down.example.com', '/keys/k.pem')]
+        unreachable = provision.provision(targets, ['mosh', 'tmux'], forks=7)
+        self.assertEqual(unreachable, ['down.example.com'])
+        self.assertEqual(len(self.runs), 1)
+        cmd, inventory, config = self.runs[0]
+        self.assertEqual(cmd[cmd.index('-f') + 1], '7')
+        self.assertEqual(cmd[-2:], [provision.playbook_path('mosh'), provision.playbook_path('tmux')])
+        self.assertEqual(inventory.split(), ['[popups]', 'h0.example.com', 'h1.example.com', 'h2.example.com'])
+        self.assertEqual(config.count('ControlMaster auto'), 3)
+        self.assertEqual(sorted(os.listdir('%s/.popup/config/ssh_configs' % self.home)),
+            ['h0.example.com', 'h1.example.com', 'h2.example.com'])
+
+    def test_extra_vars_survive_spaces(self):
+        provision.provision([('h0.example.com', '/keys/k.pem')], ['mosh'], extra_vars={'vpn_dir': '/home/a user/vpn dir'})
+        cmd = self.runs[0][0]
+        self.assertEqual(json.loads(cmd[cmd.index('-e') + 1]), {'vpn_dir': '/home/a user/vpn dir'})
+
+    def test_wait_for_ssh(self):
+        self.assertEqual(self._wait_for_ssh(['127.0.0.1'], port=self.port, timeout=1), [])
+        self.listener.close()
+        self.assertEqual(self._wait_for_ssh(['127.0.0.1'], port=self.port, timeout=0.1, delay=0.05), ['127.0.0.1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
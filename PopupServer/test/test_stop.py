@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from PopupServer import popup
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+
+class StopTest(PopupHomeTestCase):
+    def _launch(self, conn, count, **tags):
+        instances = conn.run_instances('ami-7539b41c', count, count).instances
+        for instance in instances:
+            conn.create_tags([instance.id], dict(tags))
+        return [i.id for i in instances]
+
+    def test_stop_and_wait(self):
+        conn = FakeEC2Connection(stop_time=0.05)
+        mine = self._launch(conn, 3, owner='tester', popup_id='abc', start_date='20130101')
+        theirs = self._launch(conn, 1, owner='someone', popup_id='xyz', start_date='20130101')
+        popup.stop_popup(conn, make_args(all=True, client=None, tag=None, force=False, wait=True))
+        self.assertEqual(set(conn.instances[id].state for id in mine), set([u'stopped']))
+        self.assertEqual(conn.instances[theirs[0]].state, u'running')
+
+    def test_spot_instances_are_skipped(self):
+        conn = FakeEC2Connection(spot_time=0.0)
+        spot = conn.request_spot_instances('0.01', 'ami-7539b41c')[0]
+        conn.create_tags([spot.id], {'owner': 'tester', 'popup_id': 'abc'})
+        instance_id = conn.get_all_spot_instance_requests([spot.id])[0].instance_id
+        conn.create_tags([instance_id], {'owner': 'tester', 'popup_id': 'abc', 'start_date': '20130101'})
+        on_demand = self._launch(conn, 1, owner='tester', popup_id='abc', start_date='20130101')
+        popup.stop_popup(conn, make_args(all=False, client=None, tag='abc', force=False, wait=True))
+        self.assertEqual(conn.instances[instance_id].state, u'running')
+        self.assertEqual(conn.instances[on_demand[0]].state, u'stopped')
+
+
+if __name__ == '__main__':
+    unittest.main()
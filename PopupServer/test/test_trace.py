@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sys
+import unittest
+
+from PopupServer import PopupServer, popup, scheduler, trace
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+
+class TraceTest(PopupHomeTestCase):
+    def setUp(self):
+        PopupHomeTestCase.setUp(self)
+        self.trace_file = os.path.join(self.home, 'trace.jsonl')
+        self._delay = scheduler.BASE_DELAY
+        scheduler.BASE_DELAY = 0.001
+
+    def tearDown(self):
+        trace.disable()
+        scheduler.BASE_DELAY = self._delay
+        PopupHomeTestCase.tearDown(self)
+
+    def test_disabled_by_default(self):
+        before = len(trace.spans())
+        PopupServer.PopupServer(scheduler.Scheduler(FakeEC2Connection()), make_args())
+        self.assertEqual(len(trace.spans()), before)
+
+    def test_phases_and_api_calls(self):
+        trace.enable(self.trace_file)
+        fake = FakeEC2Connection(throttle={'run_instances': 2}, stop_time=0.02, terminate_time=0.02)
+        # So the popup's launch is the throttled second call and its retry the third
+        fake.run_instances('ami-7539b41c')
+        conn = scheduler.Scheduler(fake)
+        server = PopupServer.PopupServer(conn, make_args(count=2))
+        popup.stop_popup(conn, make_args(all=True, client=None, tag=None, force=False, wait=True))
+        popup.destroy_popup(conn, make_args(all=True, client=None, tag=None))
+        trace.disable()
+
+        with open(self.trace_file) as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual(len(spans), len(trace.spans()))
+        names = set(s['name'] for s in spans)
+        for name in ['create', 'create.key_pair', 'create.security_group', 'create.launch', 'create.wait_running',
+                'gather', 'stop.request', 'stop.wait_stopped', 'destroy.terminate', 'destroy.cleanup', 'run_instances']:
+            self.assertIn(name, names)
+        launch = [s for s in spans if s['name'] == 'create.launch'][0]
+        self.assertEqual(sorted(launch['instance_ids']), sorted(i.id for i in server.instances))
+        run = [s for s in spans if s['name'] == 'run_instances'][0]
+        self.assertEqual((run['kind'], run['parent'], run['retries']), ('api', launch['id'], 1))
+        stop = [s for s in spans if s['name'] == 'stop_instances'][0]
+        self.assertEqual(stop['ids'], sorted(i.id for i in server.instances))
+        self.assertIn('run_instances', trace.report())
+
+    def test_cli_profile(self):
+        argv, stderr, iam = sys.argv, sys.stderr, os.environ.get('IAM_ID')
+        os.environ['IAM_ID'] = 'tester'
+        sys.argv = ['popup', '-b', 'sim', '--profile', '--trace-file', self.trace_file, 'inventory', '-r']
+        sys.stderr = open(os.path.join(self.home, 'stderr'), 'w')
+        try:
+            popup.main()
+        finally:
+            sys.stderr.close()
+            sys.argv, sys.stderr = argv, stderr
+            if iam is None:
+                del os.environ['IAM_ID']
+            else:
+                os.environ['IAM_ID'] = iam
+        with open(os.path.join(self.home, 'stderr')) as f:
+            report = f.read()
+        self.assertIn('command', report)
+        self.assertIn('get_all_reservations', report)
+        self.assertFalse(trace.enabled())
+        with open(self.trace_file) as f:
+            self.assertEqual(json.loads(f.readlines()[-1])['name'], 'command')
+
+
+if __name__ == '__main__':
+    unittest.main()
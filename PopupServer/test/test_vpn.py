@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from PopupServer import journal, popup, provision, vpn
+from PopupServer.test import PopupHomeTestCase, make_args
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+
+def _has_openssl():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['openssl', 'version'], stdout=devnull, stderr=devnull)
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+@unittest.skipUnless(_has_openssl(), 'needs the openssl command')
+class VPNTest(PopupHomeTestCase):
+    def setUp(self):
+        PopupHomeTestCase.setUp(self)
+        self._sizes = vpn.DH_BITS, vpn.KEY_BITS
+        vpn.DH_BITS, vpn.KEY_BITS = 512, 1024
+        self._provision = provision.provision
+        self.uploads = []
+        provision.provision = lambda targets, playbooks, forks=None, extra_vars=None: self.uploads.append(
+            (targets, playbooks, extra_vars)) or []
+        self._openssl = vpn._openssl
+        self.openssl = []
+        def counted(*args):
+            self.openssl.append(args[0])
+            return self._openssl(*args)
+        vpn._openssl = counted
+        self._stdout, self._stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self._stdout, self._stderr
+        vpn._openssl = self._openssl
+        provision.provision = self._provision
+        vpn.DH_BITS, vpn.KEY_BITS = self._sizes
+        PopupHomeTestCase.tearDown(self)
+
+    def _verify(self, owner, crt):
+        ca = vpn.certificate_authority(owner)[1]
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(['openssl', 'verify', '-CAfile', ca, crt], stdout=devnull, stderr=devnull) == 0
+
+    def test_profiles(self):
+        paths = vpn.profiles('tester', 'abc', vpn.user_names(3), ['h0.example.com', 'h1.example.com'])
+        self.assertEqual([os.path.basename(p) for p in paths], ['user1.ovpn', 'user2.ovpn', 'user3.ovpn'])
+        with open(paths[0]) as f:
+            bundle = f.read()
+        for block in ['<ca>', '<cert>', '<key>', '<tls-auth>', 'remote h0.example.com 1194', 'remote h1.example.com 1194']:
+            self.assertTrue(block in bundle, block)
+        directory = vpn.popup_dir('tester', 'abc')
+        self.assertTrue(vpn.has_server_artifacts('tester', 'abc'))
+        self.assertTrue(self._verify('tester', os.path.join(directory, 'server.crt')))
+        self.assertTrue(self._verify('tester', os.path.join(directory, 'user2.crt')))
+        self.assertEqual(os.stat(os.path.join(directory, 'user2.key')).st_mode & 0o777, 0o600)
+
+    def test_dh_params_and_ca_are_reused(self):
+        vpn.profiles('tester', 'abc', ['alice'], ['h0.example.com'])
+        with open(vpn.certificate_authority('tester')[1]) as f:
+            ca = f.read()
+        del self.openssl[:]
+        vpn.profiles('tester', 'xyz', ['alice', 'bob'], ['h1.example.com'])
+        self.assertFalse('dhparam' in self.openssl)
+        # One key and one signature each for the server and both users
+        self.assertEqual(sorted(self.openssl), ['req'] * 3 + ['x509'] * 3)
+        with open(vpn.certificate_authority('tester')[1]) as f:
+            self.assertEqual(f.read(), ca)
+        # Existing certificates aren't reissued
+        del self.openssl[:]
+        vpn.profiles('tester', 'xyz', ['alice', 'bob'], ['h1.example.com'])
+        self.assertEqual(self.openssl, [])
+
+    def test_ca_is_created_once_across_processes(self):
+        import multiprocessing
+        workers = [multiprocessing.Process(target=vpn.certificate_authority, args=('tester',)) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual([w.exitcode for w in workers], [0] * 3)
+        key, crt = vpn.certificate_authority('tester')
+        public = lambda args: subprocess.check_output(['openssl'] + args)
+        self.assertEqual(public(['pkey', '-in', key, '-pubout']), public(['x509', '-in', crt, '-noout', '-pubkey']))
+
+    def test_create_with_vpn_users(self):
+        conn = FakeEC2Connection()
+        server = popup.create_popup(conn, make_args(playbooks=[], vpn_users=2, forks=5))
+        (targets, playbooks, extra_vars), = self.uploads
+        self.assertEqual(playbooks, [vpn.UPLOAD_PLAYBOOK])
+        self.assertEqual(extra_vars, {'vpn_dir': vpn.popup_dir('tester', server.unique_tag)})
+        ops, = journal.operations()
+        self.assertEqual([os.path.basename(p) for p in ops.done('vpn')['profiles']], ['user1.ovpn', 'user2.ovpn'])
+        # Destroy takes the keys with it
+        popup.destroy_popup(conn, make_args(all=True, tag=None))
+        self.assertFalse(os.path.exists(vpn.popup_dir('tester', server.unique_tag)))
+
+    def test_vpn_profile_uploads_once(self):
+        conn = FakeEC2Connection()
+        server = popup.create_popup(conn, make_args(playbooks=[]))
+        args = make_args(tag=server.unique_tag, users=1, names=None, upload=False, forks=5)
+        popup.vpn_profile(conn, args)
+        self.assertTrue(vpn.was_uploaded('tester', server.unique_tag))
+        args.names = ['carol']
+        paths = popup.vpn_profile(conn, args)
+        self.assertEqual(len(self.uploads), 1)
+        self.assertEqual(os.path.basename(paths[0]), 'carol.ovpn')
+
+    def test_unreachable_upload_is_retried(self):
+        # The server artifacts exist locally, but a host never got them
+        provision.provision = lambda targets, playbooks, forks=None, extra_vars=None: self.uploads.append(
+            (targets, playbooks, extra_vars)) or [targets[0][0]]
+        conn = FakeEC2Connection()
+        server = popup.create_popup(conn, make_args(playbooks=[], vpn_users=1, forks=5))
+        self.assertTrue(vpn.has_server_artifacts('tester', server.unique_tag))
+        self.assertFalse(vpn.was_uploaded('tester', server.unique_tag))
+        args = make_args(tag=server.unique_tag, users=1, names=None, upload=False, forks=5)
+        popup.vpn_profile(conn, args)
+        self.assertEqual(len(self.uploads), 2)
+        # Until it's been delivered everywhere
+        provision.provision = lambda targets, playbooks, forks=None, extra_vars=None: self.uploads.append(
+            (targets, playbooks, extra_vars)) or []
+        popup.vpn_profile(conn, args)
+        self.assertTrue(vpn.was_uploaded('tester', server.unique_tag))
+        popup.vpn_profile(conn, args)
+        self.assertEqual(len(self.uploads), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
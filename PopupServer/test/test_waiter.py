@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from PopupServer import waiter
+from PopupServer.fake_ec2 import FakeEC2Connection
+
+
+class WaiterTest(unittest.TestCase):
+    def setUp(self):
+        self._delay = waiter.DELAY
+        waiter.DELAY = 0.01
+
+    def tearDown(self):
+        waiter.DELAY = self._delay
+
+    def _launch(self, conn, count):
+        return [i.id for i in conn.run_instances('ami-7539b41c', count, count).instances]
+
+    def test_one_describe_per_tick(self):
+        conn = FakeEC2Connection(boot_time=0.1)
+        ids = self._launch(conn, 10)
+        ticks = []
+        ready = waiter.wait_for_state(conn, ids, u'running', tick=lambda pending: ticks.append(len(pending)))
+        self.assertEqual(sorted(ready), sorted(ids))
+        self.assertTrue(all(i.public_dns_name for i in ready.values()))
+        self.assertEqual(conn.calls['describe_instances'], len(ticks))
+        self.assertEqual(ticks[-1], 0)
+
+    def test_backoff_limits_calls(self):
+        conn = FakeEC2Connection(boot_time=0.5)
+        ids = self._launch(conn, 1)
+        waiter.wait_for_state(conn, ids, u'running', max_delay=1)
+        # A fixed 10ms poll would have made ~50 calls
+        self.assertTrue(conn.calls['describe_instances'] < 20, conn.calls['describe_instances'])
+
+    def test_deadline(self):
+        conn = FakeEC2Connection(boot_time=60)
+        ids = self._launch(conn, 2)
+        try:
+            waiter.wait_for_state(conn, ids, u'running', timeout=0.05)
+        except waiter.WaitTimeout as e:
+            self.assertEqual(e.pending, sorted(ids))
+        else:
+            self.fail("WaitTimeout not raised")
+
+    def test_terminated_instances_stop_the_wait(self):
+        conn = FakeEC2Connection(boot_time=60)
+        ids = self._launch(conn, 1)
+        conn.terminate_instances(ids)
+        ready = waiter.wait_for_state(conn, ids, u'running', timeout=1)
+        self.assertEqual(ready[ids[0]].state, u'terminated')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Timing spans for every phase of a command and every API call.
+
+    with trace.span('create.launch', count=3) as s:
+        ...
+        s['instance_ids'] = ids
+
+Tracing is off until enable() is called and spans are then nearly free no-ops.
+Finished spans are kept for summary() and, with a trace file, appended to it
+as JSON lines: name, kind ('phase' or 'api'), start (epoch seconds), duration,
+parent (the enclosing span on the same thread), error, plus the span's attributes.
+"""
+
+import functools
+import itertools
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+
+_enabled = False
+_spans = []
+_file = None
+
+
+def enable(trace_file=None):
+    """Start recording, appending JSON lines to trace_file if given"""
+    global _enabled, _file
+    with _lock:
+        _enabled = True
+        del _spans[:]
+        if trace_file:
+            _file = open(trace_file, 'a')
+
+
+def disable():
+    global _enabled, _file
+    with _lock:
+        _enabled = False
+        if _file is not None:
+            _file.close()
+            _file = None
+
+
+def enabled():
+    return _enabled
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def _null():
+    yield {}
+
+
+@contextmanager
+def _record(name, kind, attrs):
+    stack = _stack()
+    record = {'id': next(_ids), 'name': name, 'kind': kind, 'parent': stack[-1] if stack else None,
+        'start': time.time(), 'error': None}
+    stack.append(record['id'])
+    began = time.time()
+    try:
+        yield attrs
+    except BaseException as e:
+        record['error'] = getattr(e, 'error_code', None) or e.__class__.__name__
+        raise
+    finally:
+        record['duration'] = time.time() - began
+        stack.pop()
+        record.update(attrs)
+        with _lock:
+            _spans.append(record)
+            if _file is not None:
+                _file.write(json.dumps(record, default=str) + '\n')
+                _file.flush()
+
+
+def span(name, kind='phase', **attrs):
+    """Context manager timing name. Yields a dict; anything put in it is recorded with the span"""
+    if not _enabled:
+        return _null()
+    return _record(name, kind, attrs)
+
+
+def traced(name):
+    """Decorator putting every call of a function in a span"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def spans():
+    with _lock:
+        return list(_spans)
+
+
+def summary():
+    """[(name, kind, count, total, max, retries)] ordered by total time"""
+    totals = {}
+    for s in spans():
+        entry = totals.setdefault(s['name'], [s['kind'], 0, 0.0, 0.0, 0])
+        entry[1] += 1
+        entry[2] += s['duration']
+        entry[3] = max(entry[3], s['duration'])
+        entry[4] += s.get('retries', 0) or 0
+    return sorted([(name,) + tuple(entry) for name, entry in totals.items()], key=lambda row: -row[3])
+
+
+def report():
+    lines = ["%-32s %-5s %6s %9s %9s %9s %7s" % ('span', 'kind', 'count', 'total', 'mean', 'max', 'retries')]
+    for name, kind, count, total, longest, retries in summary():
+        lines.append("%-32s %-5s %6d %8.3fs %8.3fs %8.3fs %7d" % (name, kind, count, total, total / count, longest, retries))
+    return '\n'.join(lines)
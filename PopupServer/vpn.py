@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+OpenVPN client profiles, with every key generated on the controller.
+Diffie-Hellman parameters are generated once and cached in ~/.popup/vpn, and each
+owner gets one CA that signs the server and client certificates of all their
+popups. Client certificates are issued in parallel, and only the finished server
+artifacts are uploaded; the instance never runs easy-rsa.
+"""
+
+import fcntl
+import os
+import subprocess
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+from . import provision, trace
+from .bake import PLAYBOOK_DIR
+
+
+DH_BITS = 2048
+KEY_BITS = 2048
+DAYS = 3650
+PORT = 1194
+NETWORK = '10.8.0.0 255.255.255.0'
+WORKERS = 8
+
+# Everything the server needs, uploaded to /etc/openvpn by UPLOAD_PLAYBOOK
+SERVER_ARTIFACTS = ['ca.crt', 'server.crt', 'server.key', 'dh.pem', 'ta.key', 'server.conf']
+UPLOAD_PLAYBOOK = os.path.join(PLAYBOOK_DIR, 'openvpn', 'upload.yaml')
+# Written next to the artifacts once every instance has them
+UPLOADED = 'uploaded'
+
+_USAGE = {'server': 'keyUsage = digitalSignature, keyEncipherment\nextendedKeyUsage = serverAuth\n',
+    'client': 'keyUsage = digitalSignature\nextendedKeyUsage = clientAuth\n'}
+
+# DH parameters and CAs are generated at most once; see _locked
+_lock = threading.Lock()
+
+SERVER_CONF = """port %(port)d
+proto udp
+dev tun
+ca ca.crt
+cert server.crt
+key server.key
+dh dh.pem
+tls-auth ta.key 0
+server %(network)s
+push "redirect-gateway def1 bypass-dhcp"
+push "dhcp-option DNS 8.8.8.8"
+keepalive 10 120
+cipher AES-256-CBC
+user nobody
+group nogroup
+persist-key
+persist-tun
+verb 3
+"""
+
+CLIENT_CONF = """client
+dev tun
+proto udp
+%(remotes)s
+remote-random
+resolv-retry infinite
+nobind
+persist-key
+persist-tun
+remote-cert-tls server
+cipher AES-256-CBC
+key-direction 1
+verb 3
+<ca>
+%(ca)s</ca>
+<cert>
+%(cert)s</cert>
+<key>
+%(key)s</key>
+<tls-auth>
+%(tls_auth)s</tls-auth>
+"""
+
+
+def vpn_dir():
+    return '%s/.popup/vpn' % os.path.expanduser('~')
+
+
+def owner_dir(owner):
+    return os.path.join(vpn_dir(), owner)
+
+
+def popup_dir(owner, popup_id):
+    return os.path.join(owner_dir(owner), popup_id)
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _write(path, content):
+    """Private and atomic: a concurrent reader sees the whole file or none of it"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.rename(tmp, path)
+
+
+@contextmanager
+def _locked(directory):
+    """Exclusive across threads and processes, since detached creates finish in their own popup resume"""
+    _makedirs(directory)
+    with _lock:
+        with open(os.path.join(directory, '.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _openssl(*args):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['openssl'] + list(args), stdout=devnull, stderr=subprocess.STDOUT)
+
+
+def dh_params():
+    """Path of the cached Diffie-Hellman parameters, generating them the first time"""
+    path = os.path.join(vpn_dir(), 'dh.pem')
+    with _locked(vpn_dir()):
+        if not os.path.exists(path):
+            tmp = path + '.tmp'
+            _openssl('dhparam', '-out', tmp, str(DH_BITS))
+            os.rename(tmp, path)
+    return path
+
+
+def certificate_authority(owner):
+    """(key, certificate) paths of owner's CA, creating it the first time"""
+    directory = owner_dir(owner)
+    key, crt = os.path.join(directory, 'ca.key'), os.path.join(directory, 'ca.crt')
+    with _locked(directory):
+        if not os.path.exists(crt):
+            _openssl('req', '-x509', '-newkey', 'rsa:%d' % KEY_BITS, '-nodes', '-keyout', key + '.tmp', '-out', crt + '.tmp',
+                '-days', str(DAYS), '-subj', '/CN=popup-%s-ca' % owner,
+                '-addext', 'basicConstraints = critical, CA:TRUE', '-addext', 'keyUsage = critical, keyCertSign, cRLSign')
+            os.chmod(key + '.tmp', 0o600)
+            # The certificate last: once it exists the pair is complete
+            os.rename(key + '.tmp', key)
+            os.rename(crt + '.tmp', crt)
+    return key, crt
+
+
+def prepare(owner):
+    """The slow, reusable parts: DH parameters and owner's CA"""
+    dh_params()
+    certificate_authority(owner)
+
+
+def issue(owner, directory, name, kind='client'):
+    """A key and certificate for name signed by owner's CA, in directory.
+    Returns (key, certificate) paths; an existing pair is reused.
+    """
+    ca_key, ca_crt = certificate_authority(owner)
+    key, crt = os.path.join(directory, '%s.key' % name), os.path.join(directory, '%s.crt' % name)
+    if os.path.exists(crt):
+        return key, crt
+    csr, ext = crt + '.csr', crt + '.ext'
+    _write(ext, _USAGE[kind])
+    try:
+        _openssl('req', '-new', '-newkey', 'rsa:%d' % KEY_BITS, '-nodes', '-keyout', key, '-out', csr, '-subj', '/CN=%s' % name)
+        os.chmod(key, 0o600)
+        # Random serials so certificates can be issued concurrently without a serial file
+        _openssl('x509', '-req', '-in', csr, '-CA', ca_crt, '-CAkey', ca_key, '-set_serial', '0x%s' % _hex(os.urandom(8)),
+            '-days', str(DAYS), '-extfile', ext, '-out', crt + '.tmp')
+        os.rename(crt + '.tmp', crt)
+    finally:
+        for path in (csr, ext):
+            if os.path.exists(path):
+                os.remove(path)
+    return key, crt
+
+
+def _hex(data):
+    return ''.join('%02x' % b for b in bytearray(data))
+
+
+def tls_auth_key():
+    """An OpenVPN static key (2048 random bits), as written by `openvpn --genkey`"""
+    digits = _hex(os.urandom(256))
+    lines = [digits[n:n + 32] for n in range(0, len(digits), 32)]
+    return '-----BEGIN OpenVPN Static key V1-----\n%s\n-----END OpenVPN Static key V1-----\n' % '\n'.join(lines)
+
+
+def has_server_artifacts(owner, popup_id):
+    directory = popup_dir(owner, popup_id)
+    return all(os.path.exists(os.path.join(directory, name)) for name in SERVER_ARTIFACTS)
+
+
+def mark_uploaded(owner, popup_id):
+    _write(os.path.join(popup_dir(owner, popup_id), UPLOADED), '')
+
+
+def was_uploaded(owner, popup_id):
+    """Whether the server side reached every instance, not just whether it exists here"""
+    return os.path.exists(os.path.join(popup_dir(owner, popup_id), UPLOADED))
+
+
+def server_artifacts(owner, popup_id):
+    """The directory holding SERVER_ARTIFACTS for popup_id, creating whichever are missing.
+    Every instance of a fleet serves with the same certificate.
+    """
+    directory = popup_dir(owner, popup_id)
+    _makedirs(directory)
+    issue(owner, directory, 'server', 'server')
+    files = [('ca.crt', lambda: _read(certificate_authority(owner)[1])), ('dh.pem', lambda: _read(dh_params())),
+        ('ta.key', tls_auth_key), ('server.conf', lambda: SERVER_CONF % {'port': PORT, 'network': NETWORK})]
+    for name, content in files:
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            _write(path, content())
+    return directory
+
+
+def user_names(count, prefix='user'):
+    return ['%s%d' % (prefix, n) for n in range(1, count + 1)]
+
+
+def profile(owner, popup_id, user, hostnames):
+    """Path of user's .ovpn bundle: every host as a remote and every key inline"""
+    directory = popup_dir(owner, popup_id)
+    key, crt = issue(owner, directory, user)
+    path = os.path.join(directory, '%s.ovpn' % user)
+    _write(path, CLIENT_CONF % {'remotes': '\n'.join('remote %s %d' % (h, PORT) for h in hostnames),
+        'ca': _read(os.path.join(directory, 'ca.crt')), 'cert': _read(crt), 'key': _read(key),
+        'tls_auth': _read(os.path.join(directory, 'ta.key'))})
+    return path
+
+
+def profiles(owner, popup_id, users, hostnames, workers=WORKERS):
+    """A bundle per user, with certificates issued in parallel. Returns their paths"""
+    server_artifacts(owner, popup_id)
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(workers, len(users)) or 1)
+    try:
+        return pool.map(lambda user: profile(owner, popup_id, user, hostnames), users)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def upload(targets, directory, forks=provision.FORKS):
+    """Install the finished server artifacts on every (hostname, keyfile) in targets and (re)start OpenVPN.
+    Returns the hostnames SSH never came up on.
+    """
+    return provision.provision(targets, [UPLOAD_PLAYBOOK], forks=forks, extra_vars={'vpn_dir': directory})
+
+
+@trace.traced('vpn')
+def setup(owner, popup_id, users, targets, workers=WORKERS, forks=provision.FORKS, upload_artifacts=True):
+    """Profiles for users of the popup on targets, uploading the server side first unless told not to.
+    The upload is only marked done if every target took it. Returns (profile paths, unreachable hostnames)
+    """
+    unreachable = []
+    if upload_artifacts:
+        unreachable = upload(targets, server_artifacts(owner, popup_id), forks)
+        if not unreachable:
+            mark_uploaded(owner, popup_id)
+    return profiles(owner, popup_id, users, [hostname for hostname, _ in targets], workers), unreachable
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+#Copyright (c) 2012-2013, Meangrape Incorporated
+#All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Wait for a set of EC2 instances (or images, or spot requests) to reach a state.
+All pending ids are refreshed with one describe call per tick and the
+delay between ticks grows exponentially (with jitter) up to a deadline.
+"""
+
+import random
+import time
+
+
+# Seconds. Module level so tests and benchmarks can shrink them.
+DELAY = 2.0
+MAX_DELAY = 30.0
+TIMEOUT = 900.0
+BACKOFF = 1.5
+JITTER = 0.25
+
+# States an instance or image never comes back from
+_DEAD_INSTANCE = set([u'terminated'])
+_DEAD_IMAGE = set([u'failed', u'deregistered'])
+_DEAD_SPOT_REQUEST = set([u'cancelled', u'failed', u'closed'])
+
+
+class WaitTimeout(Exception):
+    def __init__(self, desired, pending, done=None):
+        self.desired = desired
+        self.pending = sorted(pending)
+        # {id: item} for whatever did finish in time
+        self.done = done or {}
+        Exception.__init__(self, "Timed out waiting for %s to be %s" % (', '.join(self.pending), desired))
+
+
+def _not_found(e, code):
+    # Freshly created ids can take a moment to show up in describe calls
+    return getattr(e, 'error_code', None) == code
+
+
+def _describe_instances(conn, ids):
+    """Returns {instance id: instance} for whichever of ids EC2 knows about yet"""
+    try:
+        reservations = conn.get_all_instances(instance_ids=list(ids))
+    except Exception as e:
+        if _not_found(e, 'InvalidInstanceID.NotFound'):
+            return {}
+        raise
+    return dict((i.id, i) for r in reservations for i in r.instances)
+
+
+def _describe_images(conn, ids):
+    try:
+        images = conn.get_all_images(image_ids=list(ids))
+    except Exception as e:
+        if _not_found(e, 'InvalidAMIID.NotFound'):
+            return {}
+        raise
+    return dict((i.id, i) for i in images)
+
+
+def _describe_spot_requests(conn, ids):
+    try:
+        requests = conn.get_all_spot_instance_requests(request_ids=list(ids))
+    except Exception as e:
+        if _not_found(e, 'InvalidSpotInstanceRequestID.NotFound'):
+            return {}
+        raise
+    return dict((r.id, r) for r in requests)
+
+
+def _settle(found, pending, done, desired, dead):
+    """Moves whatever in found has reached desired (or can't anymore) from pending to done"""
+    for id, item in found.items():
+        if item.state == desired or (item.state in dead and desired not in dead):
+            done[id] = item
+            pending.discard(id)
+
+
+def _sleep_for(remaining, delay):
+    return min(remaining, random.uniform(delay * (1 - JITTER), delay))
+
+
+def _wait(conn, describe, dead, ids, desired, timeout, delay, max_delay, tick):
+    timeout = TIMEOUT if timeout is None else timeout
+    delay = DELAY if delay is None else delay
+    max_delay = MAX_DELAY if max_delay is None else max_delay
+
+    deadline = time.time() + timeout
+    pending = set(ids)
+    done = {}
+    while True:
+        _settle(describe(conn, pending), pending, done, desired, dead)
+        if tick is not None:
+            tick(pending)
+        if not pending:
+            return done
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise WaitTimeout(desired, pending, done)
+        time.sleep(_sleep_for(remaining, delay))
+        delay = min(max_delay, delay * BACKOFF)
+
+
+def wait_for_state(conn, instance_ids, desired, timeout=None, delay=None, max_delay=None, tick=None):
+    """Block until every instance in instance_ids is in the desired state.
+
+    tick, if given, is called with the set of still pending ids after every describe.
+    Returns {instance id: instance} with the last seen copy of each instance.
+    Raises WaitTimeout if the deadline passes first.
+    """
+    return _wait(conn, _describe_instances, _DEAD_INSTANCE, instance_ids, desired, timeout, delay, max_delay, tick)
+
+
+def wait_for_image_state(conn, image_ids, desired, timeout=None, delay=None, max_delay=None, tick=None):
+    """wait_for_state for AMIs, e.g. u'available' after create_image"""
+    return _wait(conn, _describe_images, _DEAD_IMAGE, image_ids, desired, timeout, delay, max_delay, tick)
+
+
+def wait_for_spot_requests(conn, request_ids, desired=u'active', timeout=None, delay=None, max_delay=None, tick=None):
+    """wait_for_state for spot requests; u'active' means fulfilled and instance_id is set"""
+    return _wait(conn, _describe_spot_requests, _DEAD_SPOT_REQUEST, request_ids, desired, timeout, delay, max_delay, tick)
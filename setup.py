@@ -2,18 +2,33 @@ import os.path
 import sys
 
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 from build_manpage import build_manpage
 
 HOME=os.path.expanduser('~')
 
+
+class build_py_with_manifest(build_py):
+    """Lists the playbooks in playbooks/MANIFEST so the CLI doesn't scan the directory on every start"""
+
+    def run(self):
+        build_py.run(self)
+        source = os.path.join('PopupServer', 'playbooks')
+        names = sorted(n for n in os.listdir(source) if os.path.isdir(os.path.join(source, n)))
+        target = os.path.join(self.build_lib, 'PopupServer', 'playbooks', 'MANIFEST')
+        if not self.dry_run:
+            with open(target, 'w') as f:
+                f.write(''.join('%s\n' % n for n in names))
+
+
 setup(
     name='popup',
     version='0.2.0',
     author='Jay Edwards',
-    cmdclass={'build_manpage': build_manpage},
+    cmdclass={'build_manpage': build_manpage, 'build_py': build_py_with_manifest},
     author_email='jay@meangrape.com',
     packages=['PopupServer', 'PopupServer.test'],
-    package_data={'PopupServer': ['playbooks/*/*.yaml']},
+    package_data={'PopupServer': ['playbooks/*/*.yaml', 'playbooks/*/templates/*']},
     data_files=[('%s/.popup/config/ssh_configs' % HOME, []),
     ('%s/.popup/config/ssh_control' % HOME, []), ('%s/.popup/keys' % HOME, []),
     ('%s/.popup/manifests' % HOME, []), ('%s/share/man/man1' % sys.prefix, ['doc/popup.1']),
@@ -24,7 +39,7 @@ setup(
     long_description=open('README.txt').read(),
     install_requires=[
        "ansible >= 0.9",
-       "boto >= 2.7.0",
+       "boto >= 2.25.0",
        ],
     setup_requires=[
        "github-distutils >= 0.1.0",